@@ -0,0 +1 @@
+python -m website.utils.migrations "$@"
@@ -0,0 +1,5 @@
+"""
+A load test for the website, run against synthetic tenants.
+
+See ``python -m benchmarks --help`` for the options.
+"""
@@ -0,0 +1,376 @@
+"""
+Seed synthetic tenants and load test every route of the website, reporting
+throughput, latency percentiles, and database queries per request.
+
+By default the website is run in this process against the database in the
+given config. Pass ``--url`` to load test a website that's already running
+instead (it must be using the same database). Queries per request are read
+from each response's ``Server-Timing`` header, so they aren't reported for
+streamed responses or if the website has ``server_timing`` turned off.
+
+Results can be written as JSON with ``--output`` and compared against an
+earlier run with ``--compare``, which exits non-zero if any route's p95
+latency or query count got worse by more than ``--threshold``.
+
+Usage:
+    python -m benchmarks [--config FILE] [--tenants N] [--concurrency N]
+        [--requests N] [--route NAME ...] [--output FILE] [--compare FILE]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+from datetime import datetime as dt
+import importlib
+import json
+import logging
+import math
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Optional
+import aiohttp
+from aiohttp import web
+import asyncpg
+from discord.ext import vbu
+import toml
+
+from website import utils
+
+from .routes import Route, TenantClient, match_routes
+from .seed import Tenant, TenantSize, remove_tenants, seed_tenants
+
+
+# The database stats that every route sends back
+SERVER_TIMING_REGEX = re.compile(r'(?:^|,)\s*db;dur=(?P<duration>[\d.]+);desc="(?P<queries>\d+) queries')
+
+
+def create_app(config: dict[str, Any]) -> web.Application:
+    """
+    Make the website the same way VBU does, with every route module loaded
+    (including any not listed in the config).
+    """
+
+    from aiohttp_jinja2 import setup as jinja_setup
+    from aiohttp_session import setup as session_setup
+    from aiohttp_session.cookie_storage import EncryptedCookieStorage
+    from jinja2 import FileSystemLoader
+
+    app = web.Application()
+    app['static_root_url'] = '/static'
+    route_modules = list(config['routes'])
+    for filename in sorted(os.listdir("website")):
+        name, extension = os.path.splitext(filename)
+        if extension == ".py" and name.startswith(("backend", "frontend")) and name not in route_modules:
+            route_modules.append(name)
+    for route in route_modules:
+        module = importlib.import_module(f"website.{route.replace('/', '.')}")
+        app.router.add_routes(module.routes)
+    app.router.add_static('/static', os.getcwd() + '/website/static', append_version=True)
+    key = (config.get("cookie_encryption_key") or "").encode() or os.urandom(32)
+    session_setup(app, EncryptedCookieStorage(key, max_age=1_000_000))
+    jinja_setup(app, loader=FileSystemLoader(os.getcwd() + '/website/templates'))
+    app['database'] = vbu.Database
+    app['config'] = config
+    return app
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """
+    Get a percentile of some sorted values, interpolating between the
+    nearest two.
+    """
+
+    if not values:
+        return math.nan
+    position = (len(values) - 1) * percent / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+async def run_route(
+        route: Route,
+        clients: list[TenantClient],
+        anonymous: aiohttp.ClientSession,
+        conn: asyncpg.Connection,
+        *,
+        requests: int,
+        warmup: int,
+        concurrency: int) -> dict[str, Any]:
+    """
+    Send ``requests`` requests to a route, spread evenly over the tenants
+    with at most ``concurrency`` at once, and work out the stats for them.
+    """
+
+    # Make anything the requests need
+    per_tenant = math.ceil(requests / len(clients)) + math.ceil(warmup / len(clients))
+    if route.prepare is not None:
+        for client in clients:
+            await route.prepare(client, conn, per_tenant)
+
+    latencies: list[float] = []
+    queries: list[int] = []
+    db_times: list[float] = []
+    statuses: dict[int, int] = {}
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(index: int, record: bool) -> None:
+        nonlocal errors
+        client = clients[index % len(clients)]
+        path, body = route.build(client, next(client.counter))
+        session = anonymous if route.anonymous else client.session
+        timing = None
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                async with session.request(
+                        route.method,
+                        path,
+                        json=body,
+                        allow_redirects=False) as r:
+                    await r.read()
+                    status = r.status
+                    timing = SERVER_TIMING_REGEX.search(r.headers.get("Server-Timing", ""))
+            except aiohttp.ClientError:
+                status = 0
+            elapsed = time.perf_counter() - start
+        if not record:
+            return
+        latencies.append(elapsed * 1_000)
+        statuses[status] = statuses.get(status, 0) + 1
+        if status not in route.expected:
+            errors += 1
+        if timing is not None:
+            queries.append(int(timing.group("queries")))
+            db_times.append(float(timing.group("duration")))
+
+    # Warm up, then time the real run
+    await asyncio.gather(*[send(i, False) for i in range(warmup)])
+    start = time.perf_counter()
+    await asyncio.gather(*[send(i, True) for i in range(requests)])
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "statuses": {str(i): o for i, o in sorted(statuses.items())},
+        "duration_s": round(duration, 4),
+        "throughput_rps": round(requests / duration, 2) if duration else None,
+        "latency_ms": {
+            "min": round(latencies[0], 3),
+            "mean": round(statistics.fmean(latencies), 3),
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(latencies[-1], 3),
+        },
+        "queries_per_request": {
+            "mean": round(statistics.fmean(queries), 2),
+            "max": max(queries),
+        } if queries else None,
+        "db_ms_per_request": {
+            "mean": round(statistics.fmean(db_times), 3),
+            "max": round(max(db_times), 3),
+        } if db_times else None,
+    }
+
+
+def compare_results(
+        baseline: dict[str, Any],
+        current: dict[str, Any],
+        threshold: float) -> list[str]:
+    """
+    Compare two runs, printing the change for each route they share and
+    returning the names of the routes that got worse by more than the
+    threshold (as a fraction).
+    """
+
+    regressions: list[str] = []
+    print(f"\nCompared to {baseline.get('commit') or 'baseline'} ({baseline.get('started_at')}):")
+    for name, result in current["routes"].items():
+        old = baseline.get("routes", {}).get(name)
+        if old is None:
+            continue
+        old_p95, new_p95 = old["latency_ms"]["p95"], result["latency_ms"]["p95"]
+        change = (new_p95 - old_p95) / old_p95 if old_p95 else 0.0
+        worse = change > threshold
+        line = f"  {name:<45} p95 {old_p95:>9.2f} -> {new_p95:>9.2f} ms ({change:+.0%})"
+        old_queries, new_queries = old.get("queries_per_request"), result.get("queries_per_request")
+        if old_queries and new_queries:
+            line += f"  queries {old_queries['mean']:.1f} -> {new_queries['mean']:.1f}"
+            if new_queries["mean"] > old_queries["mean"] * (1 + threshold):
+                worse = True
+        if worse:
+            regressions.append(name)
+            line += "  REGRESSION"
+        print(line)
+    return regressions
+
+
+def print_results(results: dict[str, Any]) -> None:
+    print(
+        f"{'route':<45} {'reqs':>5} {'err':>4} {'rps':>8} "
+        f"{'p50':>8} {'p95':>8} {'p99':>8} {'queries':>8}"
+    )
+    for name, result in results["routes"].items():
+        latency = result["latency_ms"]
+        queries = result["queries_per_request"]
+        print(
+            f"{name:<45} {result['requests']:>5} {result['errors']:>4} "
+            f"{result['throughput_rps'] or 0:>8.1f} {latency['p50']:>8.2f} "
+            f"{latency['p95']:>8.2f} {latency['p99']:>8.2f} "
+            f"{queries['mean'] if queries else '-':>8}"
+        )
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args: argparse.Namespace) -> int:
+    with open(args.config) as a:
+        config = toml.load(a)
+    utils.Database.config_file = args.config
+    utils.PasswordHasher.config_file = args.config
+    utils.QueryStats.config_file = args.config
+    size = TenantSize(
+        people=args.people,
+        roles=args.roles,
+        role_depth=args.role_depth,
+        periods=args.periods,
+        days=args.days,
+        venues=args.venues,
+        positions=args.positions,
+    )
+    routes = match_routes(args.route)
+    if not routes:
+        print("No routes match.", file=sys.stderr)
+        return 2
+
+    # Make the tenants
+    conn = await asyncpg.connect(**{
+        i: o
+        for i, o in config["database"].items()
+        if i in ("host", "port", "database", "user", "password",)
+    })
+    print(f"Seeding {args.tenants} tenants ({size})", file=sys.stderr)
+    tenants: list[Tenant] = await seed_tenants(conn, args.tenants, size, seed=args.seed)
+
+    # Start the website, unless we've been given one
+    runner: Optional[web.AppRunner] = None
+    base_url = args.url
+    if base_url is None:
+        logging.getLogger("aiohttp.server").setLevel(logging.CRITICAL)
+        await vbu.Database.create_pool(config["database"])
+        await utils.Database.tune_pool()
+        runner = web.AppRunner(create_app(config), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # type: ignore
+        base_url = f"http://127.0.0.1:{port}"
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    anonymous = aiohttp.ClientSession(
+        base_url,
+        connector=connector,
+        connector_owner=False,
+        cookie_jar=aiohttp.DummyCookieJar(),
+    )
+    clients = [
+        TenantClient(
+            tenant,
+            aiohttp.ClientSession(
+                base_url,
+                connector=connector,
+                connector_owner=False,
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+            ),
+            size.days,
+        )
+        for tenant in tenants
+    ]
+    results: dict[str, Any] = {
+        "commit": get_commit(),
+        "started_at": dt.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "url": args.url,
+        "tenants": args.tenants,
+        "tenant_size": size._asdict(),
+        "concurrency": args.concurrency,
+        "warmup": args.warmup,
+        "routes": {},
+    }
+    try:
+        for client in clients:
+            await client.login()
+        for route in routes:
+            print(f"Running {route.name}", file=sys.stderr)
+            results["routes"][route.name] = await run_route(
+                route, clients, anonymous, conn,
+                requests=args.requests,
+                warmup=args.warmup,
+                concurrency=args.concurrency,
+            )
+    finally:
+        for client in clients:
+            await client.session.close()
+        await anonymous.close()
+        await connector.close()
+        if runner is not None:
+            await runner.cleanup()
+        if not args.keep:
+            await remove_tenants(conn)
+        await conn.close()
+
+    # Output the results
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as a:
+            json.dump(results, a, indent=4)
+    if args.compare:
+        with open(args.compare) as a:
+            baseline = json.load(a)
+        if compare_results(baseline, results, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the website with synthetic tenants.")
+    parser.add_argument("--config", default="config/website.toml")
+    parser.add_argument("--url", help="Test a running website rather than starting one.")
+    parser.add_argument("--tenants", type=int, default=4)
+    parser.add_argument("--people", type=int, default=TenantSize().people, help="People per tenant.")
+    parser.add_argument("--roles", type=int, default=TenantSize().roles, help="Roles per tenant.")
+    parser.add_argument("--role-depth", type=int, default=TenantSize().role_depth)
+    parser.add_argument("--periods", type=int, default=TenantSize().periods, help="Availability periods (and rotas) per tenant.")
+    parser.add_argument("--days", type=int, default=TenantSize().days, help="Days per availability period.")
+    parser.add_argument("--venues", type=int, default=TenantSize().venues, help="Venues per rota.")
+    parser.add_argument("--positions", type=int, default=TenantSize().positions, help="Positions per venue.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated data.")
+    parser.add_argument("--requests", type=int, default=200, help="Timed requests per route.")
+    parser.add_argument("--warmup", type=int, default=10, help="Untimed requests per route.")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--route", action="append", default=[], help="Only run routes whose name contains this.")
+    parser.add_argument("--output", help="Write the results to this file as JSON.")
+    parser.add_argument("--compare", help="Compare against the results in this file.")
+    parser.add_argument("--threshold", type=float, default=0.2, help="How much worse (as a fraction) counts as a regression.")
+    parser.add_argument("--keep", action="store_true", help="Leave the tenants in the database afterwards.")
+    exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,375 @@
+"""
+The requests that the benchmarks make, one scenario per route.
+
+Each route is given a tenant's client and a request number (unique per
+tenant) and builds the path and JSON body to send. Routes that use up data
+(such as deletes) make what they need in ``prepare``, which isn't timed.
+Reads are listed first and deletes last so that the writes in between don't
+change the size of what's being read.
+"""
+
+from __future__ import annotations
+
+import itertools
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+import uuid
+
+import aiohttp
+import asyncpg
+
+from .seed import PASSWORD, Tenant
+
+
+__all__ = (
+    "TenantClient",
+    "Route",
+    "ROUTES",
+    "match_routes",
+)
+
+
+class TenantClient:
+    """
+    A logged in session for a tenant, along with anything the routes have
+    made for it to use.
+    """
+
+    def __init__(self, tenant: Tenant, session: aiohttp.ClientSession, days: int):
+        self.tenant = tenant
+        self.session = session
+        self.days = days
+        self.counter = itertools.count()
+        self.spare: dict[str, list[uuid.UUID]] = {}
+        self.rota_bodies: dict[uuid.UUID, Any] = {}
+        self.versions: dict[uuid.UUID, int] = {}
+
+    async def login(self) -> None:
+        async with self.session.post(
+                "/login",
+                json={"email": self.tenant.email, "password": PASSWORD}) as r:
+            if r.status != 200:
+                raise RuntimeError(f"Failed to log in as {self.tenant.email}: {await r.text()}")
+
+
+Builder = Callable[[TenantClient, int], tuple[str, Any]]
+Preparer = Callable[[TenantClient, asyncpg.Connection, int], Awaitable[None]]
+
+
+class Route(NamedTuple):
+    """
+    A single benchmarked route.
+
+    Attributes
+    -----------
+    name: str
+        The name the results are reported under.
+    method: str
+        The HTTP method.
+    build: Callable[[TenantClient, int], tuple[str, Any]]
+        Gets the path and JSON body (or None) for a request.
+    expected: tuple[int, ...]
+        The statuses that count as a success.
+    anonymous: bool
+        Whether the request is sent without the tenant's session.
+    prepare: Optional[Callable[[TenantClient, asyncpg.Connection, int], Awaitable[None]]]
+        Makes anything that the given number of requests will need.
+    """
+
+    name: str
+    method: str
+    build: Builder
+    expected: tuple[int, ...] = (200,)
+    anonymous: bool = False
+    prepare: Optional[Preparer] = None
+
+
+def _pick(items: list[Any], n: int) -> Any:
+    return items[n % len(items)]
+
+
+def _path(path: str) -> Builder:
+    return lambda client, n: (path, None)
+
+
+async def _spare_roles(client: TenantClient, conn: asyncpg.Connection, count: int) -> None:
+    rows = await conn.fetch(
+        """
+        INSERT INTO
+            roles
+            (
+                owner_id,
+                name
+            )
+        SELECT
+            $1,
+            'Spare role ' || GEN_RANDOM_UUID()
+        FROM
+            GENERATE_SERIES(1, $2)
+        RETURNING
+            id
+        """,
+        client.tenant.login_id, count,
+    )
+    client.spare["roles"] = [r["id"] for r in rows]
+
+
+async def _spare_people(client: TenantClient, conn: asyncpg.Connection, count: int) -> None:
+    rows = await conn.fetch(
+        """
+        INSERT INTO
+            people
+            (
+                owner_id,
+                name,
+                email
+            )
+        SELECT
+            $1,
+            'Spare person',
+            GEN_RANDOM_UUID() || '@spare.example.com'
+        FROM
+            GENERATE_SERIES(1, $2)
+        RETURNING
+            id
+        """,
+        client.tenant.login_id, count,
+    )
+    client.spare["people"] = [r["id"] for r in rows]
+
+
+async def _spare_venues(client: TenantClient, conn: asyncpg.Connection, count: int) -> None:
+    rows = await conn.fetch(
+        """
+        INSERT INTO
+            venues
+            (
+                owner_id,
+                rota_id,
+                name,
+                index
+            )
+        SELECT
+            $1,
+            $2,
+            'Spare venue ' || i,
+            1000 + i
+        FROM
+            GENERATE_SERIES(1, $3) i
+        RETURNING
+            id
+        """,
+        client.tenant.login_id, client.tenant.rota_ids[0], count,
+    )
+    client.spare["venues"] = [r["id"] for r in rows]
+
+
+async def _rota_bodies(client: TenantClient, conn: asyncpg.Connection, count: int) -> None:
+    for rota_id in client.tenant.rota_ids:
+        async with client.session.get(f"/api/rotas/{rota_id}") as r:
+            client.rota_bodies[rota_id] = (await r.json())["data"]
+
+
+async def _fill_versions(client: TenantClient, conn: asyncpg.Connection, count: int) -> None:
+    rows = await conn.fetch(
+        "SELECT id, version FROM filled_availability WHERE id = ANY($1::UUID[])",
+        client.tenant.filled_ids,
+    )
+    client.versions = {r["id"]: r["version"] for r in rows}
+
+
+def _take(kind: str) -> Builder:
+    def build(client: TenantClient, n: int) -> tuple[str, Any]:
+        return f"?id={client.spare[kind].pop()}", None
+    return build
+
+
+def _prefixed(prefix: str, builder: Builder) -> Builder:
+    def build(client: TenantClient, n: int) -> tuple[str, Any]:
+        path, body = builder(client, n)
+        return prefix + path, body
+    return build
+
+
+def _patch_role(client: TenantClient, n: int) -> tuple[str, Any]:
+    index = n % len(client.tenant.role_ids)
+    parent = client.tenant.role_parents[index]
+    return f"/api/roles?id={client.tenant.role_ids[index]}", {
+        "name": f"Role {index}",
+        "parent": str(parent) if parent else "",
+    }
+
+
+def _patch_person(client: TenantClient, n: int) -> tuple[str, Any]:
+    index = n % len(client.tenant.person_ids)
+    role = client.tenant.person_roles[index]
+    return f"/api/people?id={client.tenant.person_ids[index]}", {
+        "name": f"Person {index}",
+        "email": f"person-{index}@tenant-{client.tenant.index}.example.com",
+        "role": str(role) if role else None,
+    }
+
+
+def _post_fill(client: TenantClient, n: int) -> tuple[str, Any]:
+    return f"/fill/{_pick(client.tenant.filled_ids, n)}", [
+        "APU"[(n + day) % 3]
+        for day in range(client.days)
+    ]
+
+
+def _patch_fill(client: TenantClient, n: int) -> tuple[str, Any]:
+    filled_id = _pick(client.tenant.filled_ids, n)
+    return f"/fill/{filled_id}", {
+        "version": client.versions.get(filled_id, 0),
+        "changes": {str(n % client.days): "APU"[n % 3]},
+    }
+
+
+def _put_rota(client: TenantClient, n: int) -> tuple[str, Any]:
+    rota_id = _pick(client.tenant.rota_ids, n)
+    return f"/api/rotas/{rota_id}", client.rota_bodies[rota_id]
+
+
+def _post_availability(client: TenantClient, n: int) -> tuple[str, Any]:
+    return "/api/availability", {
+        "start": f"2031-01-{1 + n % 28:02d}T00:00:00Z",
+        "end": f"2031-02-{1 + n % 28:02d}T00:00:00Z",
+    }
+
+
+ROUTES: list[Route] = [
+
+    # Pages
+    Route("GET /", "GET", _path("/"), anonymous=True),
+    Route("GET /login", "GET", _path("/login"), anonymous=True),
+    Route("GET /dashboard", "GET", _path("/dashboard")),
+    Route("GET /dashboard/roles", "GET", _path("/dashboard/roles")),
+    Route("GET /dashboard/people", "GET", _path("/dashboard/people")),
+    Route("GET /dashboard/availability", "GET", _path("/dashboard/availability")),
+    Route(
+        "GET /dashboard/availability/{id}", "GET",
+        lambda client, n: (f"/dashboard/availability/{_pick(client.tenant.availability_ids, n)}", None),
+    ),
+    Route("GET /dashboard/rotas", "GET", _path("/dashboard/rotas")),
+    Route(
+        "GET /dashboard/rotas/{rota_id}", "GET",
+        lambda client, n: (f"/dashboard/rotas/{_pick(client.tenant.rota_ids, n)}", None),
+    ),
+    Route(
+        "GET /fill/{id}", "GET",
+        lambda client, n: (f"/fill/{_pick(client.tenant.filled_ids, n)}", None),
+        anonymous=True,
+    ),
+    Route("GET /logout", "GET", _path("/logout"), expected=(302,), anonymous=True),
+    Route("GET /metrics", "GET", _path("/metrics"), anonymous=True),
+
+    # API reads
+    Route("GET /api/roles", "GET", _path("/api/roles")),
+    Route("GET /api/roles?limit", "GET", _path("/api/roles?limit=100")),
+    Route("GET /api/roles/tree", "GET", _path("/api/roles/tree")),
+    Route("GET /api/people", "GET", _path("/api/people")),
+    Route("GET /api/people?limit", "GET", _path("/api/people?limit=100")),
+    Route("GET /api/availability", "GET", _path("/api/availability")),
+    Route(
+        "GET /api/user_availability", "GET",
+        lambda client, n: (f"/api/user_availability?id={_pick(client.tenant.availability_ids, n)}", None),
+    ),
+    Route(
+        "GET /api/user_availability?format=ndjson", "GET",
+        lambda client, n: (
+            f"/api/user_availability?id={_pick(client.tenant.availability_ids, n)}&format=ndjson",
+            None,
+        ),
+    ),
+    Route(
+        "GET /api/availability/{id}/grid", "GET",
+        lambda client, n: (f"/api/availability/{_pick(client.tenant.availability_ids, n)}/grid", None),
+    ),
+    Route(
+        "GET /api/availability/{id}/coverage", "GET",
+        lambda client, n: (f"/api/availability/{_pick(client.tenant.availability_ids, n)}/coverage", None),
+    ),
+    Route("GET /api/rotas", "GET", _path("/api/rotas")),
+    Route(
+        "GET /api/rotas/{rota_id}", "GET",
+        lambda client, n: (f"/api/rotas/{_pick(client.tenant.rota_ids, n)}", None),
+    ),
+    Route(
+        "GET /api/venues", "GET",
+        lambda client, n: (f"/api/venues?rota={_pick(client.tenant.rota_ids, n)}", None),
+    ),
+
+    # Logins - these are mostly password hashing
+    Route(
+        "POST /login", "POST",
+        lambda client, n: ("/login", {"email": client.tenant.email, "password": PASSWORD}),
+        anonymous=True,
+    ),
+    Route(
+        "POST /register", "POST",
+        lambda client, n: ("/register", {
+            "email": f"benchmark-register-{uuid.uuid4()}@example.com",
+            "password": PASSWORD,
+        }),
+        anonymous=True,
+    ),
+
+    # Writes
+    Route("POST /fill/{id}", "POST", _post_fill, anonymous=True),
+    Route(
+        "PATCH /fill/{id}", "PATCH", _patch_fill,
+        expected=(200, 409),  # Requests for the same row race each other
+        anonymous=True,
+        prepare=_fill_versions,
+    ),
+    Route("PATCH /api/roles", "PATCH", _patch_role, expected=(201,)),
+    Route("PATCH /api/people", "PATCH", _patch_person),
+    Route("PUT /api/rotas/{rota_id}", "PUT", _put_rota, prepare=_rota_bodies),
+    Route(
+        "POST /api/rotas/{rota_id}/solve", "POST",
+        lambda client, n: (f"/api/rotas/{_pick(client.tenant.rota_ids, n)}/solve", None),
+    ),
+    Route(
+        "POST /api/roles", "POST",
+        lambda client, n: ("/api/roles", {"name": f"Benchmark role {n}", "parent": ""}),
+        expected=(201,),
+    ),
+    Route(
+        "POST /api/people", "POST",
+        lambda client, n: ("/api/people", {
+            "name": f"Benchmark person {n}",
+            "email": f"benchmark-{n}@tenant-{client.tenant.index}.example.com",
+            "role": str(_pick(client.tenant.role_ids, n)),
+        }),
+        expected=(201,),
+    ),
+    Route("POST /api/availability", "POST", _post_availability, expected=(201,)),
+    Route(
+        "POST /api/rotas", "POST",
+        lambda client, n: ("/api/rotas", {"availability": str(_pick(client.tenant.availability_ids, n))}),
+    ),
+
+    # Deletes
+    Route("DELETE /api/roles", "DELETE", _prefixed("/api/roles", _take("roles")), prepare=_spare_roles),
+    Route("DELETE /api/people", "DELETE", _prefixed("/api/people", _take("people")), prepare=_spare_people),
+    Route("DELETE /api/venues", "DELETE", _prefixed("/api/venues", _take("venues")), prepare=_spare_venues),
+
+    # POST and PATCH /api/venues aren't here - venues are saved along with
+    # their rota through PUT /api/rotas/{rota_id}, and those two handlers
+    # don't match the current venues table.
+]
+
+
+def match_routes(patterns: list[str]) -> list[Route]:
+    """
+    Get the routes whose names contain any of the given strings, or every
+    route if none are given.
+    """
+
+    if not patterns:
+        return list(ROUTES)
+    return [
+        i
+        for i in ROUTES
+        if any(p.lower() in i.name.lower() for p in patterns)
+    ]
+
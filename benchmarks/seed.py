@@ -0,0 +1,246 @@
+"""
+Fill the database with synthetic tenants for the benchmarks to run against.
+
+Every tenant is a login with its own roles (in a hierarchy), people,
+availability periods with everyone's availability filled in, and a rota for
+each period with its venues and positions. The data for each tenant is
+generated from a fixed seed so that runs are comparable.
+"""
+
+from __future__ import annotations
+
+from datetime import datetime as dt, timedelta
+import random
+from typing import NamedTuple, Optional
+import uuid
+
+import asyncpg
+
+from website import utils
+
+
+__all__ = (
+    "TenantSize",
+    "Tenant",
+    "seed_tenants",
+    "remove_tenants",
+)
+
+
+# Benchmark logins all have emails matching this, so they can be removed
+# again without touching anything else in the database.
+EMAIL_PATTERN = "benchmark-{0}@example.com"
+EMAIL_LIKE = "benchmark-%@example.com"
+PASSWORD = "benchmark"
+
+POSITION_TIMES = [
+    ("9am", "5pm"),
+    ("10:00", "18:00"),
+    ("17:00", "23:30"),
+    ("18:00", "02:00"),
+    ("", ""),
+]
+
+
+class TenantSize(NamedTuple):
+    """
+    How much data to make for each tenant.
+    """
+
+    people: int = 50
+    roles: int = 8
+    role_depth: int = 3
+    periods: int = 4
+    days: int = 14
+    venues: int = 3
+    positions: int = 4
+
+
+class Tenant(NamedTuple):
+    """
+    The IDs of everything that was made for a tenant.
+    """
+
+    index: int
+    email: str
+    login_id: uuid.UUID
+    role_ids: list[uuid.UUID]
+    role_parents: list[Optional[uuid.UUID]]
+    person_ids: list[uuid.UUID]
+    person_roles: list[Optional[uuid.UUID]]
+    availability_ids: list[uuid.UUID]
+    filled_ids: list[uuid.UUID]
+    rota_ids: list[uuid.UUID]
+    venue_ids: list[uuid.UUID]
+
+
+async def remove_tenants(conn: asyncpg.Connection) -> None:
+    """
+    Delete every benchmark login, along with everything they own.
+    """
+
+    await conn.execute("DELETE FROM logins WHERE email LIKE $1", EMAIL_LIKE)
+    await conn.execute(
+        "DELETE FROM owner_changes WHERE NOT EXISTS (SELECT 1 FROM logins WHERE id = owner_id)",
+    )
+
+
+def _make_tenant(index: int, size: TenantSize, seed: int) -> tuple[Tenant, dict[str, list[tuple]]]:
+    """
+    Generate the rows for a single tenant, returning the tenant and the
+    records to copy into each table.
+    """
+
+    rng = random.Random(seed * 100_003 + index)
+    rows: dict[str, list[tuple]] = {
+        "roles": [],
+        "people": [],
+        "availability": [],
+        "filled_availability": [],
+        "rotas": [],
+        "venues": [],
+        "venue_positions": [],
+    }
+
+    def new_id() -> uuid.UUID:
+        return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+    login_id = new_id()
+
+    # Roles, in a binary tree no deeper than asked
+    role_ids = [new_id() for _ in range(size.roles)]
+    role_parents: list[Optional[uuid.UUID]] = []
+    depths: list[int] = []
+    for role_index, role_id in enumerate(role_ids):
+        parent_index = (role_index - 1) // 2 if role_index else None
+        if parent_index is not None and depths[parent_index] + 1 >= size.role_depth:
+            parent_index = None
+        depths.append(0 if parent_index is None else depths[parent_index] + 1)
+        role_parents.append(None if parent_index is None else role_ids[parent_index])
+        rows["roles"].append((role_id, login_id, f"Role {role_index}", role_parents[-1]))
+
+    # People
+    person_ids = [new_id() for _ in range(size.people)]
+    person_roles = [rng.choice(role_ids) if role_ids else None for _ in person_ids]
+    for person_index, person_id in enumerate(person_ids):
+        rows["people"].append((
+            person_id,
+            login_id,
+            f"Person {person_index}",
+            f"person-{person_index}@tenant-{index}.example.com",
+            person_roles[person_index],
+            rng.choice((0, 0, 20, 40)),
+        ))
+
+    # Availability periods, one after another, with everyone's filled in
+    availability_ids = [new_id() for _ in range(size.periods)]
+    filled_ids: list[uuid.UUID] = []
+    start = dt(2030, 1, 7)
+    for period_index, availability_id in enumerate(availability_ids):
+        period_start = start + timedelta(days=period_index * size.days)
+        rows["availability"].append((
+            availability_id,
+            login_id,
+            period_start,
+            period_start + timedelta(days=size.days - 1),
+        ))
+        for person_id in person_ids:
+            filled_id = new_id()
+            filled_ids.append(filled_id)
+            states = rng.choices("APU", weights=(6, 2, 2), k=size.days)
+            rows["filled_availability"].append((
+                filled_id,
+                availability_id,
+                person_id,
+                utils.pack_availability(states),
+            ))
+
+    # A rota for each period, with its venues and positions
+    rota_ids: list[uuid.UUID] = []
+    venue_ids: list[uuid.UUID] = []
+    for availability_id in availability_ids:
+        rota_id = new_id()
+        rota_ids.append(rota_id)
+        rows["rotas"].append((rota_id, login_id, availability_id))
+        for venue_index in range(size.venues):
+            venue_id = new_id()
+            venue_ids.append(venue_id)
+            rows["venues"].append((venue_id, login_id, rota_id, f"Venue {venue_index}", venue_index))
+            for position_index in range(size.positions):
+                start_time, end_time = rng.choice(POSITION_TIMES)
+                start_minute, end_minute = utils.parse_shift(start_time, end_time) or (None, None)
+                rows["venue_positions"].append((
+                    new_id(),
+                    login_id,
+                    rota_id,
+                    venue_id,
+                    rng.choice(role_ids + [None]),
+                    position_index,
+                    start_time,
+                    end_time,
+                    start_minute,
+                    end_minute,
+                    "",
+                ))
+
+    tenant = Tenant(
+        index=index,
+        email=EMAIL_PATTERN.format(index),
+        login_id=login_id,
+        role_ids=role_ids,
+        role_parents=role_parents,
+        person_ids=person_ids,
+        person_roles=person_roles,
+        availability_ids=availability_ids,
+        filled_ids=filled_ids,
+        rota_ids=rota_ids,
+        venue_ids=venue_ids,
+    )
+    return tenant, rows
+
+
+TABLE_COLUMNS: dict[str, list[str]] = {
+    "roles": ["id", "owner_id", "name", "parent_id"],
+    "people": ["id", "owner_id", "name", "email", "role_id", "maximum_working_hours"],
+    "availability": ["id", "owner_id", "start_date", "end_date"],
+    "filled_availability": ["id", "availability_id", "person_id", "availability"],
+    "rotas": ["id", "owner_id", "availability_id"],
+    "venues": ["id", "owner_id", "rota_id", "name", "index"],
+    "venue_positions": [
+        "id", "owner_id", "rota_id", "venue_id", "role_id",
+        "index", "start_time", "end_time", "start_minute", "end_minute", "notes",
+    ],
+}
+
+
+async def seed_tenants(
+        conn: asyncpg.Connection,
+        count: int,
+        size: TenantSize,
+        *,
+        seed: int = 0) -> list[Tenant]:
+    """
+    Remove any existing benchmark tenants and make ``count`` new ones of
+    the given size. Every tenant logs in with :data:`PASSWORD`.
+    """
+
+    pwhash = await utils.PasswordHasher().hash(PASSWORD)
+    tenants: list[Tenant] = []
+    async with conn.transaction():
+        await remove_tenants(conn)
+        for index in range(count):
+            tenant, rows = _make_tenant(index, size, seed)
+            tenants.append(tenant)
+            await conn.execute(
+                "INSERT INTO logins (id, email, pwhash) VALUES ($1, $2, $3)",
+                tenant.login_id, tenant.email, pwhash,
+            )
+            for table, columns in TABLE_COLUMNS.items():
+                if rows[table]:
+                    await conn.copy_records_to_table(
+                        table,
+                        records=rows[table],
+                        columns=columns,
+                    )
+    await conn.execute("ANALYZE")
+    return tenants
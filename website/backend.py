@@ -1,12 +1,13 @@
 import uuid
 
-from aiohttp.web import Request, RouteTableDef, json_response
+from aiohttp.web import Request, Response
 import aiohttp_session
-from discord.ext import vbu
 import asyncpg
 
+from . import utils
 
-routes = RouteTableDef()
+
+routes = utils.RouteTableDef()
 
 
 @routes.post("/login")
@@ -20,28 +21,62 @@ async def post_login(request: Request):
     email = data.get("email", "")
     password = data.get("password", "")
 
-    # Check if the username and password are correct
-    async with vbu.Database() as db:
+    # Get the stored hash for the email
+    async with utils.Database() as db:
         rows = await db.call(
             """
             SELECT
-                *
+                id,
+                pwhash
             FROM
                 logins
             WHERE
                 email = $1
-            AND
-                pwhash = CRYPT($2, pwhash)
-            LIMIT 1
             """,
-            email, password,
+            email,
+        )
+
+    # Check the password against it, off of the event loop
+    login_id = None
+    try:
+        if not rows:
+            await utils.PasswordHasher.verify(password, None)
+        for row in rows:
+            valid, needs_rehash = await utils.PasswordHasher.verify(password, row["pwhash"])
+            if valid:
+                login_id = row["id"]
+                break
+        if login_id is not None and needs_rehash:
+            new_pwhash = await utils.PasswordHasher.hash(password)
+            async with utils.Database() as db:
+                await db.call(
+                    """
+                    UPDATE
+                        logins
+                    SET
+                        pwhash = $3
+                    WHERE
+                        id = $1
+                    AND
+                        pwhash = $2
+                    """,
+                    login_id, row["pwhash"], new_pwhash,
+                )
+    except utils.PasswordHasherBusy:
+        return utils.json_response(
+            {
+                "success": False,
+                "error": "Too many login attempts - try again shortly.",
+            },
+            status=503,
+            headers={"Retry-After": "1"},
         )
 
     # If the username and password are correct, log the user in
-    if rows:
+    if login_id is not None:
         session = await aiohttp_session.new_session(request)
-        session["id"] = str(rows[0]["id"])
-        return json_response(
+        session["id"] = str(login_id)
+        return utils.json_response(
             {
                 "success": True,
             },
@@ -49,7 +84,7 @@ async def post_login(request: Request):
         )
 
     # Otherwise, return an error
-    return json_response(
+    return utils.json_response(
         {
             "success": False,
         },
@@ -68,8 +103,21 @@ async def post_register(request: Request):
     email = data.get("email", "")
     password = data.get("password", "")
 
-    # Check if the username and password are correct
-    async with vbu.Database() as db:
+    # Hash the password, off of the event loop
+    try:
+        pwhash = await utils.PasswordHasher.hash(password)
+    except utils.PasswordHasherBusy:
+        return utils.json_response(
+            {
+                "success": False,
+                "error": "Too many registrations - try again shortly.",
+            },
+            status=503,
+            headers={"Retry-After": "1"},
+        )
+
+    # Create the login
+    async with utils.Database() as db:
         try:
             rows = await db.call(
                 """
@@ -82,14 +130,14 @@ async def post_register(request: Request):
                 VALUES
                     (
                         $1,
-                        CRYPT($2, GEN_SALT('MD5'))
+                        $2
                     )
                 RETURNING *
                 """,
-                email, password,
+                email, pwhash,
             )
         except asyncpg.UniqueViolationError:
-            return json_response(
+            return utils.json_response(
                 {
                     "success": False,
                     "error": "Email already in use.",
@@ -100,7 +148,7 @@ async def post_register(request: Request):
     # If the username and password are correct, log the user in
     session = await aiohttp_session.new_session(request)
     session["id"] = str(rows[0]["id"])
-    return json_response(
+    return utils.json_response(
         {
             "success": True,
         },
@@ -111,14 +159,15 @@ async def post_register(request: Request):
 @routes.post("/fill/{id}")
 async def post_fill_availability(request: Request):
     """
-    Fill the availability for the given user.
+    Fill the availability for the given user. Any shifts they've been put
+    into on days they can no longer work are given to someone else.
     """
 
     # Make sure the ID is a valid UUID
     try:
         availability_id = uuid.UUID(request.match_info['id'])
     except:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Missing ID from GET params."
             },
@@ -129,42 +178,242 @@ async def post_fill_availability(request: Request):
     try:
         data = await request.json()
     except:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Failed to read JSON data."
             },
             status=400,
         )
+    try:
+        if not isinstance(data, list):
+            raise ValueError()
+        packed = utils.pack_availability(data)
+    except ValueError:
+        return utils.json_response(
+            {
+                "message": "Invalid availability data."
+            },
+            status=400,
+        )
 
     # Update data
-    async with vbu.Database() as db:
-        rows = await db.call(
-            """
-            UPDATE
-                filled_availability
-            SET
-                availability = $2
-            WHERE
-                id = $1
-            RETURNING
-                id
-            """,
-            availability_id, data,
+    async with utils.Database() as db:
+        filled = await utils.fetch_filled_availability(db, availability_id)
+        if filled is None:
+            return utils.json_response(
+                {
+                    "message": "Invalid ID."
+                },
+                status=400,
+            )
+        if len(data) != filled["days"]:
+            return utils.json_response(
+                {
+                    "message": f"Availability must have {filled['days']} days."
+                },
+                status=400,
+            )
+        async with db.transaction() as transaction:
+            rows = await transaction.call(
+                """
+                UPDATE
+                    filled_availability
+                SET
+                    availability = $2,
+                    version = version + 1
+                WHERE
+                    id = $1
+                RETURNING
+                    version
+                """,
+                availability_id, packed,
+            )
+            await utils.repair_assignments(transaction, filled, packed)  # type: ignore
+
+    # And we good - everything else can be AJAXd
+    return utils.json_response(
+        {
+            "message": "Successfully updated your availability.",
+            "data": {
+                "version": rows[0]["version"],
+            },
+        },
+        status=200,
+    )
+
+
+def _fill_conflict(filled: dict) -> Response:
+    """
+    Get the response for when someone has changed an availability that
+    was updated since they last saw it, giving them the current data.
+    """
+
+    return utils.json_response(
+        {
+            "message": "Your availability was changed somewhere else - please check it and try again.",
+            "data": {
+                "availability": utils.unpack_availability(
+                    filled["availability"],
+                    filled["days"],
+                ),
+                "version": filled["version"],
+            },
+        },
+        status=409,
+    )
+
+
+@routes.get("/fill/{id}/shifts.ics")
+async def get_fill_shifts_calendar(request: Request):
+    """
+    Get the shifts that the person with the given fill link has been put
+    into for its period as an iCalendar feed, so that they can subscribe to
+    it without logging in.
+    """
+
+    # Make sure the ID is a valid UUID
+    try:
+        availability_id = uuid.UUID(request.match_info['id'])
+    except:
+        return utils.json_response(
+            {
+                "message": "Missing ID from GET params."
+            },
+            status=400,
         )
 
+    # Get whose it is
+    async with utils.Database() as db:
+        filled = await utils.fetch_filled_availability(db, availability_id)
+        if filled is None:
+            return utils.json_response(
+                {
+                    "message": "Invalid ID."
+                },
+                status=400,
+            )
 
-    if not rows:
-        return json_response(
+        # And stream their shifts
+        return await utils.write_ics(
+            request,
+            f"{filled['person_name']} - shifts",
+            utils.stream_person_shifts(
+                db,
+                filled["person_id"],
+                availability_id=filled["availability_id"],
+            ),
+            f"shifts-{availability_id}",
+        )
+
+
+@routes.patch("/fill/{id}")
+async def patch_fill_availability(request: Request):
+    """
+    Change the availability for individual days for the given user. The
+    body should be the version of the availability the changes were made
+    against, along with a mapping of day index to new state, eg
+    ``{"version": 3, "changes": {"0": "A", "5": "U"}}``. If the
+    availability has been changed since that version then nothing is
+    updated and the current availability is returned with a 409. Any shifts
+    they've been put into on days they can no longer work are given to
+    someone else.
+    """
+
+    # Make sure the ID is a valid UUID
+    try:
+        availability_id = uuid.UUID(request.match_info['id'])
+    except:
+        return utils.json_response(
             {
-                "message": "Invalid ID."
+                "message": "Missing ID from GET params."
             },
             status=400,
         )
 
-    # And we good - everything else can be AJAXd
-    return json_response(
+    # Get the data
+    try:
+        data = await request.json()
+        version = data["version"]
+        changes = {
+            int(day): state
+            for day, state in data["changes"].items()
+        }
+        if not isinstance(version, int) or isinstance(version, bool):
+            raise ValueError()
+    except:
+        return utils.json_response(
+            {
+                "message": "Failed to read JSON data."
+            },
+            status=400,
+        )
+
+    # Make sure it exists and that they're changing the latest version
+    async with utils.Database() as db:
+        filled = await utils.fetch_filled_availability(db, availability_id)
+        if filled is None:
+            return utils.json_response(
+                {
+                    "message": "Invalid ID."
+                },
+                status=400,
+            )
+        if filled["version"] != version:
+            return _fill_conflict(filled)
+
+        # Apply their changes
+        try:
+            packed = utils.update_availability(
+                filled["availability"],
+                filled["days"],
+                changes,
+            )
+        except ValueError as e:
+            return utils.json_response(
+                {
+                    "message": str(e),
+                },
+                status=400,
+            )
+
+        # And save, as long as nobody has beaten us to it
+        async with db.transaction() as transaction:
+            rows = await transaction.call(
+                """
+                UPDATE
+                    filled_availability
+                SET
+                    availability = $2,
+                    version = version + 1
+                WHERE
+                    id = $1
+                AND
+                    version = $3
+                RETURNING
+                    version
+                """,
+                availability_id, packed, version,
+            )
+            if rows:
+                await utils.repair_assignments(transaction, filled, packed)  # type: ignore
+        if not rows:
+            filled = await utils.fetch_filled_availability(db, availability_id)
+            if filled is None:
+                return utils.json_response(
+                    {
+                        "message": "Invalid ID."
+                    },
+                    status=400,
+                )
+            return _fill_conflict(filled)
+
+    # And we good
+    return utils.json_response(
         {
-            "message": "Successfully updated your availability."
+            "message": "Successfully updated your availability.",
+            "data": {
+                "version": rows[0]["version"],
+            },
         },
         status=200,
     )
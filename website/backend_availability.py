@@ -1,90 +1,301 @@
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
 
-from aiohttp.web import Request, RouteTableDef, json_response
-import aiohttp_session
-from discord.ext import vbu
+from aiohttp.web import Request, StreamResponse
 
 from . import utils
 
 
-routes = RouteTableDef()
+routes = utils.RouteTableDef()
+
+
+# How many rows to read from the database at once, and how many bytes to
+# buffer before writing, when streaming availability
+NDJSON_BATCH_SIZE = 200
+NDJSON_FLUSH_SIZE = 64 * 1024
+
+
+AVAILABILITY_LIST = utils.ListSpec(
+    columns={
+        "id": "id",
+        "start": "start_date",
+        "end": "end_date",
+        "role": "role_id",
+    },
+    source="availability",
+    order=[("start", "TIMESTAMP"), ("id", "UUID")],
+    filters={
+        "id": utils.ListFilter("id = {}", "UUID"),
+        "from": utils.ListFilter("end_date >= {}", "TIMESTAMP"),
+        "to": utils.ListFilter("start_date <= {}", "TIMESTAMP"),
+    },
+)
 
 
 @routes.get("/api/user_availability")
 @utils.requires_login(api_response=True)
+@utils.with_etag("availability", "filled_availability", "people")
 async def api_get_user_availability(request: Request):
     """
     Return a dict of users and their related availability for the range of
     time, filling with empty strings.
-    This does not check the validity of the given ID.
+    IDs that don't belong to the logged in user give an empty list.
+
+    With ``?format=ndjson`` the people are streamed one per line instead,
+    straight from the database.
     """
 
     # Get the ID of the logged in user
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID from session."
 
     # Make sure they've given a valid ID.
     availability_id = request.query.get("id")
     if not availability_id:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Missing ID from GET params.",
             },
             status=400,
         )
     if not utils.check_valid_uuid(availability_id):
-        return json_response(
+        return utils.json_response(
             {
                 "message": "ID given is not a valid UUID.",
             },
             status=400,
         )
 
+    # Stream the people if we've been asked to
+    if request.query.get("format") == "ndjson":
+        response = StreamResponse(
+            status=200,
+            headers={
+                "Content-Type": "application/x-ndjson",
+                **utils.etag_headers(request),
+            },
+        )
+        await response.prepare(request)
+        buffer = bytearray()
+        async with utils.Database() as db:
+            async for row in utils.stream_availability(
+                    db,
+                    availability_id,
+                    login_id,
+                    prefetch=NDJSON_BATCH_SIZE):
+                buffer += utils.dumps(row)
+                buffer += b"\n"
+                if len(buffer) >= NDJSON_FLUSH_SIZE:
+                    await response.write(bytes(buffer))
+                    buffer.clear()
+        if buffer:
+            await response.write(bytes(buffer))
+        await response.write_eof()
+        return response
+
     # Get all people's availability
-    async with vbu.Database() as db:
-        person_rows = await db.call(
-            """
-            SELECT
-                id, name
-            FROM
-                people
-            WHERE
-                owner_id = $1
-            """,
+    async with utils.Database() as db:
+        matrix = await utils.AvailabilityMatrix.fetch(
+            db,
+            availability_id,
+            login_id,
+        )
+
+    # Sort out the availability and names associated
+    data = []
+    if matrix is not None:
+        for person_id in matrix.person_ids:
+            data.append({
+                "id": str(matrix.filled_ids[person_id]),
+                "person_name": matrix.person_names[person_id],
+                "person_id": str(person_id),
+                "availability": matrix.states(person_id),
+            })
+    return utils.json_response(
+        {
+            "data": data,
+        },
+        status=200,
+    )
+
+
+@routes.get("/api/availability/{id}/grid")
+@utils.requires_login(api_response=True)
+@utils.with_etag("availability", "filled_availability", "people")
+async def api_get_availability_grid(request: Request):
+    """
+    Return everything the availability view needs in one go: the dates in
+    the period, the people (ordered by name), and each person's
+    availability as a string with one character per day ("A", "P", "U", or
+    "." if they haven't filled it in).
+    """
+
+    # Get the ID of the logged in user
+    login_id = utils.get_context(request).login_id
+    assert login_id, "Missing login ID from session."
+
+    # Make sure they've given a valid ID
+    availability_id = request.match_info["id"]
+    if (r := utils.check_valid_uuid(availability_id, api_response=True)):
+        return r
+
+    # Get all people's availability
+    async with utils.Database() as db:
+        matrix = await utils.AvailabilityMatrix.fetch(
+            db,
+            availability_id,
             login_id,
         )
-        availability_rows = await db.call(
+    if matrix is None:
+        return utils.json_response(
+            {
+                "message": "Availability not found.",
+            },
+            status=404,
+        )
+
+    # And done - the rows are very repetitive, so compress them if the
+    # browser lets us
+    response = utils.json_response(
+        {
+            "data": {
+                "id": availability_id,
+                "start": matrix.start_date,
+                "end": matrix.end_date,
+                "dates": matrix.dates(),
+                "people": [
+                    {
+                        "id": person_id,
+                        "name": matrix.person_names[person_id],
+                    }
+                    for person_id in matrix.person_ids
+                ],
+                "availability": matrix.grid_rows(),
+            },
+        },
+        status=200,
+    )
+    response.enable_compression()
+    return response
+
+
+@routes.get("/api/availability/{id}/export")
+@utils.requires_login(api_response=True)
+async def api_get_availability_export(request: Request):
+    """
+    Download everyone's availability for a period as a CSV (the default) or
+    XLSX file with ``format``, with a row per person and a column per day.
+    The people are streamed straight from the database as they're read.
+    """
+
+    # Get the ID of the logged in user
+    login_id = utils.get_context(request).login_id
+    assert login_id, "Missing login ID from session."
+
+    # Make sure they've given a valid ID and format
+    availability_id = request.match_info["id"]
+    if (r := utils.check_valid_uuid(availability_id, api_response=True)):
+        return r
+    export_format = request.query.get("format", "csv")
+    if export_format not in utils.EXPORT_FORMATS:
+        return utils.json_response(
+            {
+                "message": f"Format must be one of: {', '.join(utils.EXPORT_FORMATS)}.",
+            },
+            status=400,
+        )
+
+    # Get the dates for the header before we start sending anything
+    async with utils.Database() as db:
+        period_rows = await db.call(
             """
             SELECT
-                filled_availability.id,
-                people.name AS person_name,
-                filled_availability.person_id,
-                filled_availability.availability
+                start_date,
+                end_date
             FROM
-                filled_availability
-            LEFT JOIN
-                people
-            ON
-                people.id = filled_availability.person_id
+                availability
             WHERE
-                availability_id = $1
+                id = $1
+            AND
+                owner_id = $2
             """,
+            availability_id, login_id,
+        )
+        if not period_rows:
+            return utils.json_response(
+                {
+                    "message": "Availability not found.",
+                },
+                status=404,
+            )
+        start = period_rows[0]["start_date"].date()
+        days = max((period_rows[0]["end_date"].date() - start).days + 1, 0)
+
+        # And stream everyone
+        async def rows():
+            async for row in utils.stream_availability(
+                    db,
+                    availability_id,
+                    login_id,
+                    prefetch=NDJSON_BATCH_SIZE):
+                yield [row["person_name"], *row["availability"]]
+
+        return await utils.write_export(
+            request,
+            ["Person", *(start + timedelta(days=i) for i in range(days))],
+            rows(),
+            export_format,
+            f"availability-{availability_id}",
+        )
+
+
+@routes.get("/api/availability/{id}/coverage")
+@utils.requires_login(api_response=True)
+@utils.with_etag("availability", "filled_availability", "people", "roles", "rotas", "venue_positions")
+async def api_get_availability_coverage(request: Request):
+    """
+    Return how many people can fill each role on each day of the period,
+    split by whether they're available, would prefer not to, are
+    unavailable, or haven't said, alongside how many positions the rotas
+    for the period need and how many of them can't be filled each day.
+    """
+
+    # Get the ID of the logged in user
+    login_id = utils.get_context(request).login_id
+    assert login_id, "Missing login ID from session."
+
+    # Make sure they've given a valid ID
+    availability_id = request.match_info["id"]
+    if (r := utils.check_valid_uuid(availability_id, api_response=True)):
+        return r
+
+    # Work out the coverage
+    async with utils.Database() as db:
+        tree = await utils.get_role_tree(
+            db,
+            login_id,
+            version=utils.get_versions(request)["roles"],
+        )
+        coverage = await utils.Coverage.fetch(
+            db,
             availability_id,
+            login_id,
+            tree,
+        )
+    if coverage is None:
+        return utils.json_response(
+            {
+                "message": "Availability not found.",
+            },
+            status=404,
         )
 
-    # Sort out the availability and names associated
-    data = []
-    for r in availability_rows:
-        data.append({
-            "id": str(r['id']),
-            "person_name": r['person_name'],
-            "person_id": str(r['person_id']),
-            "availability": r['availability'],
-        })
-    return json_response(
+    # And done
+    return utils.json_response(
         {
-            "data": data,
+            "data": {
+                "id": availability_id,
+                **coverage.to_json(),
+            },
         },
         status=200,
     )
@@ -92,54 +303,44 @@ async def api_get_user_availability(request: Request):
 
 @routes.get("/api/availability")
 @utils.requires_login(api_response=True)
+@utils.with_etag("availability")
 async def api_get_availbility(request: Request):
     """
-    Return a list of availability objects for the user
+    Return a list of availability objects for the user, ordered by start
+    date.
+
+    Takes ``limit`` and ``after`` to get a page at a time, ``id`` to get a
+    single period, ``from`` and ``to`` to get the periods overlapping a
+    date range, and ``fields`` to pick the columns.
     """
 
     # Get the ID of the logged in user
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID from session."
 
-    # Add the new role to the database
-    args = [login_id]
-    where = ""
-    if request.query.get("id"):
-        where = "AND id = $2"
-        args.append(request.query['id'])
-        if not utils.check_valid_uuid(request.query['id']):
-            return json_response(
-                {
-                    "message": "ID given is not a valid UUID.",
-                },
-                status=400,
+    # Get the page of availability
+    try:
+        list_query = AVAILABILITY_LIST.parse(request.query)
+        async with utils.Database() as db:
+            rows, cursor = await AVAILABILITY_LIST.fetch(
+                db,
+                list_query,
+                where="owner_id = $1",
+                args=[login_id],
             )
-    async with vbu.Database() as db:
-        rows = await db.call(
-            """
-            SELECT
-                id, start_date, end_date
-            FROM
-                availability
-            WHERE
-                owner_id = $1
-            {0}
-            """.format(where),
-            *args,
+    except utils.InvalidListQuery as e:
+        return utils.json_response(
+            {
+                "message": str(e),
+            },
+            status=400,
         )
 
     # And done
-    ret = []
-    for r in rows:
-        ret.append({
-            "id": str(r['id']),
-            "start": r['start_date'].isoformat(),
-            "end": r['end_date'].isoformat(),
-        })
-    return json_response(
+    return utils.json_response(
         {
-            "data": ret,
+            "data": rows,
+            "next": cursor,
         },
         status=200,
     )
@@ -149,14 +350,16 @@ async def api_get_availbility(request: Request):
 @utils.requires_login(api_response=True)
 async def api_post_create_availability(request: Request):
     """
-    Add a new availability date set.
+    Add a new availability date set, along with a filled availability row
+    for each of the user's people (or, if a role is given, each person who
+    can fill that role). The new rows are returned with their fill links.
     """
 
     # Validate the new role
     try:
         data = await request.json()
     except:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Failed to read JSON in request.",
             },
@@ -164,7 +367,7 @@ async def api_post_create_availability(request: Request):
         )
     required_keys = {"start", "end",}
     if len(required_keys.intersection(set(data.keys()))) != len(required_keys):
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Invalid request - missing keys.",
             },
@@ -172,41 +375,76 @@ async def api_post_create_availability(request: Request):
         )
 
     # Get the ID of the logged in user
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID from session."
 
-    # Add the new role to the database
-    async with vbu.Database() as db:
-        added_rows = await db.call(
-            """
-            INSERT INTO
-                availability
-                (
-                    owner_id,
-                    start_date,
-                    end_date
-                )
-            VALUES
-                (
-                    $1,
-                    $2,
-                    $3
+    async with utils.Database() as db:
+
+        # Work out who can fill the role, if one was given
+        role_id = data.get("role") or None
+        role_ids = None
+        if role_id:
+            tree = await utils.get_role_tree(db, login_id)
+            if not utils.check_valid_uuid(role_id) or role_id not in tree:
+                return utils.json_response(
+                    {
+                        "message": "Role does not exist.",
+                    },
+                    status=400,
                 )
-            RETURNING
-                id, start_date, end_date
-            """,
-            login_id,
-            dt.fromisoformat(data['start'].replace("Z", "")),
-            dt.fromisoformat(data['end'].replace("Z", "")),
-        )
+            role_ids = tree.descendants(role_id)
+
+        # Add the new availability and everyone's rows for it to the database
+        async with db.transaction() as transaction:
+            added_rows = await transaction.call(
+                """
+                INSERT INTO
+                    availability
+                    (
+                        owner_id,
+                        start_date,
+                        end_date,
+                        role_id
+                    )
+                VALUES
+                    (
+                        $1,
+                        $2,
+                        $3,
+                        $4
+                    )
+                RETURNING
+                    id, start_date, end_date, role_id
+                """,
+                login_id,
+                dt.fromisoformat(data['start'].replace("Z", "")),
+                dt.fromisoformat(data['end'].replace("Z", "")),
+                role_id,
+            )
+            fill_rows = await utils.create_fill_rows(
+                transaction,
+                login_id,
+                added_rows[0]["id"],
+                role_ids,
+            )
 
     # And done
+    base_url = request.app['config'].get('website_base_url', '').rstrip('/')
     added_row = dict(added_rows[0])
-    added_row["id"] = str(added_row.pop("id"))
-    added_row["start"] = added_row.pop("start_date").isoformat()
-    added_row["end"] = added_row.pop("end_date").isoformat()
-    return json_response(
+    added_row["start"] = added_row.pop("start_date")
+    added_row["end"] = added_row.pop("end_date")
+    added_row["role"] = added_row.pop("role_id")
+    added_row["fills"] = [
+        {
+            "id": r["id"],
+            "person_id": r["person_id"],
+            "person_name": r["person_name"],
+            "person_email": r["person_email"],
+            "link": f"{base_url}/fill/{r['id']}",
+        }
+        for r in fill_rows
+    ]
+    return utils.json_response(
         {
             "data": added_row,
         },
@@ -0,0 +1,23 @@
+from aiohttp.web import Request, Response
+
+from . import utils
+
+
+routes = utils.RouteTableDef()
+
+
+@routes.get("/metrics")
+async def get_metrics(request: Request):
+    """
+    Get the metrics for this process in the Prometheus text format. These
+    can only be read from this machine, or with the token from the config.
+    """
+
+    if not utils.Metrics.is_allowed(request):
+        return Response(status=403, text="Forbidden")
+    return Response(
+        body=utils.Metrics.render(request.app).encode(),
+        headers={
+            "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+        },
+    )
@@ -1,55 +1,194 @@
-from aiohttp.web import Request, RouteTableDef, json_response
-import aiohttp_session
+from typing import Any
+
+from aiohttp.web import Request
 import asyncpg
-from discord.ext import vbu
 
 from . import utils
 
 
-routes = RouteTableDef()
+routes = utils.RouteTableDef()
+
+
+def check_maximum_working_hours(value: Any):
+    """
+    Returns a json response if the given maximum working hours isn't a
+    whole number of hours that fits in the database, or None.
+    """
+
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= 32_767:
+        return utils.json_response(
+            {
+                "message": "Maximum working hours must be a whole number of hours (or 0 for no maximum).",
+            },
+            status=400,
+        )
+    return None
+
+
+PEOPLE_LIST = utils.ListSpec(
+    columns={
+        "id": "id",
+        "name": "name",
+        "email": "email",
+        "role": "role_id",
+        "maximum_working_hours": "maximum_working_hours",
+    },
+    source="people",
+    order=[("name", "CITEXT"), ("id", "UUID")],
+    filters={
+        "role": utils.ListFilter("role_id = {}", "UUID"),
+        "name": utils.ListFilter("name ILIKE {}", prefix=True),
+    },
+    nullable=("name",),
+)
 
 
 @routes.get("/api/people")
 @utils.requires_login(api_response=True)
+@utils.with_etag("people")
 async def api_get_people(request: Request):
     """
-    Return a list of people for the user
+    Return a list of people for the user, ordered by name.
+
+    Takes ``limit`` and ``after`` to get a page at a time, ``role`` and
+    ``name`` (a prefix) to filter, and ``fields`` to pick the columns.
     """
 
     # Get the ID of the logged in user
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID from session."
 
-    # Add the new role to the database
-    async with vbu.Database() as db:
+    # Get the page of people, from the cache if we can
+    try:
+        list_query = PEOPLE_LIST.parse(request.query)
+
+        async def fetch():
+            async with utils.Database() as db:
+                return await PEOPLE_LIST.fetch(
+                    db,
+                    list_query,
+                    where="owner_id = $1",
+                    args=[login_id],
+                )
+
+        rows, cursor = await utils.PEOPLE_CACHE.get(
+            login_id,
+            ("list", utils.get_versions(request)["people"], list_query.cache_key()),
+            fetch,
+        )
+    except utils.InvalidListQuery as e:
+        return utils.json_response(
+            {
+                "message": str(e),
+            },
+            status=400,
+        )
+
+    # And done
+    return utils.json_response(
+        {
+            "data": rows,
+            "next": cursor,
+        },
+        status=200,
+    )
+
+
+@routes.get("/api/people/hours")
+@utils.requires_login(api_response=True)
+@utils.with_etag("people", "assignments")
+async def api_get_people_hours(request: Request):
+    """
+    Return how long each of the user's people has been put to work for in
+    each availability period, across every rota for it, along with their
+    maximum. Takes ``availability`` and ``person`` IDs to filter.
+    """
+
+    # Get the ID of the logged in user
+    login_id = utils.get_context(request).login_id
+    assert login_id, "Missing login ID from session."
+
+    # Validate the filters
+    availability_id = request.query.get("availability") or None
+    person_id = request.query.get("person") or None
+    for i in (availability_id, person_id):
+        if i and (r := utils.check_valid_uuid(i, api_response=True)):
+            return r
+
+    # Read them from the ledger
+    async with utils.Database() as db:
+        rows = await utils.fetch_person_hours(
+            db,
+            login_id,
+            availability_id=availability_id,
+            person_id=person_id,
+        )
+
+    # And done
+    return utils.json_response(
+        {
+            "data": rows,
+        },
+        status=200,
+    )
+
+
+@routes.get("/api/people/{person_id}/shifts.ics")
+@utils.requires_login(api_response=True)
+async def api_get_person_shifts_calendar(request: Request):
+    """
+    Download every shift a person has been put into as an iCalendar feed,
+    or just those in one period with ``availability``.
+    """
+
+    # Get the ID of the logged in user
+    login_id = utils.get_context(request).login_id
+    assert login_id, "Missing login ID from session."
+
+    # Validate the IDs
+    person_id = request.match_info["person_id"]
+    availability_id = request.query.get("availability") or None
+    for i in (person_id, availability_id):
+        if i and (r := utils.check_valid_uuid(i, api_response=True)):
+            return r
+
+    # Make sure it's their person
+    async with utils.Database() as db:
         rows = await db.call(
             """
             SELECT
-                id, name, email, role_id
+                name
             FROM
                 people
             WHERE
                 owner_id = $1
+            AND
+                id = $2
             """,
-            login_id,
+            login_id, person_id,
         )
+        if not rows:
+            return utils.json_response(
+                {
+                    "message": "User not found.",
+                },
+                status=404,
+            )
 
-    # And done
-    ret = []
-    for r in rows:
-        ret.append({
-            "id": str(r['id']),
-            "name": r['name'],
-            "email": r['email'],
-            "role": str(r['role_id']) if r['role_id'] else None,
-        })
-    return json_response(
-        {
-            "data": ret,
-        },
-        status=200,
-    )
+        # And stream their shifts
+        return await utils.write_ics(
+            request,
+            f"{rows[0]['name']} - shifts",
+            utils.stream_person_shifts(
+                db,
+                person_id,
+                owner_id=login_id,
+                availability_id=availability_id,
+            ),
+            f"shifts-{person_id}",
+        )
 
 
 @routes.patch("/api/people")
@@ -63,7 +202,7 @@ async def api_patch_person(request: Request):
     query = request.query
     required_keys = {"id",}
     if len(required_keys.intersection(set(query.keys()))) != len(required_keys):
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Invalid request - missing ID key.",
             },
@@ -72,7 +211,7 @@ async def api_patch_person(request: Request):
     try:
         data = await request.json()
     except:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Failed to read JSON in request.",
             },
@@ -80,20 +219,23 @@ async def api_patch_person(request: Request):
         )
     required_keys = {"name", "email", "role",}
     if len(required_keys.intersection(set(data.keys()))) != len(required_keys):
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Invalid request - missing keys.",
             },
             status=400,
         )
 
+    maximum_working_hours = data.get("maximum_working_hours")
+    if (r := check_maximum_working_hours(maximum_working_hours)):
+        return r
+
     # Get the ID of the logged in user
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID from session."
 
     # Add the new role to the database
-    async with vbu.Database() as db:
+    async with utils.Database() as db:
         rows = await db.call(
             """
             UPDATE
@@ -101,7 +243,8 @@ async def api_patch_person(request: Request):
             SET
                 name = $3,
                 email = $4,
-                role_id = $5
+                role_id = $5,
+                maximum_working_hours = COALESCE($6, maximum_working_hours)
             WHERE
                 owner_id = $1
             AND
@@ -109,24 +252,26 @@ async def api_patch_person(request: Request):
             RETURNING *
             """,
             login_id, query['id'], data['name'],
-            data['email'], data['role'],
+            data['email'], data['role'], maximum_working_hours,
         )
+    utils.PEOPLE_CACHE.invalidate(login_id)
 
     # And done
     if not rows:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "User not found.",
             },
             status=404,
         )
-    return json_response(
+    return utils.json_response(
         {
             "data": {
                 "id": str(rows[0]['id']),
                 "name": rows[0]['name'],
                 "email": rows[0]['email'],
                 "role": str(rows[0]['role_id']) if rows[0]['role_id'] else None,
+                "maximum_working_hours": rows[0]['maximum_working_hours'],
             }
         },
         status=200,
@@ -144,7 +289,7 @@ async def api_delete_person(request: Request):
     data = request.query
     required_keys = {"id",}
     if len(required_keys.intersection(set(data.keys()))) != len(required_keys):
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Invalid request - missing ID key.",
             },
@@ -152,12 +297,11 @@ async def api_delete_person(request: Request):
         )
 
     # Get the ID of the logged in user
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID from session."
 
     # Add the new role to the database
-    async with vbu.Database() as db:
+    async with utils.Database() as db:
         rows = await db.call(
             """
             DELETE FROM
@@ -170,16 +314,17 @@ async def api_delete_person(request: Request):
             """,
             login_id, data['id'],
         )
+    utils.PEOPLE_CACHE.invalidate(login_id)
 
     # And done
     if not rows:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "User not found.",
             },
             status=404,
         )
-    return json_response(
+    return utils.json_response(
         {
             "message": "",
         },
@@ -191,14 +336,15 @@ async def api_delete_person(request: Request):
 @utils.requires_login(api_response=True)
 async def api_post_create_person(request: Request):
     """
-    Add a new role into the user's list of roles.
+    Add a new person into the user's list of people, giving them a filled
+    availability row for every period that hasn't ended yet.
     """
 
     # Validate the new role
     try:
         data = await request.json()
     except:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Failed to read JSON in request.",
             },
@@ -206,56 +352,93 @@ async def api_post_create_person(request: Request):
         )
     required_keys = {"name", "email", "role",}
     if len(required_keys.intersection(set(data.keys()))) != len(required_keys):
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Invalid request - missing keys.",
             },
             status=400,
         )
 
+    maximum_working_hours = data.get("maximum_working_hours") or 0
+    if (r := check_maximum_working_hours(maximum_working_hours)):
+        return r
+
     # Get the ID of the logged in user
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID from session."
 
-    # Add the new role to the database
-    async with vbu.Database() as db:
-        try:
-            added_rows = await db.call(
-                """
-                INSERT INTO
-                    people
-                    (
-                        owner_id,
-                        name,
-                        email,
-                        role_id
-                    )
-                VALUES
-                    (
-                        $1,
-                        $2,
-                        $3,
-                        $4
-                    )
-                RETURNING
-                    id, name, email, role_id
-                """,
-                login_id, data['name'], data['email'], data['role'],
+    # Add the new person to the database
+    role_id = data['role'] or None
+    if role_id and not utils.check_valid_uuid(role_id):
+        return utils.json_response(
+            {
+                "message": "Role ID is not a valid UUID.",
+            },
+            status=400,
+        )
+    async with utils.Database() as db:
+        tree = await utils.get_role_tree(db, login_id)
+        if role_id and role_id not in tree:
+            return utils.json_response(
+                {
+                    "message": "Role does not exist.",
+                },
+                status=400,
             )
+        try:
+            async with db.transaction() as transaction:
+                added_rows = await transaction.call(
+                    """
+                    INSERT INTO
+                        people
+                        (
+                            owner_id,
+                            name,
+                            email,
+                            role_id,
+                            maximum_working_hours
+                        )
+                    VALUES
+                        (
+                            $1,
+                            $2,
+                            $3,
+                            $4,
+                            $5
+                        )
+                    RETURNING
+                        id, name, email, role_id, maximum_working_hours
+                    """,
+                    login_id, data['name'], data['email'], role_id, maximum_working_hours,
+                )
+                fill_rows = await utils.add_person_to_open_periods(
+                    transaction,
+                    login_id,
+                    added_rows[0]["id"],
+                    tree.ancestors.get(added_rows[0]["role_id"], {}).keys(),
+                )
         except asyncpg.UniqueViolationError:
-            return json_response(
+            return utils.json_response(
                 {
                     "message": "Cannot add duplicate email."
                 },
                 status=400,
             )
+    utils.PEOPLE_CACHE.invalidate(login_id)
 
     # And done
+    base_url = request.app['config'].get('website_base_url', '').rstrip('/')
     added_row = dict(added_rows[0])
-    added_row["id"] = str(added_row.pop("id"))
-    added_row["role"] = str(added_row.pop("role_id"))
-    return json_response(
+    added_row["role"] = added_row.pop("role_id")
+    added_row["fills"] = [
+        {
+            "id": r["id"],
+            "availability_id": r["availability_id"],
+            "link": f"{base_url}/fill/{r['id']}",
+        }
+        for r in fill_rows
+    ]
+    return utils.json_response(
         {
             "data": added_row,
         },
@@ -1,51 +1,103 @@
-from aiohttp.web import Request, RouteTableDef, json_response
-import aiohttp_session
+from aiohttp.web import Request
 import asyncpg
-from discord.ext import vbu
 
 from . import utils
 
 
-routes = RouteTableDef()
+routes = utils.RouteTableDef()
+
+
+ROLES_LIST = utils.ListSpec(
+    columns={
+        "id": "id",
+        "name": "name",
+        "parent": "parent_id",
+    },
+    source="roles",
+    order=[("name", "CITEXT"), ("id", "UUID")],
+    filters={
+        "parent": utils.ListFilter("parent_id = {}", "UUID"),
+        "name": utils.ListFilter("name ILIKE {}", prefix=True),
+    },
+)
 
 
 @routes.get("/api/roles")
 @utils.requires_login(api_response=True)
+@utils.with_etag("roles")
 async def api_get_roles(request: Request):
     """
-    Return a list of roles for the user
+    Return a list of roles for the user, ordered by name.
+
+    Takes ``limit`` and ``after`` to get a page at a time, ``parent`` and
+    ``name`` (a prefix) to filter, and ``fields`` to pick the columns.
     """
 
     # Get the ID of the logged in user
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID from session."
 
-    # Add the new role to the database
-    async with vbu.Database() as db:
-        rows = await db.call(
-            """
-            SELECT
-                id, name, parent_id
-            FROM
-                roles
-            WHERE
-                owner_id = $1
-            """,
+    # Get the page of roles, from the cache if we can
+    try:
+        list_query = ROLES_LIST.parse(request.query)
+
+        async def fetch():
+            async with utils.Database() as db:
+                return await ROLES_LIST.fetch(
+                    db,
+                    list_query,
+                    where="owner_id = $1",
+                    args=[login_id],
+                )
+
+        rows, cursor = await utils.ROLES_CACHE.get(
+            login_id,
+            ("list", utils.get_versions(request)["roles"], list_query.cache_key()),
+            fetch,
+        )
+    except utils.InvalidListQuery as e:
+        return utils.json_response(
+            {
+                "message": str(e),
+            },
+            status=400,
+        )
+
+    # And done
+    return utils.json_response(
+        {
+            "data": rows,
+            "next": cursor,
+        },
+        status=200,
+    )
+
+
+@routes.get("/api/roles/tree")
+@utils.requires_login(api_response=True)
+@utils.with_etag("roles")
+async def api_get_role_tree(request: Request):
+    """
+    Return the user's roles as a tree, with each role's children nested
+    inside of it.
+    """
+
+    # Get the ID of the logged in user
+    login_id = utils.get_context(request).login_id
+    assert login_id, "Missing login ID from session."
+
+    # Get the tree
+    async with utils.Database() as db:
+        tree = await utils.get_role_tree(
+            db,
             login_id,
+            version=utils.get_versions(request)["roles"],
         )
 
     # And done
-    ret = []
-    for r in rows:
-        ret.append({
-            "id": str(r['id']),
-            "name": r['name'],
-            "parent": str(r['parent_id']) if r['parent_id'] else None,
-        })
-    return json_response(
+    return utils.json_response(
         {
-            "data": ret,
+            "data": tree.to_json(),
         },
         status=200,
     )
@@ -62,7 +114,7 @@ async def api_delete_role(request: Request):
     data = request.query
     required_keys = {"id",}
     if len(required_keys.intersection(set(data.keys()))) != len(required_keys):
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Invalid request - missing ID key.",
             },
@@ -70,12 +122,11 @@ async def api_delete_role(request: Request):
         )
 
     # Get the ID of the logged in user
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID from session."
 
     # Add the new role to the database
-    async with vbu.Database() as db:
+    async with utils.Database() as db:
         rows = await db.call(
             """
             DELETE FROM
@@ -88,16 +139,18 @@ async def api_delete_role(request: Request):
             """,
             login_id, data['id'],
         )
+    utils.invalidate_role_tree(login_id)
+    utils.PEOPLE_CACHE.invalidate(login_id)  # Their people lose the role
 
     # And done
     if not rows:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Role not found.",
             },
             status=404,
         )
-    return json_response(
+    return utils.json_response(
         {
             "message": "",
         },
@@ -116,7 +169,7 @@ async def api_post_create_role(request: Request):
     try:
         data = await request.json()
     except:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Failed to read JSON in request.",
             },
@@ -124,7 +177,7 @@ async def api_post_create_role(request: Request):
         )
     required_keys = {"name", "parent",}
     if len(required_keys.intersection(set(data.keys()))) != len(required_keys):
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Invalid request - missing keys.",
             },
@@ -132,12 +185,20 @@ async def api_post_create_role(request: Request):
         )
 
     # Get the ID of the logged in user
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID from session."
 
     # Add the new role to the database
-    async with vbu.Database() as db:
+    async with utils.Database() as db:
+        if data['parent']:
+            tree = await utils.get_role_tree(db, login_id)
+            if not utils.check_valid_uuid(data['parent']) or data['parent'] not in tree:
+                return utils.json_response(
+                    {
+                        "message": "Parent role does not exist.",
+                    },
+                    status=400,
+                )
         try:
             added_rows = await db.call(
                 """
@@ -160,12 +221,23 @@ async def api_post_create_role(request: Request):
                 login_id, data['name'], data['parent'] or None,
             )
         except asyncpg.UniqueViolationError:
-            return json_response(
+            return utils.json_response(
                 {
                     "message": "Cannot add duplicate name."
                 },
                 status=400,
             )
+        except asyncpg.ForeignKeyViolationError:
+
+            # The cached tree was out of date and the parent has gone
+            utils.invalidate_role_tree(login_id)
+            return utils.json_response(
+                {
+                    "message": "Parent role does not exist.",
+                },
+                status=400,
+            )
+    utils.invalidate_role_tree(login_id)
 
     # And done
     added_row = dict(added_rows[0])
@@ -175,7 +247,7 @@ async def api_post_create_role(request: Request):
         if added_row.get("parent_id")
         else None
     )
-    return json_response(
+    return utils.json_response(
         {
             "data": added_row,
         },
@@ -193,7 +265,7 @@ async def api_patch_role(request: Request):
     # Validate the new role
     role_id = request.query.get("id", "")
     if not utils.check_valid_uuid(role_id):
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Missing valid role ID from query params.",
             },
@@ -202,7 +274,7 @@ async def api_patch_role(request: Request):
     try:
         data = await request.json()
     except:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Failed to read JSON in request.",
             },
@@ -210,7 +282,7 @@ async def api_patch_role(request: Request):
         )
     required_keys = {"name", "parent",}
     if len(required_keys.intersection(set(data.keys()))) != len(required_keys):
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Invalid request - missing keys.",
             },
@@ -218,13 +290,31 @@ async def api_patch_role(request: Request):
         )
 
     # Get the ID of the logged in user
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID from session."
 
-    # Add the new role to the database
-    async with vbu.Database() as db:
-        added_rows = await db.call(
+    # Make sure the new parent is one of the user's roles and that it isn't
+    # the role itself or one of its children
+    async with utils.Database() as db, db.transaction() as transaction:
+        tree = await utils.RoleTree.fetch(transaction, login_id, lock=True)
+        if data['parent']:
+            if not utils.check_valid_uuid(data['parent']) or data['parent'] not in tree:
+                return utils.json_response(
+                    {
+                        "message": "Parent role does not exist.",
+                    },
+                    status=400,
+                )
+            if tree.would_cycle(role_id, data['parent']):
+                return utils.json_response(
+                    {
+                        "message": "A role cannot be placed under itself or one of its children.",
+                    },
+                    status=400,
+                )
+
+        # Update the role
+        added_rows = await transaction.call(
             """
             UPDATE
                 roles
@@ -240,8 +330,9 @@ async def api_patch_role(request: Request):
             """,
             login_id, role_id, data['name'], data['parent'] or None,
         )
+    utils.invalidate_role_tree(login_id)
     if not added_rows:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Role does not exist."
             },
@@ -256,7 +347,7 @@ async def api_patch_role(request: Request):
         if added_row.get("parent_id")
         else None
     )
-    return json_response(
+    return utils.json_response(
         {
             "data": added_row,
         },
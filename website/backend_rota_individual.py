@@ -1,25 +1,30 @@
+import asyncio
+from datetime import date, timedelta
+import functools
 from typing import Any
 
-from aiohttp.web import Request, RouteTableDef, json_response, Response
-import aiohttp_session
-from discord.ext import vbu
+from aiohttp.web import Request, Response
 
 from . import utils
 
 
-routes = RouteTableDef()
+routes = utils.RouteTableDef()
+
+
+# The columns of a rota export, in the order utils.stream_rota_rows gives them
+ROTA_EXPORT_HEADER = ["Date", "Venue", "Role", "Start", "End", "Hours", "Person", "Email", "Notes"]
 
 
 @routes.get("/api/rotas/{rota_id}")
 @utils.requires_login(api_response=True)
+@utils.with_etag("rotas", "venues", "venue_positions")
 async def api_get_rota_venues(request: Request):
     """
     Get the venues for a given rota.
     """
 
     # Get the user's ID
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID"
 
     # Get and validate the rota ID from the url
@@ -27,87 +32,166 @@ async def api_get_rota_venues(request: Request):
     if (r := utils.check_valid_uuid(rota_id, api_response=True)):
         return r
 
-    # Sort out our returnable data
-    data = []
+    # Get the venues and their positions
+    async with utils.Database() as db:
+        data = await utils.fetch_rota_venues(db, login_id, rota_id)
 
-    # Open the database so we can get applicable data
-    async with vbu.Database() as db:
+    # Return the venues
+    return utils.json_response(
+        {
+            "data": utils.encode_row_as_json(data),
+        },
+        status=200,
+    )
 
-        # Get the venues from the user
-        venues = await db.call(
-            """
-            SELECT
-                id, name, index
-            FROM
-                venues
-            WHERE
-                owner_id = $1
-            AND
-                rota_id = $2
-            ORDER BY
-                index ASC,
-                name ASC
-            """,
-            login_id, rota_id,
-        )
 
-        # Get positions for the venue
-        serialized_venue_permissions = []
-        for venue in venues:
+@routes.put("/api/rotas/{rota_id}")
+@utils.requires_login(api_response=True)
+async def api_put_rota_venues(request: Request):
+    """
+    Save the venues for a given rota. Venues and positions that are sent
+    with their ID are updated in place rather than being recreated.
 
-            # Get the positions for the venue
-            positions = await db.call(
-                """
-                SELECT
-                    id, role_id, index, start_time,
-                    end_time, notes
-                FROM
-                    venue_positions
-                WHERE
-                    venue_id = $1
-                ORDER BY
-                    index ASC
-                """,
-                venue["id"],
+    Changing a position's times changes the hours of everyone assigned to
+    it, so anyone who's now over their maximum working hours for the period
+    is sent back as a warning.
+    """
+
+    # Get the user's ID
+    login_id = utils.get_context(request).login_id
+    assert login_id, "Missing login ID"
+
+    # Get and validate the rota ID from the url
+    rota_id: str = request.match_info["rota_id"]
+    if (r := utils.check_valid_uuid(rota_id, api_response=True)):
+        return r
+
+    # Get the data from the request
+    data: Response | list[dict[str, Any]]
+    success, data = await utils.try_read_json(request)
+    if not success:
+        return data
+    if not isinstance(data, list):
+        return utils.json_response(
+            {
+                "message": "Invalid data type.",
+            },
+            status=400,
+        )
+
+    # Validate the venues and positions
+    for venue in data:
+        if not isinstance(venue, dict):
+            return utils.json_response(
+                {
+                    "message": "Invalid data type.",
+                },
+                status=400,
+            )
+        if (r := utils.ensure_required_keys(venue, {"name", "positions"}, location="venue")):
+            return r
+        if not isinstance(venue["positions"], list):
+            return utils.json_response(
+                {
+                    "message": "Invalid data type.",
+                },
+                status=400,
             )
+        for position in venue["positions"]:
+            if not isinstance(position, dict):
+                return utils.json_response(
+                    {
+                        "message": "Invalid data type.",
+                    },
+                    status=400,
+                )
+            if (r := utils.ensure_required_keys(position, {"role", "start", "end", "notes"}, location="position")):
+                return r
 
-            # Add the venue to the data
-            for position in positions:
-                serialized_venue_permissions.append({
-                    'id': position['id'],
-                    'role': position['role_id'] or None,
-                    'index': position['index'],
-                    'start': position['start_time'],
-                    'end': position['end_time'],
-                    'notes': position['notes'],
-                })
-
-        data.append({
-            'id': venues[0]['id'],
-            'name': venues[0]['name'],
-            'index': venues[0]['index'],
-            'positions': serialized_venue_permissions,
-        })
+    # Save only what's changed
+    async with utils.Database() as db:
+        counts = await utils.save_rota_venues(db, login_id, rota_id, data)
+        if counts is None:
+            return utils.json_response(
+                {
+                    "message": "Rota not found.",
+                },
+                status=404,
+            )
+        venues = await utils.fetch_rota_venues(db, login_id, rota_id)
+        warnings = await utils.fetch_hour_warnings(db, login_id, rota_id)
+    if any(counts.values()):
+        utils.VENUES_CACHE.invalidate(login_id)
 
     # Return the venues
-    return json_response(
+    return utils.json_response(
         {
-            "data": utils.encode_row_as_json(data),
+            "message": "Successfully updated venues.",
+            "data": utils.encode_row_as_json(venues),
+            "changes": counts,
+            "warnings": warnings,
         },
         status=200,
     )
 
 
-@routes.put("/api/rotas/{rota_id}")
+@routes.get("/api/rotas/{rota_id}/assignments")
 @utils.requires_login(api_response=True)
-async def api_put_rota_venues(request: Request):
+@utils.with_etag("rotas", "assignments")
+async def api_get_rota_assignments(request: Request):
     """
-    Get the venues for a given rota.
+    Get who's been put into each position on each day of a rota. Takes
+    ``start`` and ``end`` dates to get only some of the days.
     """
 
     # Get the user's ID
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
+    assert login_id, "Missing login ID"
+
+    # Get and validate the rota ID from the url
+    rota_id: str = request.match_info["rota_id"]
+    if (r := utils.check_valid_uuid(rota_id, api_response=True)):
+        return r
+
+    # Validate the dates
+    try:
+        start = date.fromisoformat(request.query["start"]) if request.query.get("start") else None
+        end = date.fromisoformat(request.query["end"]) if request.query.get("end") else None
+    except ValueError:
+        return utils.json_response(
+            {
+                "message": "Invalid date.",
+            },
+            status=400,
+        )
+
+    # Get the assignments
+    async with utils.Database() as db:
+        data = await utils.fetch_assignments(db, login_id, rota_id, start=start, end=end)
+
+    # And done
+    return utils.json_response(
+        {
+            "data": data,
+        },
+        status=200,
+    )
+
+
+@routes.put("/api/rotas/{rota_id}/assignments")
+@utils.requires_login(api_response=True)
+async def api_put_rota_assignments(request: Request):
+    """
+    Change who's been put into positions in a rota, as a list of
+    ``{"position", "date", "person"}``, with a null person to clear the
+    position on that day. Anything not given is left as it is.
+
+    Anyone who's now in overlapping shifts is sent back as a conflict, and
+    anyone over their maximum working hours for the period as a warning.
+    """
+
+    # Get the user's ID
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID"
 
     # Get and validate the rota ID from the url
@@ -121,94 +205,317 @@ async def api_put_rota_venues(request: Request):
     if not success:
         return data
     if not isinstance(data, list):
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Invalid data type.",
             },
             status=400,
         )
 
-    # Open a database connection
-    async with vbu.Database() as db:
+    # Validate the assignments
+    assignments: list[tuple[str, date, str | None]] = []
+    for assignment in data:
+        if not isinstance(assignment, dict):
+            return utils.json_response(
+                {
+                    "message": "Invalid data type.",
+                },
+                status=400,
+            )
+        if (r := utils.ensure_required_keys(assignment, {"position", "date", "person"}, location="assignment")):
+            return r
+        if (r := utils.check_valid_uuid(assignment["position"], api_response=True)):
+            return r
+        if assignment["person"] and (r := utils.check_valid_uuid(assignment["person"], api_response=True)):
+            return r
+        try:
+            day = date.fromisoformat(assignment["date"])
+        except (TypeError, ValueError):
+            return utils.json_response(
+                {
+                    "message": "Invalid date.",
+                },
+                status=400,
+            )
+        assignments.append((assignment["position"], day, assignment["person"] or None))
 
-        # Delete the current venues associated with the rota
-        await db.call(
+    # Save only what's changed
+    async with utils.Database() as db:
+        counts = await utils.save_assignments(db, login_id, rota_id, assignments)
+        if counts is None:
+            return utils.json_response(
+                {
+                    "message": "Rota not found.",
+                },
+                status=404,
+            )
+        conflicts = await utils.fetch_assignment_conflicts(db, login_id, rota_id)
+        warnings = await utils.fetch_hour_warnings(db, login_id, rota_id)
+
+    # And done
+    return utils.json_response(
+        {
+            "message": "Successfully updated assignments.",
+            "changes": counts,
+            "conflicts": conflicts,
+            "warnings": warnings,
+        },
+        status=200,
+    )
+
+
+@routes.get("/api/rotas/{rota_id}/export")
+@utils.requires_login(api_response=True)
+async def api_get_rota_export(request: Request):
+    """
+    Download every position on every day of a rota, along with who's been
+    put into it, as a CSV (the default) or XLSX file with ``format``. The
+    rows are streamed straight from the database as they're read.
+    """
+
+    # Get the user's ID
+    login_id = utils.get_context(request).login_id
+    assert login_id, "Missing login ID"
+
+    # Get and validate the rota ID from the url and the format
+    rota_id: str = request.match_info["rota_id"]
+    if (r := utils.check_valid_uuid(rota_id, api_response=True)):
+        return r
+    export_format = request.query.get("format", "csv")
+    if export_format not in utils.EXPORT_FORMATS:
+        return utils.json_response(
+            {
+                "message": f"Format must be one of: {', '.join(utils.EXPORT_FORMATS)}.",
+            },
+            status=400,
+        )
+
+    # Make sure the rota exists before we start sending it
+    async with utils.Database() as db:
+        rota_rows = await db.call(
             """
-            DELETE FROM
-                venues
+            SELECT
+                id
+            FROM
+                rotas
             WHERE
                 owner_id = $1
             AND
-                rota_id = $2
+                id = $2
             """,
             login_id, rota_id,
         )
+        if not rota_rows:
+            return utils.json_response(
+                {
+                    "message": "Rota not found.",
+                },
+                status=404,
+            )
+
+        # And stream it
+        return await utils.write_export(
+            request,
+            ROTA_EXPORT_HEADER,
+            utils.stream_rota_rows(db, login_id, rota_id),
+            export_format,
+            f"rota-{rota_id}",
+        )
+
+
+@routes.post("/api/rotas/{rota_id}/solve")
+@utils.requires_login(api_response=True)
+async def api_post_solve_rota(request: Request):
+    """
+    Automatically assign people to every position in a rota for each day of
+    its linked availability, and save the assignments. Anyone who ends up in
+    overlapping shifts (an overnight shift running into the next day's, say)
+    is listed as a conflict, and anyone over their maximum working hours for
+    the period as a warning.
+    """
 
-        # Create each venue given
-        venue: dict
-        for venue_index, venue in enumerate(data):  # type: ignore
-            venue_rows = await db.call(
+    # Get the user's ID
+    login_id = utils.get_context(request).login_id
+    assert login_id, "Missing login ID"
+
+    # Get and validate the rota ID from the url
+    rota_id: str = request.match_info["rota_id"]
+    if (r := utils.check_valid_uuid(rota_id, api_response=True)):
+        return r
+
+    # Get everything the solver needs
+    async with utils.Database() as db:
+        rota_rows = await db.call(
+            """
+            SELECT
+                availability_id
+            FROM
+                rotas
+            WHERE
+                owner_id = $1
+            AND
+                id = $2
+            """,
+            login_id, rota_id,
+        )
+        if not rota_rows:
+            return utils.json_response(
+                {
+                    "message": "Rota not found.",
+                },
+                status=404,
+            )
+        position_rows = await db.call(
+            """
+            SELECT
+                venue_positions.id,
+                venue_positions.venue_id,
+                venue_positions.role_id,
+                venue_positions.start_minute,
+                venue_positions.end_minute
+            FROM
+                venue_positions
+            LEFT JOIN
+                venues
+            ON
+                venues.id = venue_positions.venue_id
+            WHERE
+                venue_positions.owner_id = $1
+            AND
+                venue_positions.rota_id = $2
+            ORDER BY
+                venues.index ASC,
+                venue_positions.index ASC
+            """,
+            login_id, rota_id,
+        )
+        roles = await utils.get_role_tree(db, login_id)
+        person_rows = await db.call(
+            """
+            SELECT
+                people.id,
+                people.role_id,
+                people.maximum_working_hours,
+                COALESCE(person_hours.minutes, 0) AS worked_minutes
+            FROM
+                people
+            LEFT JOIN
+                person_hours
+            ON
+                person_hours.person_id = people.id
+            AND
+                person_hours.availability_id = $2
+            WHERE
+                people.owner_id = $1
+            """,
+            login_id, rota_rows[0]["availability_id"],
+        )
+        rota_minutes = {
+            r["person_id"]: r["minutes"]
+            for r in await db.call(
                 """
-                INSERT INTO
-                    venues
-                    (
-                        owner_id,
-                        rota_id,
-                        name,
-                        index
-                    )
-                VALUES
-                    (
-                        $1,
-                        $2,
-                        $3,
-                        $4
-                    )
-                RETURNING
-                    *
+                SELECT
+                    person_id,
+                    SUM(minutes) AS minutes
+                FROM
+                    assignments
+                WHERE
+                    rota_id = $1
+                GROUP BY
+                    person_id
                 """,
-                login_id, rota_id, venue["name"], venue_index,
+                rota_id,
             )
+        }
+        matrix = await utils.AvailabilityMatrix.fetch(
+            db,
+            rota_rows[0]["availability_id"],
+        )
+    assert matrix, "Missing availability for rota"
 
-            # Add the positions for the venue into the database
-            position: dict
-            for position_index, position in enumerate(venue["positions"]):  # type: ignore
-                await db.call(
-                    """
-                    INSERT INTO
-                        venue_positions
-                        (
-                            owner_id,
-                            rota_id,
-                            venue_id,
-                            role_id,
-                            index,
-                            start_time,
-                            end_time,
-                            notes
-                        )
-                    VALUES
-                        (
-                            $1,
-                            $2,
-                            $3,
-                            $4,
-                            $5,
-                            $6,
-                            $7,
-                            $8
-                        )
-                    """,
-                    login_id, rota_id, venue_rows[0]["id"],
-                    position["role"] or None, position_index,
-                    position["start"], position["end"],
-                    position["notes"],
-                )
+    # Solve the rota off of the event loop
+    start_date = matrix.start_date.date()
+    solve = functools.partial(
+        utils.solve_rota,
+        people=[
+            utils.SolverPerson(
+                r["id"],
+                r["role_id"],
+                r["maximum_working_hours"] * 60,
+                r["worked_minutes"] - rota_minutes.get(r["id"], 0),
+            )
+            for r in person_rows
+        ],
+        positions=[
+            utils.SolverPosition(
+                r["id"],
+                r["venue_id"],
+                r["role_id"],
+                r["end_minute"] - r["start_minute"] if r["start_minute"] is not None else 0,
+            )
+            for r in position_rows
+        ],
+        roles=roles,
+        availability={
+            person_id: matrix.states(person_id)
+            for person_id in matrix.person_ids
+        },
+        days=matrix.days,
+    )
+    loop = asyncio.get_running_loop()
+    assignments = await loop.run_in_executor(None, solve)
 
-    # Return the venues
-    return json_response(
+    # Save what's changed since the last solve
+    async with utils.Database() as db:
+        counts = await utils.save_assignments(
+            db,
+            login_id,
+            rota_id,
+            (
+                (i.position_id, start_date + timedelta(days=i.day), i.person_id)
+                for i in assignments
+            ),
+            replace=True,
+        )
+        if counts is None:
+            return utils.json_response(
+                {
+                    "message": "Rota not found.",
+                },
+                status=404,
+            )
+        warnings = await utils.fetch_hour_warnings(db, login_id, rota_id)
+
+    # Check that no-one's been put in two places at once
+    shift_times = {
+        r["id"]: (r["start_minute"], r["end_minute"])
+        for r in position_rows
+        if r["start_minute"] is not None
+    }
+    conflicts = utils.find_conflicts(
+        utils.BookedShift(i.person_id, i.position_id, i.venue_id, i.day, *shift_times[i.position_id])
+        for i in assignments
+        if i.person_id is not None and i.position_id in shift_times
+    )
+
+    # And done
+    return utils.json_response(
         {
-            "message": "Successfully updated venues.",
+            "data": {
+                "assignments": [
+                    {
+                        "position": str(i.position_id),
+                        "venue": str(i.venue_id),
+                        "date": (start_date + timedelta(days=i.day)).isoformat(),
+                        "person": str(i.person_id) if i.person_id else None,
+                    }
+                    for i in assignments
+                ],
+                "unfilled": sum(1 for i in assignments if i.person_id is None),
+                "conflicts": [i.to_json(start_date) for i in conflicts],
+                "warnings": warnings,
+            },
+            "changes": counts,
         },
         status=200,
     )
@@ -1,55 +1,69 @@
-from aiohttp.web import Request, RouteTableDef, json_response
-import aiohttp_session
-from discord.ext import vbu
+from aiohttp.web import Request
 import asyncpg
 
 from . import utils
 
 
-routes = RouteTableDef()
+routes = utils.RouteTableDef()
+
+
+ROTAS_LIST = utils.ListSpec(
+    columns={
+        "id": "rotas.id",
+        "availability": "availability.id",
+        "start": "availability.start_date",
+        "end": "availability.end_date",
+    },
+    source="rotas LEFT JOIN availability ON rotas.availability_id = availability.id",
+    order=[("start", "TIMESTAMP"), ("id", "UUID")],
+    filters={
+        "availability": utils.ListFilter("availability.id = {}", "UUID"),
+        "from": utils.ListFilter("availability.end_date >= {}", "TIMESTAMP"),
+        "to": utils.ListFilter("availability.start_date <= {}", "TIMESTAMP"),
+    },
+)
 
 
 @routes.get("/api/rotas")
 @utils.requires_login(api_response=True)
+@utils.with_etag("rotas", "availability")
 async def api_get_rotas(request: Request):
     """
-    Return all of the JSON data for the venues.
+    Return the user's rotas, ordered by the start date of their
+    availability.
+
+    Takes ``limit`` and ``after`` to get a page at a time, ``availability``
+    to filter by availability ID, ``from`` and ``to`` to get the rotas
+    overlapping a date range, and ``fields`` to pick the columns.
     """
 
     # Get the user's ID
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID"
 
-    # Get the venues from the user
-    async with vbu.Database() as db:
-        rotas = await db.call(
-            """
-            SELECT
-                rotas.id,
-                availability.id AS availability_id,
-                availability.start_date AS start,
-                availability.end_date AS end
-            FROM
-                rotas
-            LEFT JOIN
-                availability ON rotas.availability_id = availability.id
-            WHERE
-                rotas.owner_id = $1
-            """,
-            login_id,
+    # Get the page of rotas
+    try:
+        list_query = ROTAS_LIST.parse(request.query)
+        async with utils.Database() as db:
+            rotas, cursor = await ROTAS_LIST.fetch(
+                db,
+                list_query,
+                where="rotas.owner_id = $1",
+                args=[login_id],
+            )
+    except utils.InvalidListQuery as e:
+        return utils.json_response(
+            {
+                "message": str(e),
+            },
+            status=400,
         )
 
-    # Return the venues
-    return json_response(
+    # Return the rotas
+    return utils.json_response(
         {
-            "data": [
-                utils.encode_row_as_json(
-                    i,
-                    {"availability_id": "availability"},
-                )
-                for i in rotas
-            ],
+            "data": rotas,
+            "next": cursor,
         },
         status=200,
     )
@@ -63,8 +77,7 @@ async def api_post_rotas(request: Request):
     """
 
     # Get the user's ID
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID"
 
     # Validate the request
@@ -75,7 +88,7 @@ async def api_post_rotas(request: Request):
         return r
 
     # Get the venues from the user
-    async with vbu.Database() as db:
+    async with utils.Database() as db:
         try:
             rotas = await db.call(
                 """
@@ -96,7 +109,7 @@ async def api_post_rotas(request: Request):
                 login_id, data['availability'],
             )
         except asyncpg.ForeignKeyViolationError:
-            return json_response(
+            return utils.json_response(
                 {
                     "error": "Invalid availability ID",
                 },
@@ -104,7 +117,7 @@ async def api_post_rotas(request: Request):
             )
 
     # Don't return anything - the page refreshes out of ease
-    return json_response(
+    return utils.json_response(
         {
             "data": {}
         },
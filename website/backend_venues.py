@@ -1,50 +1,75 @@
-from aiohttp.web import Request, RouteTableDef, json_response
-import aiohttp_session
-from discord.ext import vbu
+from aiohttp.web import Request
 import asyncpg
 
 from . import utils
 
 
-routes = RouteTableDef()
+routes = utils.RouteTableDef()
+
+
+VENUES_LIST = utils.ListSpec(
+    columns={
+        "id": "id",
+        "owner_id": "owner_id",
+        "rota_id": "rota_id",
+        "name": "name",
+        "index": "index",
+    },
+    source="venues",
+    order=[("name", "CITEXT"), ("id", "UUID")],
+    filters={
+        "rota": utils.ListFilter("rota_id = {}", "UUID"),
+        "name": utils.ListFilter("name ILIKE {}", prefix=True),
+    },
+)
 
 
 @routes.get("/api/venues")
 @utils.requires_login(api_response=True)
+@utils.with_etag("venues")
 async def api_get_venues(request: Request):
     """
-    Return all of the JSON data for the venues.
+    Return all of the JSON data for the venues, ordered by name.
+
+    Takes ``limit`` and ``after`` to get a page at a time, ``rota`` and
+    ``name`` (a prefix) to filter, and ``fields`` to pick the columns.
     """
 
     # Get the user's ID
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID"
 
-    # Get the venues from the user
-    async with vbu.Database() as db:
-        venues = await db.call(
-            """
-            SELECT
-                *
-            FROM
-                venues
-            WHERE
-                owner_id = $1
-            """,
+    # Get the venues from the user, from the cache if we can
+    try:
+        list_query = VENUES_LIST.parse(request.query)
+
+        async def fetch():
+            async with utils.Database() as db:
+                return await VENUES_LIST.fetch(
+                    db,
+                    list_query,
+                    where="owner_id = $1",
+                    args=[login_id],
+                )
+
+        venues, cursor = await utils.VENUES_CACHE.get(
             login_id,
+            ("list", utils.get_versions(request)["venues"], list_query.cache_key()),
+            fetch,
+        )
+    except utils.InvalidListQuery as e:
+        return utils.json_response(
+            {
+                "message": str(e),
+            },
+            status=400,
         )
 
     # Return the venues
-    return json_response(
+    return utils.json_response(
         {
-            "data": [
-                utils.encode_row_as_json(
-                    i,
-                    {"display_name": "display"},
-                )
-                for i in venues
-            ],
+            "data": venues,
+            "next": cursor,
         },
         status=200,
     )
@@ -64,12 +89,11 @@ async def api_delete_venue(request: Request):
         return r
 
     # Get the user's ID
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID"
 
     # Delete the venue
-    async with vbu.Database() as db:
+    async with utils.Database() as db:
         venue_rows = await db.call(
             """
             DELETE FROM
@@ -83,16 +107,17 @@ async def api_delete_venue(request: Request):
             """,
             login_id, request.query["id"],
         )
+    utils.VENUES_CACHE.invalidate(login_id)
 
     # Return if we've been successful
     if not venue_rows:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "Venue not found.",
             },
             status=404,
         )
-    return json_response(
+    return utils.json_response(
         {
             "message": "Venue deleted.",
         },
@@ -115,12 +140,11 @@ async def api_create_venue(request: Request):
         return r
 
     # Get the user's ID
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID"
 
     # Create the venue
-    async with vbu.Database() as db:
+    async with utils.Database() as db:
         try:
             venue_rows = await db.call(
                 """
@@ -143,15 +167,16 @@ async def api_create_venue(request: Request):
                 login_id, data["name"], data.get("display_name", None)
             )
         except asyncpg.UniqueViolationError:
-            return json_response(
+            return utils.json_response(
                 {
                     "message": "You already have a venue with that name.",
                 },
                 status=409,
             )
+    utils.VENUES_CACHE.invalidate(login_id)
 
     # Tell the user it's been created
-    return json_response(
+    return utils.json_response(
         {
             "message": "Venue created.",
             "data": utils.encode_row_as_json(
@@ -182,12 +207,11 @@ async def api_patch_venue(request: Request):
         return r
 
     # Get the user's ID
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID"
 
     # Update the venue
-    async with vbu.Database() as db:
+    async with utils.Database() as db:
         try:
             venue_rows = await db.call(
                 """
@@ -207,16 +231,17 @@ async def api_patch_venue(request: Request):
                 data["name"], data["display"],
             )
         except asyncpg.UniqueViolationError:
-            return json_response(
+            return utils.json_response(
                 {
                     "message": "You already have a venue with that name.",
                 },
                 status=409,
             )
+    utils.VENUES_CACHE.invalidate(login_id)
 
     # Tell the user if there was no venue with that ID
     if not venue_rows:
-        return json_response(
+        return utils.json_response(
             {
                 "message": "That venue does not exist.",
             },
@@ -224,7 +249,7 @@ async def api_patch_venue(request: Request):
         )
 
     # Tell the user it's been created
-    return json_response(
+    return utils.json_response(
         {
             "message": "Venue created.",
             "data": utils.encode_row_as_json(
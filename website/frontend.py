@@ -1,14 +1,12 @@
 import uuid
 
-from aiohttp.web import HTTPFound, RouteTableDef, Request
+from aiohttp.web import HTTPFound, Request
 from aiohttp_jinja2 import template
-import aiohttp_session
-from discord.ext import vbu
 
 from . import utils
 
 
-routes = RouteTableDef()
+routes = utils.RouteTableDef()
 
 
 @routes.get("/")
@@ -20,7 +18,7 @@ async def index(_: Request):
 
 @routes.get("/logout")
 async def logout(request: Request):
-    session = await aiohttp_session.get_session(request)
+    session = utils.get_context(request).session
     session.clear()
     session.invalidate()
     return HTTPFound("/")
@@ -78,12 +76,11 @@ async def dashboard_availability_view(request: Request):
     """
 
     # Get the ID of the logged in user
-    session = await aiohttp_session.get_session(request)
-    login_id = session.get("id")
+    login_id = utils.get_context(request).login_id
     assert login_id, "Missing login ID from session."
 
     # Verify the given ID exists
-    async with vbu.Database() as db:
+    async with utils.Database() as db:
         rows = await db.call(
             """
             SELECT
@@ -101,7 +98,9 @@ async def dashboard_availability_view(request: Request):
         return HTTPFound("/dashboard/availability")
 
     # And we good - everything else can be AJAXd
-    return {}
+    return {
+        "availability_id": rows[0]["id"],
+    }
 
 
 @routes.get("/dashboard/rotas")
@@ -140,39 +139,20 @@ async def fill_availability(request: Request):
         return HTTPFound("/")
 
     # Verify the given ID exists
-    async with vbu.Database() as db:
-        rows = await db.call(
-            """
-            SELECT
-                filled_availability.availability_id,
-                filled_availability.person_id,
-                people.name AS person_name,
-                filled_availability.availability,
-                availability.start_date,
-                availability.end_date
-            FROM
-                filled_availability
-            LEFT JOIN
-                people
-            ON
-                people.id = filled_availability.person_id
-            LEFT JOIN
-                availability
-            ON
-                availability.id = filled_availability.availability_id
-            WHERE
-                filled_availability.id = $1
-            """,
-            availability_id,
-        )
-    if not rows:
+    async with utils.Database() as db:
+        filled = await utils.fetch_filled_availability(db, availability_id)
+    if filled is None:
         return HTTPFound("/")
 
     # And we good - everything else can be AJAXd
     return {
-        "person_name": rows[0]['person_name'],
-        "person_id": rows[0]['person_id'],
-        "start_date": rows[0]['start_date'],
-        "end_date": rows[0]['end_date'],
-        "current": rows[0]['availability'],
+        "person_name": filled['person_name'],
+        "person_id": filled['person_id'],
+        "start_date": filled['start_date'],
+        "end_date": filled['end_date'],
+        "current": utils.unpack_availability(
+            filled['availability'],
+            filled['days'],
+        ),
+        "version": filled['version'],
     }
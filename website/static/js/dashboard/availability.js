@@ -58,6 +58,7 @@ async function getAllAvailability() {
         "/api/availability",
         {
             method: "GET",
+            cache: "no-cache",
         },
     );
     let siteData = await site.json();
@@ -113,7 +114,7 @@ async function createNewAvailability() {
 
     // Add new role to list
     let availabilityListNode = document.querySelector("#availability-list");
-    let newAv = createAvailabilityNode(r.id, r.start, r.end);
+    let newAv = createAvailabilityNode(data.id, data.start, data.end);
     availabilityListNode.appendChild(newAv);
 
     // Reset form
@@ -1,54 +1,42 @@
 async function getAllAvailability() {
 
-    // Get the availability dates
+    // Get the dates, people, and availability all at once
     let availabilityId = window.location.pathname.split("/").pop();
-    let availabilitySite = await fetch(`/api/availability?id=${availabilityId}`);
-    let availabilityData = await availabilitySite.json();
-    let availabilityMeta = availabilityData.data[0];
-    let startDate = new Date(availabilityMeta.start);
-    let endDate = new Date(availabilityMeta.end);
-
-    // For ease, let's make a list of dates to display
-    let dates = [];
-    let working = startDate;
-    while(working <= endDate) {
-        dates.push(new Date(working));
-        working.setDate(working.getDate() + 1);
-    }
+    let availabilitySite = await fetch(`/api/availability/${availabilityId}/grid`, {cache: "no-cache"});
+    let grid = (await availabilitySite.json()).data;
 
     // Add the dates to the table
     let thead = document.querySelector("thead");
     let tr = document.createElement("tr");
     tr.appendChild(document.createElement("td"));
-    for(let i of dates) {
+    for(let i of grid.dates) {
         let dateHeader = document.createElement("th");
         dateHeader.scope = "col";
-        dateHeader.textContent = i.toDateString();
+        dateHeader.textContent = new Date(`${i}T00:00:00`).toDateString();
         tr.appendChild(dateHeader)
     }
     thead.appendChild(tr);
 
-    // Get all of the people and their availability
-    availabilitySite = await fetch(`/api/user_availability?id=${availabilityId}`);
-    availabilityData = await availabilitySite.json();
-
-    // Add each person to the table
-    for(let i of availabilityData.data) {
-        let tbody = document.querySelector("tbody");
+    // Add each person and their availability, building the rows off the
+    // page so that it's only laid out once
+    let tbody = document.querySelector("tbody");
+    let rows = document.createDocumentFragment();
+    grid.people.forEach((person, index) => {
         let newRow = document.createElement("tr");
-        // newRow.dataset.id = i.id;
         let nameCol = document.createElement("th");
         nameCol.scope = "row"
-        nameCol.dataset.id = i.person_id;
-        nameCol.appendChild(document.createTextNode(i.person_name));
+        nameCol.dataset.id = person.id;
+        nameCol.appendChild(document.createTextNode(person.name));
         newRow.appendChild(nameCol)
-        for(let r of i.availability) {
+        for(let r of grid.availability[index]) {
+            let value = r == "." ? "" : r;
             let avCol = document.createElement("td");
             avCol.classList.add("availability-cell")
-            avCol.textContent = r;
-            avCol.dataset.value = r;
+            avCol.textContent = value;
+            avCol.dataset.value = value;
             newRow.appendChild(avCol);
         }
-        tbody.appendChild(newRow)
-    }
+        rows.appendChild(newRow)
+    });
+    tbody.appendChild(rows);
 }
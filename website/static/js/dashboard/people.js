@@ -1,3 +1,9 @@
+const PEOPLE_PAGE_SIZE = 100;
+let nextPeoplePage = null;
+let loadingPeople = false;
+let peopleObserver = null;
+
+
 function cancelEditPerson() {
 
     // Hide just the user we're editing
@@ -131,9 +137,10 @@ function createPersonNode(id, name, email, roleId) {
  * */
 async function getAllRoles() {
     let site = await fetch(
-        "/api/roles",
+        "/api/roles?fields=id,name",
         {
             method: "GET",
+            cache: "no-cache",
         },
     );
     let siteData = await site.json();
@@ -142,9 +149,9 @@ async function getAllRoles() {
 
 
 /**
- * Get all of the people under the user's ID via the API;
- * add all of those people to the page, clearing the ones that are currently
- * on the page.
+ * Get the people under the user's ID via the API, a page at a time;
+ * add the first page to the page, clearing the ones that are currently
+ * on the page, and load the rest as they're scrolled to.
  * This will also clear and reset the role dropdown selector for creating
  * new people.
  * */
@@ -160,23 +167,56 @@ async function getAllPeople() {
         roleList.appendChild(newRole);
     }
 
+    // Clear the list and load the first page of people
+    let personListNode = document.querySelector("#person-list");
+    personListNode.innerHTML = "";
+    nextPeoplePage = "";
+    await loadMorePeople();
+}
+
+
+/**
+ * Add the next page of people to the end of the list. A marker after the
+ * list loads the page after that once it's scrolled into view.
+ * */
+async function loadMorePeople() {
+    if(nextPeoplePage === null || loadingPeople) return;
+    loadingPeople = true;
+
     // Perform the API request to get the users
+    let params = new URLSearchParams({limit: PEOPLE_PAGE_SIZE});
+    if(nextPeoplePage) params.set("after", nextPeoplePage);
     let site = await fetch(
-        "/api/people",
+        `/api/people?${params}`,
         {
             method: "GET",
+            cache: "no-cache",
         },
     );
     let siteData = await site.json();
     let data = siteData.data;
 
-    // Set up the new options in the role list
+    // Add them to the list
     let personListNode = document.querySelector("#person-list");
-    personListNode.innerHTML = "";
     for(let r of data) {
         let newPerson = createPersonNode(r.id, r.name, r.email, r.role);
         personListNode.appendChild(newPerson);
     }
+    nextPeoplePage = siteData.next;
+    loadingPeople = false;
+
+    // Watch for the end of the list coming into view
+    let marker = document.querySelector("#person-list-end");
+    if(marker == null) {
+        marker = document.createElement("div");
+        marker.id = "person-list-end";
+        personListNode.after(marker);
+        peopleObserver = new IntersectionObserver((entries) => {
+            if(entries.some(e => e.isIntersecting)) loadMorePeople();
+        });
+    }
+    peopleObserver.unobserve(marker);
+    if(nextPeoplePage) peopleObserver.observe(marker);
 }
 
 
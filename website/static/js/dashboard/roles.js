@@ -1,3 +1,9 @@
+const ROLES_PAGE_SIZE = 100;
+let nextRolesPage = null;
+let loadingRoles = false;
+let rolesObserver = null;
+
+
 function cancelEditRole() {
 
     // Hide just the user we're editing
@@ -122,17 +128,19 @@ function createRoleNode(id, name, parentId) {
 
 
 /**
- * Get all of the roles under the user's ID via the API;
- * add all of those roles to the page, clearing the ones that are currently
- * on the page.
+ * Get the roles under the user's ID via the API;
+ * add all of them to the parent dropdown and the first page of them to the
+ * page, clearing the ones that are currently on the page. The rest are
+ * loaded as they're scrolled to.
  * */
 async function getAllRoles() {
 
     // Perform the API request
     let site = await fetch(
-        "/api/roles",
+        "/api/roles?fields=id,name",
         {
             method: "GET",
+            cache: "no-cache",
         },
     );
     let siteData = await site.json();
@@ -153,13 +161,56 @@ async function getAllRoles() {
         selectNode.appendChild(newOption);
     }
 
-    // Set up the new options in the role list
+    // Clear the role list and load the first page
     let roleListNode = document.querySelector("#role-list");
     roleListNode.innerHTML = "";
+    nextRolesPage = "";
+    await loadMoreRoles();
+}
+
+
+/**
+ * Add the next page of roles to the end of the list. A marker after the
+ * list loads the page after that once it's scrolled into view.
+ * */
+async function loadMoreRoles() {
+    if(nextRolesPage === null || loadingRoles) return;
+    loadingRoles = true;
+
+    // Perform the API request
+    let params = new URLSearchParams({limit: ROLES_PAGE_SIZE});
+    if(nextRolesPage) params.set("after", nextRolesPage);
+    let site = await fetch(
+        `/api/roles?${params}`,
+        {
+            method: "GET",
+            cache: "no-cache",
+        },
+    );
+    let siteData = await site.json();
+    let data = siteData.data;
+
+    // Add them to the list
+    let roleListNode = document.querySelector("#role-list");
     for(let r of data) {
         let newRole = createRoleNode(r.id, r.name, r.parent);
         roleListNode.appendChild(newRole);
     }
+    nextRolesPage = siteData.next;
+    loadingRoles = false;
+
+    // Watch for the end of the list coming into view
+    let marker = document.querySelector("#role-list-end");
+    if(marker == null) {
+        marker = document.createElement("div");
+        marker.id = "role-list-end";
+        roleListNode.after(marker);
+        rolesObserver = new IntersectionObserver((entries) => {
+            if(entries.some(e => e.isIntersecting)) loadMoreRoles();
+        });
+    }
+    rolesObserver.unobserve(marker);
+    if(nextRolesPage) rolesObserver.observe(marker);
 }
 
 
@@ -20,6 +20,7 @@ async function saveAllVenues() {
         let positions = venue.querySelectorAll(".position");
         for (let position of positions) {
             positionData.push({
+                id: position.dataset.id || null,
                 role: position.querySelector("[name=role]").value,
                 start: position.querySelector("[name=start]").value,
                 end: position.querySelector("[name=end]").value,
@@ -29,6 +30,7 @@ async function saveAllVenues() {
 
         // Store positions in the venue
         postData.push({
+            id: venue.dataset.id || null,
             name: venue.querySelector("[name=name]").value,
             positions: positionData,
         });
@@ -40,36 +42,42 @@ async function saveAllVenues() {
         body: JSON.stringify(postData),
     });
 
-    // If the API call was successful, update the UI
+    // If the API call was successful, update the UI with what was saved
     if (response.status === 200) {
-        getAllRotaData();
+        let data = await response.json();
+        renderRotaData(data.data);
+
+        // Let them know if the new shift times put anyone over their hours
+        if(data.warnings.length) {
+            let lines = data.warnings.map(i => `${i.name}: ${i.minutes / 60} of ${i.maximum_minutes / 60} hours`);
+            alert(`Some people are now over their maximum working hours:\n${lines.join("\n")}`);
+        }
     }
 }
 
 
 /**
- * Perform an API request to get all available roles, returning a list of
- * option nodes.
+ * The user's roles, fetched once per page load and shared by every call
+ * to getAllRoles.
  * */
-async function getAllRoles() {
+let allRoles = null;
 
-    // See if we have roles stored already
-    let roles = document.querySelector("#roles");
-    if(roles.dataset.fetched == "1") {
-        return [...roles.querySelectorAll("option")]
-    }
 
-    // We don't have roles stored, so fetch them
-    let response = await fetch("/api/roles");
-    let data = await response.json();
-    for(let role of data.data) {
-        let option = document.createElement("option");
-        option.value = role.id;
-        option.textContent = role.name;
-        roles.appendChild(option);
+/**
+ * Perform an API request to get all available roles, returning a list of
+ * roles with their IDs and names.
+ * */
+async function getAllRoles() {
+    if(allRoles === null) {
+        allRoles = fetch("/api/roles?fields=id,name", {cache: "no-cache"})
+            .then(response => response.json())
+            .then(data => data.data)
+            .catch(error => {
+                allRoles = null;
+                throw error;
+            });
     }
-    roles.dataset.fetched = "1";
-    return [...roles.querySelectorAll("option")]
+    return await allRoles;
 }
 
 
@@ -85,8 +93,16 @@ async function createNewPositionNode() {
     let roles = document.createElement("select");
     roles.classList.add("input");
     roles.name = "role";
-    for(let r of await getAllRoles()) {
-        roles.appendChild(r.cloneNode(true));
+    let anyRole = document.createElement("option");
+    anyRole.value = "";
+    anyRole.textContent = "(Any)";
+    anyRole.selected = true;
+    roles.appendChild(anyRole);
+    for(let role of await getAllRoles()) {
+        let option = document.createElement("option");
+        option.value = role.id;
+        option.textContent = role.name;
+        roles.appendChild(option);
     }
 
     let startTime = document.createElement("input");
@@ -135,9 +151,10 @@ async function createNewVenuePosition(event) {
 /**
  * Create a new venue node to be added to the DOM.
  * */
-function createNewVenueNode(name = "") {
+function createNewVenueNode(name = "", id = "") {
     let venueItem = document.createElement("div");
     venueItem.classList.add("venue");
+    if(id) venueItem.dataset.id = id;
 
     let venueName = document.createElement("input");
     venueName.classList.add("input");
@@ -188,24 +205,34 @@ async function getAllRotaData() {
     await getAllRoles();
 
     // Get the venues associated with the rota
-    const response = await fetch(`/api/rotas/${ROTAID}`);
+    const response = await fetch(`/api/rotas/${ROTAID}`, {cache: "no-cache"});
     const venues = await response.json();
+    await renderRotaData(venues.data);
+}
+
+
+/**
+ * Clear the venues list and populate it with the given venues.
+ * */
+async function renderRotaData(venues) {
 
     // Clear the venue list
     const venueList = document.querySelector("#venue-list");
     venueList.innerHTML = "";
 
     // Go through all of the data in the list
-    for (let venue of venues.data) {
+    for (let venue of venues) {
 
         // Create a new venue item
-        let venueItem = createNewVenueNode(venue.name);
+        let venueItem = createNewVenueNode(venue.name, venue.id);
         venueList.appendChild(venueItem);
 
         // Add positions of the venue
         if(venue.positions) {
             for (let position of venue.positions) {
                 let positionNode = await createNewPositionNode();
+                positionNode.dataset.id = position.id;
+                positionNode.classList.remove("unsaved");
                 positionNode.querySelector("[name=role]").value = position.role;
                 positionNode.querySelector("[name=start]").value = position.start;
                 positionNode.querySelector("[name=end]").value = position.end;
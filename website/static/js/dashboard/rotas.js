@@ -9,7 +9,7 @@ async function getAllAvailability() {
     dropdown.innerHTML = "";
 
     // Ask the API for non-expired availability sheets
-    let response = await fetch("/api/availability");
+    let response = await fetch("/api/availability", {cache: "no-cache"});
 
     // Create option nodes for each item
     let json = await response.json();
@@ -68,7 +68,7 @@ async function getAllRotas() {
     rotaHolder.innerHTML = "";
 
     // Ask the API nicely for the rotas
-    let response = await fetch("/api/rotas");
+    let response = await fetch("/api/rotas", {cache: "no-cache"});
 
     // Check the response is valid
     if (!response.ok) {
@@ -116,6 +116,7 @@ async function getAllVenues() {
         `/api/venues`,
         {
             method: "GET",
+            cache: "no-cache",
         },
     );
     json = await response.json();
@@ -1,4 +1,5 @@
 const AVSTATES = "APU";
+let originalAvailability = [];
 
 
 function changeButtonValue(event) {
@@ -17,7 +18,9 @@ function generateTable() {
     let tbody = document.querySelector("tbody");
     let startDate = new Date(table.dataset.start);
     let endDate = new Date(table.dataset.end);
+    originalAvailability = table.dataset.current.split(",");
     let working = new Date(startDate);
+    let index = 0;
     while(working <= endDate) {
         let newRow = document.createElement("tr");
         let th = document.createElement("th");
@@ -25,40 +28,70 @@ function generateTable() {
         th.textContent = working.toDateString();
         newRow.appendChild(th);
 
+        // Unfilled days show as available, and are saved as such
         let td = document.createElement("td");
         let button = document.createElement("button");
         button.classList.add("button")
         button.onclick = changeButtonValue
-        button.textContent = "A";
-        button.value = "A";
+        button.textContent = originalAvailability[index] || "A";
+        button.value = originalAvailability[index] || "A";
         td.appendChild(button);
         newRow.appendChild(td);
 
         working.setDate(working.getDate() + 1);
         tbody.appendChild(newRow);
+        index += 1;
     }
 }
 
 
 async function submitAvailability() {
 
-    // Get the data from the user
+    // Get the days that the user has changed
     document.querySelector("#submit").classList.add("is-loading");
+    let table = document.querySelector("table");
     let allButtons = document.querySelectorAll("table button");
-    let userAvailability = [];
-    for(let i of allButtons) {
-        userAvailability.push(i.value);
-    }
+    let changes = {};
+    allButtons.forEach((button, index) => {
+        if(button.value != originalAvailability[index]) {
+            changes[index] = button.value;
+        }
+    });
 
     // Send over to the api
     let site = await fetch(
         window.location.pathname,
         {
-            method: "POST",
-            body: JSON.stringify(userAvailability)
+            method: "PATCH",
+            body: JSON.stringify({
+                version: parseInt(table.dataset.version),
+                changes: changes,
+            }),
         }
     );
     let data = await site.json();
-    alert(data.message);
     document.querySelector("#submit").classList.remove("is-loading");
+
+    // Someone else has changed it since we loaded the page - take their
+    // values for any days the user hasn't touched
+    if(site.status == 409) {
+        allButtons.forEach((button, index) => {
+            let current = data.data.availability[index];
+            if(changes[index] === undefined) {
+                button.textContent = current || "A";
+                button.value = current || "A";
+            }
+            originalAvailability[index] = current;
+        });
+        table.dataset.version = data.data.version;
+        alert(data.message);
+        return;
+    }
+    if(site.ok) {
+        allButtons.forEach((button, index) => {
+            originalAvailability[index] = button.value;
+        });
+        table.dataset.version = data.data.version;
+    }
+    alert(data.message);
 }
@@ -1,10 +1,38 @@
 import functools
 from typing import Any, Literal, Optional, Tuple, Mapping, overload
 import uuid
-from datetime import datetime as dt
 
-from aiohttp.web import Request, HTTPFound, Response, json_response
-import aiohttp_session
+import asyncpg
+from aiohttp.web import Request, HTTPFound, Response
+
+from .assignments import fetch_assignments, save_assignments, fetch_assignment_conflicts, repair_assignments
+from .availability import (
+    AVAILABILITY_STATES,
+    pack_availability,
+    update_availability,
+    unpack_availability,
+    AvailabilityMatrix,
+    stream_availability,
+    create_fill_rows,
+    add_person_to_open_periods,
+    fetch_filled_availability,
+)
+from .cache import OwnerCache, ROLES_CACHE, PEOPLE_CACHE, VENUES_CACHE
+from .coverage import Coverage
+from .database import Database
+from .encoding import dumps, json_response
+from .etags import fetch_versions, make_etag, etag_matches, get_versions, etag_headers, with_etag
+from .exports import EXPORT_FORMATS, CsvWriter, XlsxWriter, write_export, stream_rota_rows, stream_person_shifts, ics_lines, write_ics
+from .hours import fetch_person_hours, fetch_hour_warnings
+from .instrumentation import QueryStats, get_query_stats
+from .listing import ListFilter, ListQuery, ListSpec, InvalidListQuery
+from .metrics import Metrics
+from .middleware import RequestContext, get_context, RouteTableDef
+from .passwords import PasswordHasher, PasswordHasherBusy
+from .roles import RoleTree, get_role_tree, invalidate_role_tree
+from .rotas import fetch_rota_venues, save_rota_venues
+from .shifts import MINUTES_PER_DAY, parse_time, parse_shift, shift_minutes, BookedShift, ShiftConflict, find_conflicts
+from .solver import SolverPerson, SolverPosition, Assignment, solve_rota
 
 
 __all__ = (
@@ -14,6 +42,71 @@ __all__ = (
     "encode_row_as_json",
     "try_read_json",
     "ensure_required_keys",
+    "fetch_assignments",
+    "save_assignments",
+    "fetch_assignment_conflicts",
+    "repair_assignments",
+    "OwnerCache",
+    "ROLES_CACHE",
+    "PEOPLE_CACHE",
+    "VENUES_CACHE",
+    "Coverage",
+    "Database",
+    "dumps",
+    "json_response",
+    "fetch_versions",
+    "make_etag",
+    "etag_matches",
+    "get_versions",
+    "etag_headers",
+    "with_etag",
+    "EXPORT_FORMATS",
+    "CsvWriter",
+    "XlsxWriter",
+    "write_export",
+    "stream_rota_rows",
+    "stream_person_shifts",
+    "ics_lines",
+    "write_ics",
+    "fetch_person_hours",
+    "fetch_hour_warnings",
+    "QueryStats",
+    "get_query_stats",
+    "ListFilter",
+    "ListQuery",
+    "ListSpec",
+    "InvalidListQuery",
+    "Metrics",
+    "RequestContext",
+    "get_context",
+    "RouteTableDef",
+    "PasswordHasher",
+    "PasswordHasherBusy",
+    "AVAILABILITY_STATES",
+    "pack_availability",
+    "update_availability",
+    "unpack_availability",
+    "AvailabilityMatrix",
+    "stream_availability",
+    "create_fill_rows",
+    "add_person_to_open_periods",
+    "fetch_filled_availability",
+    "RoleTree",
+    "get_role_tree",
+    "invalidate_role_tree",
+    "fetch_rota_venues",
+    "save_rota_venues",
+    "MINUTES_PER_DAY",
+    "parse_time",
+    "parse_shift",
+    "shift_minutes",
+    "BookedShift",
+    "ShiftConflict",
+    "find_conflicts",
+    "SolverPerson",
+    "SolverPosition",
+    "Assignment",
+    "solve_rota",
 )
 
 
@@ -27,7 +120,7 @@ def add_session():
         async def inner(request: Request):
             v = await func(request)
             if isinstance(v, dict):
-                v["session"] = await aiohttp_session.get_session(request)
+                v["session"] = get_context(request).session
             return v
         return inner
     return outer
@@ -37,8 +130,7 @@ def requires_login(*, api_response: bool = False):
     def outer(func):
         @functools.wraps(func)
         async def inner(request: Request):
-            session = await aiohttp_session.get_session(request)
-            if not session.get("id"):
+            if not get_context(request).logged_in:
                 if api_response:
                     return json_response(
                         {
@@ -99,42 +191,28 @@ def encode_row_as_json(
         row: dict[str | int, Any] |  list[Any],
         key_replacements: Optional[dict[str | int, str]] = None) -> dict | list:
     """
-    Encode a row from the database as JSON.
+    Prepare a row from the database to be sent as JSON, renaming any keys
+    given in ``key_replacements``. For a list of rows, the keys of each row
+    in it are renamed.
+
+    Values are left as they are - UUIDs, datetimes, and records are encoded
+    by :func:`json_response` itself, so there's no need to walk the row.
     """
 
-    # Set key replacements up
-    key_replacements = key_replacements or dict()
-
-    # Set up output dict
-    output = {}
-
-    # Validate input row
-    row_is_list = isinstance(row, list)
-    if row_is_list:
-        row = {
-            i: o
-            for i, o in enumerate(row)
-        }
-    assert not isinstance(row, list)
-
-    # Loop through the row and serialize the items in it
-    for i, o in row.items():
-        new_key = key_replacements.get(i, i)
-        if isinstance(o, uuid.UUID):
-            output[new_key] = str(o)
-        elif isinstance(o, dt):
-            output[new_key] = o.isoformat()
-        elif isinstance(o, (list, dict)):
-            output[new_key] = encode_row_as_json(o)
-        elif o is None:
-            output[new_key] = None
-        else:
-            output[new_key] = o
-
-    # Return serialized output
-    if row_is_list:
-        return list(output.values())
-    return output
+    if isinstance(row, list):
+        if not key_replacements:
+            return list(row)
+        return [
+            encode_row_as_json(i, key_replacements)
+            if isinstance(i, (dict, asyncpg.Record)) else i
+            for i in row
+        ]
+    if not key_replacements:
+        return dict(row.items())
+    return {
+        key_replacements.get(i, i): o
+        for i, o in row.items()
+    }
 
 
 @overload
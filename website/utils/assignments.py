@@ -0,0 +1,591 @@
+from __future__ import annotations
+
+from datetime import date, timedelta
+from typing import TYPE_CHECKING, Any, Iterable, Optional
+
+from .availability import AVAILABILITY_STATES, unpack_availability
+from .roles import get_role_tree
+from .shifts import BookedShift, find_conflicts
+from .solver import SolverPerson, SolverPosition, solve_rota
+
+if TYPE_CHECKING:
+    from discord.ext import vbu
+
+
+__all__ = (
+    "fetch_assignments",
+    "save_assignments",
+    "fetch_assignment_conflicts",
+    "repair_assignments",
+)
+
+
+# The states that someone can be put into a shift in
+WORKING_STATES = ("A", "P")
+
+
+async def fetch_assignments(
+        db: vbu.Database,
+        owner_id: Any,
+        rota_id: Any,
+        *,
+        start: Optional[date] = None,
+        end: Optional[date] = None) -> list[dict[str, Any]]:
+    """
+    Get who's been put into each position on each day of a rota, ordered by
+    date and then by venue and position. Can be narrowed down to the days
+    between ``start`` and ``end`` (inclusive).
+    """
+
+    rows = await db.call(
+        """
+        SELECT
+            assignments.position_id,
+            venue_positions.venue_id,
+            assignments.date,
+            assignments.person_id,
+            assignments.minutes
+        FROM
+            assignments
+        JOIN
+            venue_positions
+        ON
+            venue_positions.id = assignments.position_id
+        JOIN
+            venues
+        ON
+            venues.id = venue_positions.venue_id
+        WHERE
+            assignments.owner_id = $1
+        AND
+            assignments.rota_id = $2
+        AND
+            ($3::DATE IS NULL OR assignments.date >= $3)
+        AND
+            ($4::DATE IS NULL OR assignments.date <= $4)
+        ORDER BY
+            assignments.date ASC,
+            venues.index ASC,
+            venue_positions.index ASC
+        """,
+        owner_id, rota_id, start, end,
+    )
+    return [
+        {
+            "position": r["position_id"],
+            "venue": r["venue_id"],
+            "date": r["date"],
+            "person": r["person_id"],
+            "minutes": r["minutes"],
+        }
+        for r in rows
+    ]
+
+
+async def save_assignments(
+        db: vbu.Database,
+        owner_id: Any,
+        rota_id: Any,
+        assignments: Iterable[tuple[Any, date, Optional[Any]]],
+        *,
+        replace: bool = False) -> Optional[dict[str, int]]:
+    """
+    Save who's been put into which position on which day of a rota, given as
+    ``(position_id, date, person_id)`` with a person of None to clear the
+    position for that day. Only the assignments that differ from what's
+    stored are written, so the hours ledger is only moved by what actually
+    changed. If ``replace`` is set, stored assignments that weren't given are
+    cleared too.
+
+    Positions that aren't in the rota, dates outside of its period, and
+    people that the owner doesn't have are skipped. Everything runs in a
+    single transaction. Returns the number of assignments inserted,
+    updated, and deleted, or None if the rota doesn't exist.
+    """
+
+    async with db.transaction() as transaction:
+
+        # Lock the rota so that concurrent saves can't interleave
+        rota_rows = await transaction.call(
+            """
+            SELECT
+                id
+            FROM
+                rotas
+            WHERE
+                owner_id = $1
+            AND
+                id = $2
+            FOR UPDATE
+            """,
+            owner_id, rota_id,
+        )
+        if not rota_rows:
+            return None
+        current_rows = await transaction.call(
+            """
+            SELECT
+                position_id,
+                date,
+                person_id
+            FROM
+                assignments
+            WHERE
+                rota_id = $1
+            """,
+            rota_id,
+        )
+        current = {
+            (str(r["position_id"]), r["date"]): str(r["person_id"])
+            for r in current_rows
+        }
+        counts = {
+            "inserted": 0,
+            "updated": 0,
+            "deleted": 0,
+        }
+
+        # Work out what's changed
+        new_assignments: list[tuple[str, date, str]] = []
+        updated_assignments: list[tuple[str, date, str]] = []
+        deleted_assignments: list[tuple[str, date]] = []
+        for position_id, day, person_id in assignments:
+            key = (str(position_id), day)
+            existing = current.pop(key, None)
+            if person_id is None:
+                if existing is not None:
+                    deleted_assignments.append(key)
+            elif existing is None:
+                new_assignments.append((*key, str(person_id)))
+            elif existing != str(person_id):
+                updated_assignments.append((*key, str(person_id)))
+        if replace:
+            deleted_assignments.extend(current)
+
+        # Apply each kind of change in one statement
+        if deleted_assignments:
+            deleted_rows = await transaction.call(
+                """
+                DELETE FROM
+                    assignments
+                USING
+                    UNNEST($2::UUID[], $3::DATE[]) AS deleted(position_id, date)
+                WHERE
+                    assignments.rota_id = $1
+                AND
+                    assignments.position_id = deleted.position_id
+                AND
+                    assignments.date = deleted.date
+                RETURNING
+                    assignments.position_id
+                """,
+                rota_id,
+                [i[0] for i in deleted_assignments],
+                [i[1] for i in deleted_assignments],
+            )
+            counts["deleted"] += len(deleted_rows)
+        if updated_assignments:
+            updated_rows = await transaction.call(
+                """
+                UPDATE
+                    assignments
+                SET
+                    person_id = updated.person_id
+                FROM
+                    UNNEST($3::UUID[], $4::DATE[], $5::UUID[]) AS updated(position_id, date, person_id)
+                JOIN
+                    people
+                ON
+                    people.id = updated.person_id
+                AND
+                    people.owner_id = $1
+                WHERE
+                    assignments.rota_id = $2
+                AND
+                    assignments.position_id = updated.position_id
+                AND
+                    assignments.date = updated.date
+                RETURNING
+                    assignments.position_id
+                """,
+                owner_id, rota_id,
+                [i[0] for i in updated_assignments],
+                [i[1] for i in updated_assignments],
+                [i[2] for i in updated_assignments],
+            )
+            counts["updated"] += len(updated_rows)
+        if new_assignments:
+            new_rows = await transaction.call(
+                """
+                INSERT INTO
+                    assignments
+                    (
+                        owner_id,
+                        rota_id,
+                        availability_id,
+                        position_id,
+                        date,
+                        person_id,
+                        minutes
+                    )
+                SELECT
+                    $1,
+                    $2,
+                    rotas.availability_id,
+                    venue_positions.id,
+                    new_assignments.date,
+                    people.id,
+                    COALESCE(venue_positions.end_minute - venue_positions.start_minute, 0)
+                FROM
+                    UNNEST($3::UUID[], $4::DATE[], $5::UUID[]) AS new_assignments(position_id, date, person_id)
+                JOIN
+                    venue_positions
+                ON
+                    venue_positions.id = new_assignments.position_id
+                AND
+                    venue_positions.rota_id = $2
+                JOIN
+                    rotas
+                ON
+                    rotas.id = venue_positions.rota_id
+                JOIN
+                    availability
+                ON
+                    availability.id = rotas.availability_id
+                AND
+                    new_assignments.date BETWEEN availability.start_date::DATE AND availability.end_date::DATE
+                JOIN
+                    people
+                ON
+                    people.id = new_assignments.person_id
+                AND
+                    people.owner_id = $1
+                RETURNING
+                    position_id
+                """,
+                owner_id, rota_id,
+                [i[0] for i in new_assignments],
+                [i[1] for i in new_assignments],
+                [i[2] for i in new_assignments],
+            )
+            counts["inserted"] += len(new_rows)
+
+    return counts
+
+
+async def fetch_assignment_conflicts(
+        db: vbu.Database,
+        owner_id: Any,
+        rota_id: Any) -> list[dict[str, Any]]:
+    """
+    Find everyone with overlapping shifts in a rota's period, across every
+    rota for it, as given by :meth:`ShiftConflict.to_json`. Shifts are read
+    with their stored start and end minutes, so positions whose times
+    couldn't be parsed are left out.
+    """
+
+    rows = await db.call(
+        """
+        SELECT
+            assignments.person_id,
+            assignments.position_id,
+            venue_positions.venue_id,
+            rotas_period.start_date::DATE AS start_date,
+            assignments.date - rotas_period.start_date::DATE AS day,
+            venue_positions.start_minute,
+            venue_positions.end_minute
+        FROM (
+            SELECT
+                availability.id,
+                availability.start_date
+            FROM
+                rotas
+            JOIN
+                availability
+            ON
+                availability.id = rotas.availability_id
+            WHERE
+                rotas.owner_id = $1
+            AND
+                rotas.id = $2
+        ) rotas_period
+        JOIN
+            assignments
+        ON
+            assignments.availability_id = rotas_period.id
+        JOIN
+            venue_positions
+        ON
+            venue_positions.id = assignments.position_id
+        WHERE
+            venue_positions.start_minute IS NOT NULL
+        """,
+        owner_id, rota_id,
+    )
+    if not rows:
+        return []
+    conflicts = find_conflicts(
+        BookedShift(
+            r["person_id"],
+            r["position_id"],
+            r["venue_id"],
+            r["day"],
+            r["start_minute"],
+            r["end_minute"],
+        )
+        for r in rows
+    )
+    return [i.to_json(rows[0]["start_date"]) for i in conflicts]
+
+
+async def repair_assignments(
+        db: vbu.Database,
+        filled: dict[str, Any],
+        packed: bytes) -> dict[str, int]:
+    """
+    Fix up the assignments of someone whose filled availability is about to
+    change from ``filled`` (as given by :func:`fetch_filled_availability`)
+    to ``packed``, which should already be saved in the same transaction.
+
+    Only the days they can no longer work are looked at. Their assignments
+    on those days are removed, and just those positions are filled again
+    from whoever else is free on the day, with the same rules and costs as
+    solving a whole rota. The period's rotas are locked first, just as
+    saving or solving one does. Returns the number of assignments cleared
+    and refilled.
+    """
+
+    counts = {
+        "cleared": 0,
+        "refilled": 0,
+    }
+
+    # Work out which days they've stopped being able to work
+    days = filled["days"]
+    old_states = unpack_availability(filled["availability"], days)
+    new_states = unpack_availability(packed, days)
+    start_date = filled["start_date"].date()
+    lost_days = [
+        day
+        for day, (old, new) in enumerate(zip(old_states, new_states))
+        if old in WORKING_STATES and new not in WORKING_STATES
+    ]
+    if not lost_days:
+        return counts
+    lost_dates = [start_date + timedelta(days=day) for day in lost_days]
+
+    # Lock the period's rotas, in id order, so that saves and solves of them
+    # can't interleave with us
+    await db.call(
+        """
+        SELECT
+            id
+        FROM
+            rotas
+        WHERE
+            availability_id = $1
+        ORDER BY
+            id
+        FOR UPDATE
+        """,
+        filled["availability_id"],
+    )
+
+    # Take them out of those days
+    cleared_rows = await db.call(
+        """
+        DELETE FROM
+            assignments
+        WHERE
+            availability_id = $1
+        AND
+            person_id = $2
+        AND
+            date = ANY($3::DATE[])
+        RETURNING
+            owner_id,
+            rota_id,
+            position_id,
+            date,
+            minutes
+        """,
+        filled["availability_id"], filled["person_id"], lost_dates,
+    )
+    counts["cleared"] = len(cleared_rows)
+    if not cleared_rows:
+        return counts
+    owner_id = cleared_rows[0]["owner_id"]
+
+    # Get who could fill the gaps - people in the period with a role that
+    # can fill one of the positions, with their availability on just the
+    # lost days and the hours they're already down for
+    position_rows = await db.call(
+        """
+        SELECT
+            id,
+            venue_id,
+            role_id
+        FROM
+            venue_positions
+        WHERE
+            id = ANY($1::UUID[])
+        """,
+        list({r["position_id"] for r in cleared_rows}),
+    )
+    positions = {r["id"]: r for r in position_rows}
+    if not positions:
+        return counts
+    roles = await get_role_tree(db, owner_id)
+    role_ids: Optional[set[Any]] = set()
+    for r in position_rows:
+        if r["role_id"] is None:
+            role_ids = None  # Anyone can fill it
+            break
+        role_ids |= roles.descendants(r["role_id"])  # type: ignore
+    person_rows = await db.call(
+        """
+        SELECT
+            people.id,
+            people.role_id,
+            people.maximum_working_hours,
+            COALESCE(person_hours.minutes, 0) AS worked_minutes,
+            ARRAY(
+                SELECT
+                    CASE
+                        WHEN lost.day / 4 < LENGTH(filled_availability.availability)
+                        THEN (GET_BYTE(filled_availability.availability, lost.day / 4) >> (lost.day % 4 * 2)) & 3
+                        ELSE 0
+                    END
+                FROM
+                    UNNEST($4::INTEGER[]) WITH ORDINALITY AS lost(day, index)
+                ORDER BY
+                    lost.index
+            ) AS codes
+        FROM
+            filled_availability
+        JOIN
+            people
+        ON
+            people.id = filled_availability.person_id
+        LEFT JOIN
+            person_hours
+        ON
+            person_hours.person_id = people.id
+        AND
+            person_hours.availability_id = filled_availability.availability_id
+        WHERE
+            filled_availability.availability_id = $2
+        AND
+            people.owner_id = $1
+        AND
+            people.id <> $3
+        AND
+            ($5::UUID[] IS NULL OR people.role_id = ANY($5::UUID[]))
+        """,
+        owner_id, filled["availability_id"], filled["person_id"], lost_days,
+        None if role_ids is None else list(role_ids),
+    )
+    busy_rows = await db.call(
+        """
+        SELECT
+            person_id,
+            date
+        FROM
+            assignments
+        WHERE
+            availability_id = $1
+        AND
+            date = ANY($2::DATE[])
+        """,
+        filled["availability_id"], lost_dates,
+    )
+    busy = {(r["person_id"], r["date"]) for r in busy_rows}
+    worked = {r["id"]: r["worked_minutes"] for r in person_rows}
+    lost_index = {day_date: index for index, day_date in enumerate(lost_dates)}
+
+    # Fill each day's gaps on their own
+    refilled: list[tuple[Any, Any, Any, date, int]] = []
+    for day_date in sorted({r["date"] for r in cleared_rows}):
+        index = lost_index[day_date]
+        gaps = [r for r in cleared_rows if r["date"] == day_date and r["position_id"] in positions]
+        candidates = [
+            r
+            for r in person_rows
+            if (r["id"], day_date) not in busy
+        ]
+        people = [
+            SolverPerson(
+                r["id"],
+                r["role_id"],
+                r["maximum_working_hours"] * 60,
+                worked[r["id"]],
+            )
+            for r in candidates
+        ]
+        gap_minutes = {r["position_id"]: r["minutes"] for r in gaps}
+        output = solve_rota(
+            people,
+            [
+                SolverPosition(
+                    r["position_id"],
+                    positions[r["position_id"]]["venue_id"],
+                    positions[r["position_id"]]["role_id"],
+                    r["minutes"],
+                )
+                for r in gaps
+            ],
+            roles,
+            {r["id"]: [AVAILABILITY_STATES[r["codes"][index]]] for r in candidates},
+            1,
+        )
+        rota_ids = {r["position_id"]: r["rota_id"] for r in gaps}
+        for i in output:
+            if i.person_id is None:
+                continue
+            refilled.append((
+                rota_ids[i.position_id],
+                i.position_id,
+                i.person_id,
+                day_date,
+                gap_minutes[i.position_id],
+            ))
+            worked[i.person_id] += gap_minutes[i.position_id]
+
+    # And save them all at once
+    if refilled:
+        refilled_rows = await db.call(
+            """
+            INSERT INTO
+                assignments
+                (
+                    owner_id,
+                    rota_id,
+                    availability_id,
+                    position_id,
+                    date,
+                    person_id,
+                    minutes
+                )
+            SELECT
+                $1,
+                refilled.rota_id,
+                $2,
+                refilled.position_id,
+                refilled.date,
+                refilled.person_id,
+                refilled.minutes
+            FROM
+                UNNEST($3::UUID[], $4::UUID[], $5::UUID[], $6::DATE[], $7::INTEGER[])
+                    AS refilled(rota_id, position_id, person_id, date, minutes)
+            RETURNING
+                position_id
+            """,
+            owner_id, filled["availability_id"],
+            [i[0] for i in refilled],
+            [i[1] for i in refilled],
+            [i[2] for i in refilled],
+            [i[3] for i in refilled],
+            [i[4] for i in refilled],
+        )
+        counts["refilled"] = len(refilled_rows)
+    return counts
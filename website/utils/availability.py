@@ -0,0 +1,528 @@
+from __future__ import annotations
+
+from datetime import date, timedelta
+from typing import TYPE_CHECKING, Any, AsyncIterator, Iterable, Mapping, Optional
+
+if TYPE_CHECKING:
+    import asyncpg
+    from discord.ext import vbu
+
+    from .database import Database
+
+
+__all__ = (
+    "AVAILABILITY_STATES",
+    "pack_availability",
+    "update_availability",
+    "unpack_availability",
+    "AvailabilityMatrix",
+    "stream_availability",
+    "create_fill_rows",
+    "add_person_to_open_periods",
+    "fetch_filled_availability",
+)
+
+
+# Each day is stored as a 2 bit code, four days to a byte with the first day
+# in the lowest bits. Code 0 is a day that hasn't been filled in.
+AVAILABILITY_STATES = ("", "A", "P", "U")
+UNFILLED, AVAILABLE, PREFERRED_NOT, UNAVAILABLE = range(4)
+STATE_CODES = {
+    state: code
+    for code, state in enumerate(AVAILABILITY_STATES)
+}
+
+# Translates codes into the characters they're shown as in a compact grid
+# row, with "." for an unfilled day
+GRID_TABLE = bytes.maketrans(bytes(range(4)), b".APU")
+
+# Lookup tables so that unpacking is a byte-level translation rather than
+# bit twiddling per day
+UNPACK_TABLE = [
+    bytes((byte >> (shift * 2)) & 0b11 for shift in range(4))
+    for byte in range(256)
+]
+
+
+def pack_availability(states: Iterable[str]) -> bytes:
+    """
+    Pack a list of "A", "P", and "U" day states into their stored bytes.
+    Empty strings and None are stored as unfilled days.
+    """
+
+    output = bytearray()
+    for index, state in enumerate(states):
+        try:
+            code = STATE_CODES[state or ""]
+        except (KeyError, TypeError):
+            raise ValueError(f"Invalid availability state {state!r}.")
+        if index % 4 == 0:
+            output.append(0)
+        output[-1] |= code << ((index % 4) * 2)
+    return bytes(output)
+
+
+def update_availability(
+        data: Optional[bytes],
+        days: int,
+        changes: Mapping[int, str]) -> bytes:
+    """
+    Change the state of individual days in stored bytes, leaving the rest
+    as they are. Raises ValueError for days outside of the period or
+    invalid states.
+    """
+
+    output = bytearray(data or b"")[:(days + 3) // 4]
+    output.extend(bytes((days + 3) // 4 - len(output)))
+    for day, state in changes.items():
+        if not 0 <= day < days:
+            raise ValueError(f"Day {day} is outside of the period.")
+        try:
+            code = STATE_CODES[state or ""]
+        except (KeyError, TypeError):
+            raise ValueError(f"Invalid availability state {state!r}.")
+        shift = (day % 4) * 2
+        output[day // 4] = (output[day // 4] & ~(0b11 << shift)) | (code << shift)
+    return bytes(output)
+
+
+def unpack_codes(data: Optional[bytes], days: Optional[int] = None) -> bytes:
+    """
+    Unpack stored bytes into one code (0-3) per day. If the number of days
+    isn't given then trailing unfilled days are dropped.
+    """
+
+    codes = b"".join([UNPACK_TABLE[i] for i in data or b""])
+    if days is None:
+        return codes.rstrip(b"\x00")
+    return codes[:days].ljust(days, b"\x00")
+
+
+def unpack_availability(data: Optional[bytes], days: Optional[int] = None) -> list[str]:
+    """
+    Unpack stored bytes into a list of "A", "P", "U", and "" (unfilled) day
+    states. If the number of days isn't given then trailing unfilled days
+    are dropped.
+    """
+
+    return [AVAILABILITY_STATES[i] for i in unpack_codes(data, days)]
+
+
+class AvailabilityMatrix:
+    """
+    The filled availability of every person for a given availability period,
+    stored as one code per person per day in a single row-major buffer.
+
+    Columns are read with strided slices, so per-day counts and masks run
+    at C speed rather than looping over each cell in Python.
+
+    Attributes
+    -----------
+    person_ids: list
+        The IDs of the people in the matrix, in row order.
+    person_names: dict
+        A map of person ID to their name.
+    filled_ids: dict
+        A map of person ID to the ID of their filled availability row.
+    days: int
+        The number of days in the availability period.
+    codes: bytearray
+        The day codes for every person, ``days`` codes per person.
+    """
+
+    def __init__(
+            self,
+            days: int,
+            start_date: Any = None,
+            end_date: Any = None):
+        self.days = days
+        self.start_date = start_date
+        self.end_date = end_date
+        self.person_ids: list[Any] = []
+        self.person_names: dict[Any, Optional[str]] = {}
+        self.filled_ids: dict[Any, Any] = {}
+        self.codes = bytearray()
+        self._rows: dict[Any, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.person_ids)
+
+    def __contains__(self, person_id: Any) -> bool:
+        return person_id in self._rows
+
+    def add_row(
+            self,
+            person_id: Any,
+            packed: Optional[bytes],
+            *,
+            name: Optional[str] = None,
+            filled_id: Any = None) -> None:
+        """
+        Add a person's packed availability as a new row in the matrix.
+        """
+
+        self._rows[person_id] = len(self.person_ids)
+        self.person_ids.append(person_id)
+        self.person_names[person_id] = name
+        self.filled_ids[person_id] = filled_id
+        self.codes += unpack_codes(packed, self.days)
+
+    @classmethod
+    async def fetch(
+            cls,
+            db: vbu.Database,
+            availability_id: Any,
+            owner_id: Any = None) -> Optional[AvailabilityMatrix]:
+        """
+        Load the matrix for an availability period in a single query.
+        Returns None if the period doesn't exist (or isn't owned by the
+        given owner).
+        """
+
+        rows = await db.call(
+            """
+            SELECT
+                availability.start_date,
+                availability.end_date,
+                filled_availability.id,
+                filled_availability.person_id,
+                people.name AS person_name,
+                filled_availability.availability
+            FROM
+                availability
+            LEFT JOIN
+                filled_availability
+            ON
+                filled_availability.availability_id = availability.id
+            LEFT JOIN
+                people
+            ON
+                people.id = filled_availability.person_id
+            WHERE
+                availability.id = $1
+            AND
+                ($2::UUID IS NULL OR availability.owner_id = $2)
+            ORDER BY
+                people.name ASC
+            """,
+            availability_id, owner_id,
+        )
+        if not rows:
+            return None
+        start_date = rows[0]["start_date"]
+        end_date = rows[0]["end_date"]
+        matrix = cls(
+            max((end_date.date() - start_date.date()).days + 1, 0),
+            start_date,
+            end_date,
+        )
+        for r in rows:
+            if r["person_id"] is None:
+                continue  # Period with no filled availability
+            matrix.add_row(
+                r["person_id"],
+                r["availability"],
+                name=r["person_name"],
+                filled_id=r["id"],
+            )
+        return matrix
+
+    def row(self, person_id: Any) -> bytes:
+        """
+        Get the day codes for a given person.
+        """
+
+        start = self._rows[person_id] * self.days
+        return bytes(self.codes[start:start + self.days])
+
+    def states(self, person_id: Any) -> list[str]:
+        """
+        Get the "A"/"P"/"U"/"" day states for a given person.
+        """
+
+        return [AVAILABILITY_STATES[i] for i in self.row(person_id)]
+
+    def get(self, person_id: Any, day: int) -> str:
+        """
+        Get the state of a person on a given day.
+        """
+
+        return AVAILABILITY_STATES[self.codes[self._rows[person_id] * self.days + day]]
+
+    def column(self, day: int) -> bytes:
+        """
+        Get the day codes for every person on a given day, in row order.
+        """
+
+        return bytes(self.codes[day::self.days])
+
+    def count(self, day: int, state: str) -> int:
+        """
+        Count how many people are in the given state on the given day.
+        """
+
+        return self.codes[day::self.days].count(STATE_CODES[state])
+
+    def day_counts(self, state: str) -> list[int]:
+        """
+        Count how many people are in the given state for every day.
+        """
+
+        code = STATE_CODES[state]
+        return [
+            self.codes[day::self.days].count(code)
+            for day in range(self.days)
+        ]
+
+    def mask(self, *states: str) -> bytes:
+        """
+        Get a buffer the same shape as :attr:`codes` with a 1 in every cell
+        that's one of the given states and a 0 everywhere else.
+        """
+
+        table = bytearray(256)
+        for state in states:
+            table[STATE_CODES[state]] = 1
+        return bytes(self.codes).translate(table)
+
+    def people_in_state(self, day: int, *states: str) -> list[Any]:
+        """
+        Get the IDs of the people in any of the given states on a day.
+        """
+
+        codes = {STATE_CODES[i] for i in states}
+        return [
+            person_id
+            for person_id, code in zip(self.person_ids, self.codes[day::self.days])
+            if code in codes
+        ]
+
+    def dates(self) -> list[date]:
+        """
+        Get the date of every day in the period, in column order.
+        """
+
+        if self.start_date is None:
+            return []
+        start = self.start_date.date()
+        return [start + timedelta(days=i) for i in range(self.days)]
+
+    def grid_rows(self) -> list[str]:
+        """
+        Get every person's availability as a single string with one
+        character per day - "A", "P", or "U", or "." for a day that hasn't
+        been filled in - in row order.
+        """
+
+        if not self.days:
+            return [""] * len(self.person_ids)
+        characters = bytes(self.codes).translate(GRID_TABLE).decode("ascii")
+        return [
+            characters[i:i + self.days]
+            for i in range(0, len(characters), self.days)
+        ]
+
+
+async def stream_availability(
+        db: Database,
+        availability_id: Any,
+        owner_id: Any = None,
+        *,
+        prefetch: int = 200) -> AsyncIterator[dict[str, Any]]:
+    """
+    Yield each person's filled availability for a period, ordered by name,
+    reading from a server side cursor so that only ``prefetch`` rows are
+    held in memory at once. Yields nothing if the period doesn't exist (or
+    isn't owned by the given owner).
+    """
+
+    conn: asyncpg.Connection = db.conn  # type: ignore
+    async with conn.transaction(readonly=True):
+        periods = await db.call(
+            """
+            SELECT
+                start_date,
+                end_date
+            FROM
+                availability
+            WHERE
+                id = $1
+            AND
+                ($2::UUID IS NULL OR owner_id = $2)
+            """,
+            availability_id, owner_id,
+        )
+        if not periods:
+            return
+        period = periods[0]
+        days = max((period["end_date"].date() - period["start_date"].date()).days + 1, 0)
+        rows = db.stream(
+            """
+            SELECT
+                filled_availability.id,
+                filled_availability.person_id,
+                people.name AS person_name,
+                filled_availability.availability
+            FROM
+                filled_availability
+            LEFT JOIN
+                people
+            ON
+                people.id = filled_availability.person_id
+            WHERE
+                filled_availability.availability_id = $1
+            ORDER BY
+                people.name ASC
+            """,
+            availability_id,
+            prefetch=prefetch,
+        )
+        async for r in rows:
+            yield {
+                "id": r["id"],
+                "person_name": r["person_name"],
+                "person_id": r["person_id"],
+                "availability": unpack_availability(r["availability"], days),
+            }
+
+
+async def create_fill_rows(
+        db: vbu.Database,
+        owner_id: Any,
+        availability_id: Any,
+        role_ids: Optional[Iterable[Any]] = None) -> list[Any]:
+    """
+    Add an empty filled availability row for an availability period for
+    each of the owner's people (or just the people with one of the given
+    roles) in a single statement. Returns the new rows' IDs along with the
+    ID, name, and email of their person.
+    """
+
+    return await db.call(
+        """
+        WITH inserted AS (
+            INSERT INTO
+                filled_availability
+                (
+                    availability_id,
+                    person_id
+                )
+            SELECT
+                $2,
+                people.id
+            FROM
+                people
+            WHERE
+                people.owner_id = $1
+            AND
+                ($3::UUID[] IS NULL OR people.role_id = ANY($3::UUID[]))
+            RETURNING
+                id, person_id
+        )
+        SELECT
+            inserted.id,
+            inserted.person_id,
+            people.name AS person_name,
+            people.email AS person_email
+        FROM
+            inserted
+        LEFT JOIN
+            people
+        ON
+            people.id = inserted.person_id
+        ORDER BY
+            people.name ASC
+        """,
+        owner_id, availability_id,
+        list(role_ids) if role_ids is not None else None,
+    )
+
+
+async def add_person_to_open_periods(
+        db: vbu.Database,
+        owner_id: Any,
+        person_id: Any,
+        role_ids: Iterable[Any]) -> list[Any]:
+    """
+    Add an empty filled availability row for a person to each of the
+    owner's periods that haven't ended yet, skipping periods limited to a
+    role that isn't one of ``role_ids`` (the person's role and its
+    ancestors). Returns the new rows' IDs along with their period's ID.
+    """
+
+    return await db.call(
+        """
+        INSERT INTO
+            filled_availability
+            (
+                availability_id,
+                person_id
+            )
+        SELECT
+            availability.id,
+            $2
+        FROM
+            availability
+        WHERE
+            availability.owner_id = $1
+        AND
+            availability.end_date >= DATE_TRUNC('day', TIMEZONE('UTC', NOW()))
+        AND
+            (availability.role_id IS NULL OR availability.role_id = ANY($3::UUID[]))
+        AND
+            NOT EXISTS (
+                SELECT
+                    1
+                FROM
+                    filled_availability existing
+                WHERE
+                    existing.availability_id = availability.id
+                AND
+                    existing.person_id = $2
+            )
+        RETURNING
+            id, availability_id
+        """,
+        owner_id, person_id, list(role_ids),
+    )
+
+
+async def fetch_filled_availability(
+        db: vbu.Database,
+        filled_id: Any) -> Optional[dict[str, Any]]:
+    """
+    Get a single person's filled availability along with its period and
+    the number of days in it, or None if it doesn't exist.
+    """
+
+    rows = await db.call(
+        """
+        SELECT
+            filled_availability.id,
+            filled_availability.availability_id,
+            filled_availability.person_id,
+            people.name AS person_name,
+            filled_availability.availability,
+            filled_availability.version,
+            availability.start_date,
+            availability.end_date
+        FROM
+            filled_availability
+        LEFT JOIN
+            people
+        ON
+            people.id = filled_availability.person_id
+        LEFT JOIN
+            availability
+        ON
+            availability.id = filled_availability.availability_id
+        WHERE
+            filled_availability.id = $1
+        """,
+        filled_id,
+    )
+    if not rows:
+        return None
+    output = dict(rows[0].items())
+    output["days"] = max((output["end_date"].date() - output["start_date"].date()).days + 1, 0)
+    return output
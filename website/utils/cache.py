@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+import logging
+import time
+from typing import Any, Awaitable, Callable, ClassVar, Hashable, Optional, TypeVar
+
+import asyncpg
+from discord.ext import vbu
+import toml
+
+from .database import CONNECTION_KEYS
+
+
+__all__ = (
+    "OwnerCache",
+    "ROLES_CACHE",
+    "PEOPLE_CACHE",
+    "VENUES_CACHE",
+)
+
+
+log = logging.getLogger("rotaroamer.cache")
+
+T = TypeVar("T")
+
+
+# The options that can be set in the [cache] section of the website config,
+# and their defaults.
+CACHE_DEFAULTS: dict[str, Any] = {
+    "enabled": True,
+    "max_entries": 5_000,  # Entries kept by each cache, across every owner
+    "ttl": 300.0,  # Seconds an entry is trusted for
+    "notify": False,  # Share invalidations with other processes through Postgres
+    "notify_channel": "rotaroamer_cache",
+}
+RECONNECT_DELAY = 5.0
+
+
+class OwnerCache:
+    """
+    A read-through cache of query results, split up by owner so that all of
+    an owner's entries can be dropped at once when they change something.
+
+    Entries are evicted least recently used first once there are more than
+    ``max_entries`` of them, and are trusted for ``ttl`` seconds. A fetch
+    that was running while its owner was invalidated (or the cache was
+    cleared) isn't stored, so a slow read can't put back data that a write
+    has just replaced. Other owners' fetches are unaffected.
+
+    If ``notify`` is set, invalidations are also sent to every other process
+    with Postgres' ``NOTIFY``, and invalidations from other processes are
+    listened for on a dedicated connection. Every cache is cleared whenever
+    that connection is (re)made, since messages sent while it was down are
+    lost.
+
+    Attributes
+    -----------
+    name: str
+        The name of the cache, used in invalidation messages and metrics.
+    hits: int
+        How many reads were answered from the cache.
+    misses: int
+        How many reads had to go to the database.
+    evictions: int
+        How many entries were dropped to stay under ``max_entries``.
+    invalidations: int
+        How many times an owner's entries were dropped.
+    """
+
+    config_file: ClassVar[str] = "config/website.toml"
+    options: ClassVar[Optional[dict[str, Any]]] = None
+    caches: ClassVar[dict[str, OwnerCache]] = {}
+    _listener: ClassVar[Optional[asyncio.Task]] = None
+    _outbox: ClassVar[Optional[asyncio.Queue[str]]] = None
+
+    def __init__(self, name: str):
+        self.name = name
+        self.entries: OrderedDict[tuple[str, Hashable], tuple[float, Any]] = OrderedDict()
+        self.owners: dict[str, set[Hashable]] = {}
+        self.epoch: int = 0  # Bumped when everything is cleared
+        self.generations: dict[str, int] = {}  # Per owner, while they have fetches running
+        self.fetching: dict[str, int] = {}  # How many fetches each owner has running
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+        self.caches[name] = self
+
+    @classmethod
+    def load_options(cls) -> dict[str, Any]:
+        """
+        Read the cache options from the website config file, falling back
+        to the defaults for anything that isn't set.
+        """
+
+        try:
+            with open(cls.config_file) as a:
+                cache_config = toml.load(a).get("cache", {})
+        except OSError:
+            cache_config = {}
+        return {
+            i: cache_config.get(i, o)
+            for i, o in CACHE_DEFAULTS.items()
+        }
+
+    @classmethod
+    def get_options(cls) -> dict[str, Any]:
+        if cls.options is None:
+            cls.options = cls.load_options()
+        return cls.options
+
+    async def get(self, owner_id: Any, key: Hashable, fetch: Callable[[], Awaitable[T]]) -> T:
+        """
+        Get an owner's entry from the cache, or run ``fetch`` and store what
+        it returns if we don't have it.
+        """
+
+        options = self.get_options()
+        if not options["enabled"]:
+            return await fetch()
+        self.start_listener()
+
+        # See if we have it already
+        owner = str(owner_id)
+        now = time.monotonic()
+        cached = self.entries.get((owner, key))
+        if cached is not None:
+            if cached[0] > now:
+                self.entries.move_to_end((owner, key))
+                self.hits += 1
+                return cached[1]
+            self._drop(owner, key)
+
+        # We don't, so get it - as long as nothing was invalidated in the
+        # meantime it's safe to keep
+        self.misses += 1
+        generation = (self.epoch, self.generations.get(owner, 0))
+        self.fetching[owner] = self.fetching.get(owner, 0) + 1
+        try:
+            value = await fetch()
+            if (self.epoch, self.generations.get(owner, 0)) == generation:
+                self._store(owner, key, value, now + options["ttl"])
+        finally:
+            self.fetching[owner] -= 1
+            if not self.fetching[owner]:
+                del self.fetching[owner]
+                self.generations.pop(owner, None)
+        return value
+
+    def _store(self, owner: str, key: Hashable, value: Any, expires: float) -> None:
+        self.entries[(owner, key)] = (expires, value)
+        self.entries.move_to_end((owner, key))
+        self.owners.setdefault(owner, set()).add(key)
+        max_entries = self.get_options()["max_entries"]
+        while len(self.entries) > max_entries:
+            (evicted_owner, evicted_key), _ = self.entries.popitem(last=False)
+            self._forget(evicted_owner, evicted_key)
+            self.evictions += 1
+
+    def _drop(self, owner: str, key: Hashable) -> None:
+        self.entries.pop((owner, key), None)
+        self._forget(owner, key)
+
+    def _forget(self, owner: str, key: Hashable) -> None:
+        keys = self.owners.get(owner)
+        if keys is None:
+            return
+        keys.discard(key)
+        if not keys:
+            del self.owners[owner]
+
+    def invalidate(self, owner_id: Any, *, publish: bool = True) -> None:
+        """
+        Drop everything cached for an owner, for after they change
+        something. Unless ``publish`` is False, other processes are told to
+        do the same.
+        """
+
+        owner = str(owner_id)
+        if owner in self.fetching:
+            self.generations[owner] = self.generations.get(owner, 0) + 1
+        self.invalidations += 1
+        for key in self.owners.pop(owner, ()):
+            self.entries.pop((owner, key), None)
+        if publish and self.get_options()["notify"]:
+            self.start_listener()
+            assert self._outbox is not None
+            self._outbox.put_nowait(f"{self.name}:{owner}")
+
+    def clear(self) -> None:
+        """
+        Drop every entry in the cache.
+        """
+
+        self.epoch += 1
+        self.entries.clear()
+        self.owners.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "owners": len(self.owners),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    @classmethod
+    def clear_all(cls) -> None:
+        for cache in cls.caches.values():
+            cache.clear()
+
+    @classmethod
+    def start_listener(cls) -> None:
+        """
+        Start sending and listening for invalidations, if that's turned on
+        and we aren't already.
+        """
+
+        if not cls.get_options()["notify"]:
+            return
+        if cls._listener is not None and not cls._listener.done():
+            return
+        if cls._outbox is None:
+            cls._outbox = asyncio.Queue()
+        cls._listener = asyncio.create_task(cls._listen())
+
+    @classmethod
+    def _on_notify(cls, connection: Any, pid: int, channel: str, payload: str) -> None:
+        if pid == connection.get_server_pid():
+            return  # We sent it, so we've already invalidated it
+        name, _, owner = payload.partition(":")
+        cache = cls.caches.get(name)
+        if cache is not None:
+            cache.invalidate(owner, publish=False)
+
+    @classmethod
+    async def _listen(cls) -> None:
+        channel = cls.get_options()["notify_channel"]
+        outbox = cls._outbox
+        assert outbox is not None
+        while True:
+
+            # Connect and listen
+            try:
+                connection = await asyncpg.connect(**{
+                    i: o
+                    for i, o in (vbu.Database.config or {}).items()
+                    if i in CONNECTION_KEYS
+                })
+            except (OSError, asyncpg.PostgresError) as e:
+                log.warning("Failed to connect to listen for cache invalidations - %s", e)
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            closed = asyncio.Event()
+            connection.add_termination_listener(lambda _: closed.set())
+            closing = asyncio.ensure_future(closed.wait())
+            payload: Optional[str] = None
+            try:
+                await connection.add_listener(channel, cls._on_notify)
+                cls.clear_all()
+
+                # Send our own invalidations until the connection drops
+                while True:
+                    getting = asyncio.ensure_future(outbox.get())
+                    await asyncio.wait({getting, closing}, return_when=asyncio.FIRST_COMPLETED)
+                    if not getting.done():
+                        getting.cancel()
+                        break
+                    payload = getting.result()
+                    await connection.execute("SELECT pg_notify($1, $2)", channel, payload)
+                    payload = None
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                log.warning("Lost the cache invalidation connection - %s", e)
+            finally:
+                closing.cancel()
+                if payload is not None:
+                    outbox.put_nowait(payload)
+                if not connection.is_closed():
+                    await connection.close()
+
+            # Anything could have changed while we weren't listening
+            cls.clear_all()
+            log.warning("Cache invalidation connection closed, reconnecting")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+ROLES_CACHE = OwnerCache("roles")
+PEOPLE_CACHE = OwnerCache("people")
+VENUES_CACHE = OwnerCache("venues")
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+from datetime import timedelta
+from typing import TYPE_CHECKING, Any, Hashable, Optional
+
+from .availability import AVAILABILITY_STATES, AVAILABLE, PREFERRED_NOT, UNAVAILABLE, UNFILLED
+
+if TYPE_CHECKING:
+    from discord.ext import vbu
+
+    from .roles import RoleTree
+
+
+__all__ = (
+    "Coverage",
+)
+
+
+class Coverage:
+    """
+    How many people can fill each role on each day of an availability
+    period, and how many positions the period's rotas need filled.
+
+    People are counted against their own role and every role above it
+    (since they can fill positions with any of those roles), and everyone
+    is counted under None, for positions that have no role. Positions are
+    rolled up the same way, since a position for a Senior Bartender has
+    to be filled from the same people as a Bartender position - so each
+    role's demand is every position that only people counted under it can
+    fill.
+
+    Attributes
+    -----------
+    start_date: datetime
+        The start of the period.
+    end_date: datetime
+        The end of the period.
+    days: int
+        The number of days in the period.
+    tree: RoleTree
+        The owner's roles.
+    counts: dict[Optional[UUID], list[list[int]]]
+        For each role, the number of people in each state (indexed by
+        code, so ``counts[role_id][AVAILABLE][day]``) on each day.
+    demand: dict[Optional[UUID], int]
+        The number of positions with each role or one below it, across
+        every rota for the period. Every position needs filling every day.
+    """
+
+    def __init__(self, start_date: Any, end_date: Any, tree: RoleTree):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.days = max((end_date.date() - start_date.date()).days + 1, 0)
+        self.tree = tree
+        self.counts: dict[Optional[Hashable], list[list[int]]] = {
+            role_id: [[0] * self.days for _ in AVAILABILITY_STATES]
+            for role_id in [None, *tree.parents]
+        }
+        self.demand: dict[Optional[Hashable], int] = dict.fromkeys(self.counts, 0)
+
+    def add_counts(self, role_id: Any, day: int, code: int, count: int) -> None:
+        """
+        Add people with the given role who are in a state on a day, rolling
+        them up into every role above theirs.
+        """
+
+        for i in [None, *self.tree.ancestors.get(role_id, ())]:
+            self.counts[i][code][day] += count
+
+    @classmethod
+    async def fetch(
+            cls,
+            db: vbu.Database,
+            availability_id: Any,
+            owner_id: Any,
+            tree: RoleTree) -> Optional[Coverage]:
+        """
+        Work out the coverage for a period, with the day counts done by the
+        database in a single aggregate query. Returns None if the period
+        doesn't exist (or isn't owned by the given owner).
+        """
+
+        period_rows = await db.call(
+            """
+            SELECT
+                start_date,
+                end_date
+            FROM
+                availability
+            WHERE
+                id = $1
+            AND
+                owner_id = $2
+            """,
+            availability_id, owner_id,
+        )
+        if not period_rows:
+            return None
+        coverage = cls(period_rows[0]["start_date"], period_rows[0]["end_date"], tree)
+
+        # Count everyone's states for each day, grouped by their role
+        count_rows = await db.call(
+            """
+            SELECT
+                people.role_id,
+                days.day,
+                CASE
+                    WHEN days.day / 4 < LENGTH(filled_availability.availability)
+                    THEN (GET_BYTE(filled_availability.availability, days.day / 4) >> (days.day % 4 * 2)) & 3
+                    ELSE 0
+                END AS code,
+                COUNT(*) AS count
+            FROM
+                filled_availability
+            JOIN
+                people
+            ON
+                people.id = filled_availability.person_id
+            CROSS JOIN
+                GENERATE_SERIES(0, $2::INTEGER - 1) AS days(day)
+            WHERE
+                filled_availability.availability_id = $1
+            GROUP BY
+                people.role_id,
+                days.day,
+                code
+            """,
+            availability_id, coverage.days,
+        )
+        for r in count_rows:
+            coverage.add_counts(r["role_id"], r["day"], r["code"], r["count"])
+
+        # And how many positions need filling
+        demand_rows = await db.call(
+            """
+            SELECT
+                venue_positions.role_id,
+                COUNT(*) AS count
+            FROM
+                rotas
+            JOIN
+                venue_positions
+            ON
+                venue_positions.rota_id = rotas.id
+            WHERE
+                rotas.availability_id = $1
+            AND
+                rotas.owner_id = $2
+            GROUP BY
+                venue_positions.role_id
+            """,
+            availability_id, owner_id,
+        )
+        for r in demand_rows:
+            for i in [None, *tree.ancestors.get(r["role_id"], ())]:
+                coverage.demand[i] += r["count"]
+        return coverage
+
+    def shortage(self, role_id: Any, *, include_preferred_not: bool = False) -> list[int]:
+        """
+        Get how many positions with a role couldn't be filled on each day,
+        even if everyone who could fill them was put there. People who'd
+        prefer not to work are only counted if ``include_preferred_not`` is
+        set.
+        """
+
+        demand = self.demand[role_id]
+        counts = self.counts[role_id]
+        if include_preferred_not:
+            return [
+                max(demand - available - preferred_not, 0)
+                for available, preferred_not in zip(counts[AVAILABLE], counts[PREFERRED_NOT])
+            ]
+        return [max(demand - i, 0) for i in counts[AVAILABLE]]
+
+    def to_json(self) -> dict[str, Any]:
+        """
+        Get the coverage for every role (with positions that need no role
+        first, under a None ID), with each count as a list with one number
+        per day.
+        """
+
+        start = self.start_date.date()
+        role_ids = [None, *sorted(self.tree.parents, key=lambda i: self.tree.names[i].lower())]
+        roles = []
+        for role_id in role_ids:
+            counts = self.counts[role_id]
+            shortage = self.shortage(role_id)
+            roles.append({
+                "id": role_id,
+                "name": self.tree.names[role_id] if role_id is not None else None,
+                "parent": self.tree.parents[role_id] if role_id is not None else None,
+                "demand": self.demand[role_id],
+                "available": counts[AVAILABLE],
+                "preferred_not": counts[PREFERRED_NOT],
+                "unavailable": counts[UNAVAILABLE],
+                "unfilled": counts[UNFILLED],
+                "shortage": shortage,
+                "shortage_with_preferred_not": self.shortage(role_id, include_preferred_not=True),
+                "short_days": sum(1 for i in shortage if i),
+            })
+        return {
+            "start": self.start_date,
+            "end": self.end_date,
+            "dates": [start + timedelta(days=i) for i in range(self.days)],
+            "roles": roles,
+        }
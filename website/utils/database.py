@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterator, ClassVar, Optional
+
+import asyncpg
+from discord.ext import vbu
+import toml
+
+from .instrumentation import record_query
+
+
+__all__ = (
+    "Database",
+)
+
+
+log = logging.getLogger("rotaroamer.database")
+
+
+# The pool options that can be set in the [database] section of the website
+# config, and their defaults. VBU ignores these keys when it makes its own
+# pool at startup.
+POOL_DEFAULTS: dict[str, Any] = {
+    "pool_min_size": 2,
+    "pool_max_size": 20,
+    "pool_acquire_timeout": 10.0,
+    "pool_max_inactive_connection_lifetime": 300.0,
+    "statement_cache_size": 512,
+    "pool_saturation_warning": 0.25,  # Seconds waiting on an acquire before we log it
+}
+CONNECTION_KEYS = ("host", "port", "database", "user", "password",)
+
+
+class Database(vbu.Database):
+    """
+    A drop-in for ``vbu.Database`` that hands out connections from a tuned,
+    long-lived pool.
+
+    VBU creates its pool with asyncpg's defaults. This class keeps its own
+    pool, built from the pool options in the website config by
+    :meth:`tune_pool`, which should be awaited once at startup (it's run on
+    first use otherwise). ``vbu.Database`` keeps VBU's pool, so every
+    connection always goes back to the pool it came from. Every query sent
+    through ``.call`` is parsed once per connection and then reused from
+    asyncpg's statement cache, whose size is set here too.
+
+    Acquiring a connection waits at most ``pool_acquire_timeout`` seconds,
+    and waits longer than ``pool_saturation_warning`` are logged. Call
+    :meth:`pool_stats` for the current usage of the pool.
+
+    Queries run through ``.call``, ``.executemany``, and ``.stream``
+    (including inside transactions) are timed and added to the current
+    request's :class:`QueryStats`.
+    """
+
+    config_file: ClassVar[str] = "config/website.toml"
+    pool_options: ClassVar[dict[str, Any]] = POOL_DEFAULTS.copy()
+    pool: ClassVar[Optional[asyncpg.Pool]] = None  # type: ignore
+    tuned: ClassVar[bool] = False
+    _tune_lock: ClassVar[Optional[asyncio.Lock]] = None
+    _stats: ClassVar[dict[str, Any]] = {
+        "acquired": 0,
+        "waiting": 0,
+        "timeouts": 0,
+        "slow_acquires": 0,
+        "max_wait": 0.0,
+    }
+
+    @classmethod
+    def load_pool_options(cls) -> dict[str, Any]:
+        """
+        Read the pool options from the website config file, falling back to
+        the defaults for anything that isn't set.
+        """
+
+        try:
+            with open(cls.config_file) as a:
+                database_config = toml.load(a).get("database", {})
+        except OSError:
+            database_config = {}
+        return {
+            i: database_config.get(i, o)
+            for i, o in POOL_DEFAULTS.items()
+        }
+
+    @classmethod
+    async def tune_pool(cls) -> None:
+        """
+        Create our connection pool from the pool options, once VBU's pool
+        has been made (which is where the connection details come from).
+        """
+
+        if cls._tune_lock is None:
+            cls._tune_lock = asyncio.Lock()
+        async with cls._tune_lock:
+            if cls.tuned:
+                return
+            options = cls.pool_options = cls.load_pool_options()
+            assert vbu.Database.config, "The database pool hasn't been created."
+            pool = await asyncpg.create_pool(
+                **{
+                    i: o
+                    for i, o in vbu.Database.config.items()
+                    if i in CONNECTION_KEYS
+                },
+                min_size=options["pool_min_size"],
+                max_size=options["pool_max_size"],
+                max_inactive_connection_lifetime=options["pool_max_inactive_connection_lifetime"],
+                statement_cache_size=options["statement_cache_size"],
+            )
+            cls.pool = pool
+            cls.tuned = True
+
+    @classmethod
+    async def get_connection(cls) -> Database:
+        if not cls.tuned:
+            await cls.tune_pool()
+        pool = cls.pool
+        assert pool is not None
+        stats = cls._stats
+        stats["waiting"] += 1
+        start = time.perf_counter()
+        try:
+            connection = await pool.acquire(
+                timeout=cls.pool_options["pool_acquire_timeout"],
+            )
+        except asyncio.TimeoutError:
+            stats["timeouts"] += 1
+            log.error("Timed out acquiring a database connection - %s", cls.pool_stats())
+            raise
+        finally:
+            stats["waiting"] -= 1
+        waited = time.perf_counter() - start
+        stats["acquired"] += 1
+        stats["max_wait"] = max(stats["max_wait"], waited)
+        if waited > cls.pool_options["pool_saturation_warning"]:
+            stats["slow_acquires"] += 1
+            log.warning(
+                "Waited %.3fs to acquire a database connection - %s",
+                waited, cls.pool_stats(),
+            )
+        v = cls(conn=connection)
+        v.is_active = True
+        return v
+
+    @classmethod
+    def pool_stats(cls) -> dict[str, Any]:
+        """
+        Get the current size and usage of the pool, along with counters for
+        how often (and how long) requests have had to wait for it.
+        """
+
+        pool = cls.pool
+        size = pool.get_size() if pool else 0
+        idle = pool.get_idle_size() if pool else 0
+        return {
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+            "max_size": cls.pool_options["pool_max_size"],
+            **cls._stats,
+        }
+
+    async def call(self, sql: str, *args: Any, **kwargs: Any) -> list[Any]:
+        start = time.perf_counter()
+        rows = None
+        try:
+            rows = await super().call(sql, *args, **kwargs)
+            return rows
+        finally:
+            record_query(sql, time.perf_counter() - start, rows)
+
+    async def executemany(self, sql: str, *args_list: Any) -> None:
+        start = time.perf_counter()
+        try:
+            return await super().executemany(sql, *args_list)
+        finally:
+            record_query(sql, time.perf_counter() - start, None)
+
+    async def stream(self, sql: str, *args: Any, prefetch: Optional[int] = None) -> AsyncIterator[Any]:
+        """
+        Yield the rows of a query from a server side cursor, ``prefetch``
+        at a time. This has to be run inside a transaction. The time spent
+        waiting on the database and the rows read are recorded as a single
+        query once the cursor is finished with.
+        """
+
+        conn: asyncpg.Connection = self.conn  # type: ignore
+        rows = conn.cursor(sql, *args, prefetch=prefetch).__aiter__()
+        duration = 0.0
+        count = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    row = await rows.__anext__()
+                except StopAsyncIteration:
+                    return
+                finally:
+                    duration += time.perf_counter() - start
+                count += 1
+                yield row
+        finally:
+            record_query(sql, duration, count)
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+from datetime import date, datetime as dt, time
+from decimal import Decimal
+import json
+from typing import Any, Optional
+import uuid
+
+from aiohttp.web import Response
+import asyncpg
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+__all__ = (
+    "dumps",
+    "json_response",
+)
+
+
+def _default(o: Any) -> Any:
+    """
+    Encode the types that the JSON backend doesn't handle itself.
+    """
+
+    if isinstance(o, asyncpg.Record):
+        return dict(o.items())
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    if isinstance(o, (dt, date, time)):
+        return o.isoformat()
+    if isinstance(o, Decimal):
+        return float(o)
+    if isinstance(o, (bytes, memoryview)):
+        return list(o)
+    if isinstance(o, (set, frozenset, tuple)):
+        return list(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+
+    def dumps(data: Any) -> bytes:
+        """
+        Encode data as JSON bytes. UUIDs, dates, and times are encoded
+        natively by orjson; database records are encoded as objects.
+        """
+
+        return orjson.dumps(
+            data,
+            default=_default,
+            option=orjson.OPT_NON_STR_KEYS,
+        )
+
+else:
+
+    _encoder = json.JSONEncoder(
+        default=_default,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+
+    def dumps(data: Any) -> bytes:
+        """
+        Encode data as JSON bytes. UUIDs, dates, and times are encoded as
+        strings; database records are encoded as objects.
+        """
+
+        return _encoder.encode(data).encode()
+
+
+def json_response(
+        data: Any,
+        *,
+        status: int = 200,
+        reason: Optional[str] = None,
+        headers: Optional[dict[str, str]] = None) -> Response:
+    """
+    A drop-in for aiohttp's ``json_response`` which encodes with
+    :func:`dumps`, so handlers can return rows, UUIDs, and dates without
+    converting them first.
+    """
+
+    return Response(
+        body=dumps(data),
+        status=status,
+        reason=reason,
+        headers=headers,
+        content_type="application/json",
+    )
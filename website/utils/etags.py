@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import functools
+import hashlib
+from typing import TYPE_CHECKING, Any, Iterable
+
+from aiohttp.web import Request, Response, StreamResponse
+
+from .database import Database
+from .middleware import get_context
+
+if TYPE_CHECKING:
+    from discord.ext import vbu
+
+    from .middleware import Handler
+
+
+__all__ = (
+    "fetch_versions",
+    "make_etag",
+    "etag_matches",
+    "get_versions",
+    "etag_headers",
+    "with_etag",
+)
+
+
+# Browsers may keep responses, but have to check they're still current
+# before using them. They're never shared, since they belong to one user.
+CACHE_CONTROL = "private, no-cache"
+
+
+async def fetch_versions(db: vbu.Database, owner_id: Any, names: Iterable[str]) -> dict[str, int]:
+    """
+    Get the current version of each of the given tables for an owner, which
+    is the number of changes they've made to it. Tables that they've never
+    changed are at version 0.
+    """
+
+    names = list(names)
+    rows = await db.call(
+        """
+        SELECT
+            name,
+            SUM(changes)::BIGINT AS version
+        FROM
+            owner_changes
+        WHERE
+            owner_id = $1
+        AND
+            name = ANY($2::TEXT[])
+        GROUP BY
+            name
+        """,
+        owner_id, names,
+    )
+    versions = dict.fromkeys(names, 0)
+    versions.update((r["name"], r["version"]) for r in rows)
+    return versions
+
+
+def make_etag(owner_id: Any, path: str, versions: dict[str, int]) -> str:
+    """
+    Make a (weak) ETag for what an owner gets from a path, given the
+    versions of the tables that it's built from.
+    """
+
+    key = "\n".join([
+        str(owner_id),
+        path,
+        *(f"{i}={o}" for i, o in sorted(versions.items())),
+    ])
+    return 'W/"{0}"'.format(hashlib.blake2b(key.encode(), digest_size=16).hexdigest())
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Whether an ``If-None-Match`` header matches the given ETag, using the
+    weak comparison that HTTP asks for.
+    """
+
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(
+        i.strip().removeprefix("W/") == opaque
+        for i in if_none_match.split(",")
+    )
+
+
+def get_versions(request: Request) -> dict[str, int]:
+    """
+    Get the table versions that a request's ETag was made from, as set by
+    :func:`with_etag`.
+    """
+
+    try:
+        return request["versions"]
+    except KeyError:
+        raise RuntimeError("Table versions are missing - is the route using utils.with_etag?")
+
+
+def etag_headers(request: Request) -> dict[str, str]:
+    """
+    Get the headers to send the request's ETag with, for responses that are
+    prepared before :func:`with_etag` gets to add them.
+    """
+
+    if "etag" not in request:
+        return {}
+    return {
+        "ETag": request["etag"],
+        "Cache-Control": CACHE_CONTROL,
+    }
+
+
+def with_etag(*names: str):
+    """
+    Give successful responses an ETag made from the versions of the named
+    tables, and answer requests whose ``If-None-Match`` still matches with a
+    304 before the handler runs. The versions are available to the handler
+    through :func:`get_versions`, for caching against.
+
+    This has to go after :func:`requires_login`.
+    """
+
+    def outer(func: Handler) -> Handler:
+        @functools.wraps(func)
+        async def inner(request: Request):
+
+            # Work out the ETag
+            login_id = get_context(request).login_id
+            async with Database() as db:
+                versions = await fetch_versions(db, login_id, names)
+            etag = make_etag(login_id, request.path_qs, versions)
+            request["versions"] = versions
+            request["etag"] = etag
+
+            # See if they already have it
+            if etag_matches(request.headers.get("If-None-Match", ""), etag):
+                return Response(status=304, headers=etag_headers(request))
+
+            # They don't
+            response = await func(request)
+            if (
+                    isinstance(response, StreamResponse)
+                    and response.status == 200
+                    and not response.prepared):
+                response.headers.update(etag_headers(request))
+            return response
+        return inner
+    return outer
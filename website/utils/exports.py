@@ -0,0 +1,493 @@
+from __future__ import annotations
+
+import csv
+from datetime import date, datetime as dt, timedelta, timezone
+import io
+import re
+from typing import TYPE_CHECKING, Any, AsyncIterator, Iterable, Iterator, Optional
+from xml.sax.saxutils import escape
+import zipfile
+
+from aiohttp.web import Request, StreamResponse
+
+if TYPE_CHECKING:
+    import asyncpg
+
+    from .database import Database
+
+
+__all__ = (
+    "EXPORT_FORMATS",
+    "CsvWriter",
+    "XlsxWriter",
+    "write_export",
+    "stream_rota_rows",
+    "stream_person_shifts",
+    "ics_lines",
+    "write_ics",
+)
+
+
+# How many rows to read from the database (and write out) at once when
+# streaming an export, and how many bytes of a calendar to buffer before
+# writing it
+EXPORT_BATCH_SIZE = 500
+EXPORT_FLUSH_SIZE = 64 * 1024
+
+# Spreadsheet apps run cells starting with these as formulas, so text that
+# starts with them is written with a leading quote instead
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+# Characters that can't go into XML at all
+XML_INVALID_REGEX = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+
+def _cell_text(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, (dt, date)):
+        return value.isoformat()
+    return str(value)
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """
+    A write-only file that keeps what's written to it until it's taken,
+    for writing a zip file out a piece at a time. It can't seek, so zipfile
+    writes each member's sizes after its data.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        self.data += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def take(self) -> bytes:
+        data = bytes(self.data)
+        self.data.clear()
+        return data
+
+
+class CsvWriter:
+    """
+    Write rows as CSV, keeping the output until it's taken so that it can be
+    sent in pieces.
+    """
+
+    content_type = "text/csv; charset=utf-8"
+    extension = "csv"
+
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def write_row(self, row: Iterable[Any]) -> None:
+        cells = []
+        for value in row:
+            text = _cell_text(value)
+            if isinstance(value, str) and text.startswith(FORMULA_PREFIXES):
+                text = "'" + text
+            cells.append(text)
+        self.writer.writerow(cells)
+
+    def take(self) -> bytes:
+        data = self.buffer.getvalue().encode()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+    def close(self) -> bytes:
+        return self.take()
+
+
+class XlsxWriter:
+    """
+    Write rows as a single sheet XLSX workbook, keeping the output until
+    it's taken so that it can be sent in pieces.
+
+    The sheet is deflated into the zip as each row is written, and text is
+    written inline rather than into a shared strings table, so the size of
+    the sheet never has to be known up front and nothing is held on to
+    once it's been taken.
+    """
+
+    content_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    extension = "xlsx"
+
+    STATIC_PARTS = {
+        "[Content_Types].xml": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>'
+        ),
+        "_rels/.rels": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        ),
+        "xl/workbook.xml": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="{sheet_name}" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        ),
+        "xl/_rels/workbook.xml.rels": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            'Target="worksheets/sheet1.xml"/>'
+            '</Relationships>'
+        ),
+    }
+
+    def __init__(self, sheet_name: str = "Sheet1"):
+        self.output = _ChunkBuffer()
+        self.zip = zipfile.ZipFile(self.output, "w", zipfile.ZIP_DEFLATED)
+        for name, content in self.STATIC_PARTS.items():
+            self.zip.writestr(name, content.replace("{sheet_name}", escape(sheet_name[:31])))
+        self.sheet = self.zip.open("xl/worksheets/sheet1.xml", "w")
+        self.sheet.write(
+            b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            b'<sheetData>'
+        )
+        self.rows = 0
+        self.columns: list[str] = []
+
+    def column(self, index: int) -> str:
+        """
+        Get the letters for a column, eg 0 is "A" and 27 is "AB".
+        """
+
+        while len(self.columns) <= index:
+            number = len(self.columns) + 1
+            letters = ""
+            while number:
+                number, remainder = divmod(number - 1, 26)
+                letters = chr(65 + remainder) + letters
+            self.columns.append(letters)
+        return self.columns[index]
+
+    def write_row(self, row: Iterable[Any]) -> None:
+        self.rows += 1
+        cells = []
+        for index, value in enumerate(row):
+            if value is None or value == "":
+                continue
+            ref = f"{self.column(index)}{self.rows}"
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                cells.append(f'<c r="{ref}"><v>{value}</v></c>')
+            else:
+                text = escape(XML_INVALID_REGEX.sub("", _cell_text(value)))
+                cells.append(f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+        self.sheet.write(f'<row r="{self.rows}">{"".join(cells)}</row>'.encode())
+
+    def take(self) -> bytes:
+        return self.output.take()
+
+    def close(self) -> bytes:
+        self.sheet.write(b"</sheetData></worksheet>")
+        self.sheet.close()
+        self.zip.close()
+        return self.take()
+
+
+EXPORT_FORMATS = {
+    i.extension: i
+    for i in (CsvWriter, XlsxWriter)
+}
+
+
+async def write_export(
+        request: Request,
+        header: list[str],
+        rows: AsyncIterator[Iterable[Any]],
+        export_format: str,
+        filename: str) -> StreamResponse:
+    """
+    Stream rows to the client as a download in the given format (one of
+    :data:`EXPORT_FORMATS`), sending them on in pieces as they're read.
+    """
+
+    writer = EXPORT_FORMATS[export_format]()
+    response = StreamResponse(
+        status=200,
+        headers={
+            "Content-Type": writer.content_type,
+            "Content-Disposition": f'attachment; filename="{filename}.{writer.extension}"',
+        },
+    )
+    await response.prepare(request)
+    writer.write_row(header)
+    buffered = 0
+    async for row in rows:
+        writer.write_row(row)
+        buffered += 1
+        if buffered >= EXPORT_BATCH_SIZE:
+            if (data := writer.take()):
+                await response.write(data)
+            buffered = 0
+    await response.write(writer.close())
+    await response.write_eof()
+    return response
+
+
+async def stream_rota_rows(
+        db: Database,
+        owner_id: Any,
+        rota_id: Any,
+        *,
+        prefetch: int = EXPORT_BATCH_SIZE) -> AsyncIterator[list[Any]]:
+    """
+    Yield a row for every position on every day of a rota, with who's been
+    put into it (if anyone), ordered by day, venue, and position. Rows are
+    read from a server side cursor so that only ``prefetch`` of them are
+    held in memory at once.
+    """
+
+    conn: asyncpg.Connection = db.conn  # type: ignore
+    async with conn.transaction(readonly=True):
+        rows = db.stream(
+            """
+            SELECT
+                days.date::DATE AS date,
+                venues.name AS venue_name,
+                roles.name AS role_name,
+                venue_positions.start_time,
+                venue_positions.end_time,
+                (venue_positions.end_minute - venue_positions.start_minute) / 60.0::FLOAT AS hours,
+                people.name AS person_name,
+                people.email AS person_email,
+                venue_positions.notes
+            FROM
+                rotas
+            JOIN
+                availability
+            ON
+                availability.id = rotas.availability_id
+            CROSS JOIN
+                GENERATE_SERIES(
+                    availability.start_date::DATE,
+                    availability.end_date::DATE,
+                    INTERVAL '1 day'
+                ) AS days(date)
+            JOIN
+                venue_positions
+            ON
+                venue_positions.rota_id = rotas.id
+            JOIN
+                venues
+            ON
+                venues.id = venue_positions.venue_id
+            LEFT JOIN
+                roles
+            ON
+                roles.id = venue_positions.role_id
+            LEFT JOIN
+                assignments
+            ON
+                assignments.position_id = venue_positions.id
+            AND
+                assignments.date = days.date::DATE
+            LEFT JOIN
+                people
+            ON
+                people.id = assignments.person_id
+            WHERE
+                rotas.owner_id = $1
+            AND
+                rotas.id = $2
+            ORDER BY
+                days.date ASC,
+                venues.index ASC,
+                venue_positions.index ASC
+            """,
+            owner_id, rota_id,
+            prefetch=prefetch,
+        )
+        async for r in rows:
+            yield list(r.values())
+
+
+async def stream_person_shifts(
+        db: Database,
+        person_id: Any,
+        *,
+        owner_id: Any = None,
+        availability_id: Any = None,
+        prefetch: int = EXPORT_BATCH_SIZE) -> AsyncIterator[asyncpg.Record]:
+    """
+    Yield every shift a person has been put into (or just those in one
+    availability period), ordered by date, from a server side cursor.
+    """
+
+    conn: asyncpg.Connection = db.conn  # type: ignore
+    async with conn.transaction(readonly=True):
+        rows = db.stream(
+            """
+            SELECT
+                assignments.position_id,
+                assignments.date,
+                venues.name AS venue_name,
+                roles.name AS role_name,
+                venue_positions.start_minute,
+                venue_positions.end_minute,
+                venue_positions.start_time,
+                venue_positions.end_time,
+                venue_positions.notes
+            FROM
+                assignments
+            JOIN
+                venue_positions
+            ON
+                venue_positions.id = assignments.position_id
+            JOIN
+                venues
+            ON
+                venues.id = venue_positions.venue_id
+            LEFT JOIN
+                roles
+            ON
+                roles.id = venue_positions.role_id
+            WHERE
+                assignments.person_id = $1
+            AND
+                ($2::UUID IS NULL OR assignments.owner_id = $2)
+            AND
+                ($3::UUID IS NULL OR assignments.availability_id = $3)
+            ORDER BY
+                assignments.date ASC
+            """,
+            person_id, owner_id, availability_id,
+            prefetch=prefetch,
+        )
+        async for r in rows:
+            yield r
+
+
+def _ics_text(value: Optional[str]) -> str:
+    return (
+        (value or "")
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def _ics_fold(line: str) -> str:
+    """
+    Fold a content line so that no line is longer than 75 octets.
+    """
+
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    output = []
+    current = ""
+    limit = 75
+    for character in line:
+        if len((current + character).encode()) > limit:
+            output.append(current)
+            current = ""
+            limit = 74  # Continuation lines start with a space
+        current += character
+    output.append(current)
+    return "\r\n ".join(output) + "\r\n"
+
+
+def ics_lines(shift: asyncpg.Record, stamp: str) -> Iterator[str]:
+    """
+    Get the folded lines of the VEVENT for a shift. Shifts whose times
+    couldn't be parsed are all day events with their times in the summary.
+    """
+
+    summary = shift["venue_name"] or "Shift"
+    if shift["role_name"]:
+        summary = f"{summary} - {shift['role_name']}"
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{shift['position_id']}-{shift['date']:%Y%m%d}@rotaroamer",
+        f"DTSTAMP:{stamp}",
+    ]
+    if shift["start_minute"] is not None:
+        start = dt.combine(shift["date"], dt.min.time()) + timedelta(minutes=shift["start_minute"])
+        end = dt.combine(shift["date"], dt.min.time()) + timedelta(minutes=shift["end_minute"])
+        lines.append(f"DTSTART:{start:%Y%m%dT%H%M%S}")
+        lines.append(f"DTEND:{end:%Y%m%dT%H%M%S}")
+    else:
+        lines.append(f"DTSTART;VALUE=DATE:{shift['date']:%Y%m%d}")
+        lines.append(f"DTEND;VALUE=DATE:{shift['date'] + timedelta(days=1):%Y%m%d}")
+        if shift["start_time"] or shift["end_time"]:
+            summary = f"{summary} ({shift['start_time'] or '?'}-{shift['end_time'] or '?'})"
+    lines.append(f"SUMMARY:{_ics_text(summary)}")
+    if shift["notes"]:
+        lines.append(f"DESCRIPTION:{_ics_text(shift['notes'])}")
+    lines.append("END:VEVENT")
+    for line in lines:
+        yield _ics_fold(line)
+
+
+async def write_ics(
+        request: Request,
+        name: str,
+        shifts: AsyncIterator[asyncpg.Record],
+        filename: str) -> StreamResponse:
+    """
+    Stream shifts to the client as an iCalendar feed, sending them on in
+    pieces as they're read. Times are floating (local to wherever the
+    shift is), since that's how they're entered.
+    """
+
+    response = StreamResponse(
+        status=200,
+        headers={
+            "Content-Type": "text/calendar; charset=utf-8",
+            "Content-Disposition": f'attachment; filename="{filename}.ics"',
+        },
+    )
+    await response.prepare(request)
+    stamp = f"{dt.now(timezone.utc):%Y%m%dT%H%M%SZ}"
+    buffer = "".join([
+        "BEGIN:VCALENDAR\r\n",
+        "VERSION:2.0\r\n",
+        "PRODID:-//RotaRoamer//Shifts//EN\r\n",
+        "CALSCALE:GREGORIAN\r\n",
+        _ics_fold(f"X-WR-CALNAME:{_ics_text(name)}"),
+    ])
+    parts = [buffer]
+    size = len(buffer)
+    async for shift in shifts:
+        for line in ics_lines(shift, stamp):
+            parts.append(line)
+            size += len(line)
+        if size >= EXPORT_FLUSH_SIZE:
+            await response.write("".join(parts).encode())
+            parts.clear()
+            size = 0
+    parts.append("END:VCALENDAR\r\n")
+    await response.write("".join(parts).encode())
+    await response.write_eof()
+    return response
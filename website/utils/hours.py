@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Optional
+
+if TYPE_CHECKING:
+    from discord.ext import vbu
+    import asyncpg
+
+
+__all__ = (
+    "fetch_person_hours",
+    "fetch_hour_warnings",
+)
+
+
+def _hours_row(r: asyncpg.Record) -> dict[str, Any]:
+    maximum_minutes = r["maximum_working_hours"] * 60
+    return {
+        "person": r["person_id"],
+        "name": r["name"],
+        "availability": r["availability_id"],
+        "minutes": r["minutes"],
+        "shifts": r["shifts"],
+        "maximum_minutes": maximum_minutes,
+        "over": bool(maximum_minutes) and r["minutes"] > maximum_minutes,
+    }
+
+
+async def fetch_person_hours(
+        db: vbu.Database,
+        owner_id: Any,
+        *,
+        availability_id: Optional[Any] = None,
+        person_id: Optional[Any] = None) -> list[dict[str, Any]]:
+    """
+    Get how long each of an owner's people has been put to work for in each
+    availability period, across every rota for it, from the hours ledger.
+    Can be narrowed down to a single period and/or person. People with no
+    shifts in a period aren't included.
+    """
+
+    rows = await db.call(
+        """
+        SELECT
+            person_hours.availability_id,
+            person_hours.person_id,
+            person_hours.minutes,
+            person_hours.shifts,
+            people.name,
+            people.maximum_working_hours
+        FROM
+            person_hours
+        JOIN
+            people
+        ON
+            people.id = person_hours.person_id
+        WHERE
+            people.owner_id = $1
+        AND
+            ($2::UUID IS NULL OR person_hours.availability_id = $2)
+        AND
+            ($3::UUID IS NULL OR person_hours.person_id = $3)
+        AND
+            person_hours.shifts > 0
+        ORDER BY
+            people.name ASC,
+            people.id ASC,
+            person_hours.availability_id ASC
+        """,
+        owner_id, availability_id, person_id,
+    )
+    return [_hours_row(r) for r in rows]
+
+
+async def fetch_hour_warnings(
+        db: vbu.Database,
+        owner_id: Any,
+        rota_id: Any) -> list[dict[str, Any]]:
+    """
+    Get everyone who's been put to work for longer than their maximum
+    working hours in a rota's period, counting every rota for the period.
+    """
+
+    rows = await db.call(
+        """
+        SELECT
+            person_hours.availability_id,
+            person_hours.person_id,
+            person_hours.minutes,
+            person_hours.shifts,
+            people.name,
+            people.maximum_working_hours
+        FROM
+            rotas
+        JOIN
+            person_hours
+        ON
+            person_hours.availability_id = rotas.availability_id
+        JOIN
+            people
+        ON
+            people.id = person_hours.person_id
+        WHERE
+            rotas.owner_id = $1
+        AND
+            rotas.id = $2
+        AND
+            people.maximum_working_hours > 0
+        AND
+            person_hours.minutes > people.maximum_working_hours * 60
+        ORDER BY
+            people.name ASC,
+            people.id ASC
+        """,
+        owner_id, rota_id,
+    )
+    return [_hours_row(r) for r in rows]
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import contextvars
+import logging
+import re
+import time
+from typing import TYPE_CHECKING, Any, ClassVar, Optional
+
+from aiohttp import web
+import toml
+
+if TYPE_CHECKING:
+    from aiohttp.web import Request
+
+    from .middleware import Handler
+
+
+__all__ = (
+    "QueryStats",
+    "get_query_stats",
+    "record_query",
+    "query_stats_middleware",
+)
+
+
+log = logging.getLogger("rotaroamer.queries")
+
+
+# The options that can be set in the [instrumentation] section of the
+# website config, and their defaults.
+INSTRUMENTATION_DEFAULTS: dict[str, Any] = {
+    "server_timing": True,  # Send the query stats to the browser as Server-Timing headers
+    "log_requests": True,  # Log the query stats for every request
+    "repeated_query_warning": 5,  # Warn when a request runs the same SQL more than this many times
+}
+WHITESPACE_REGEX = re.compile(r"\s+")
+
+_current_stats: contextvars.ContextVar[Optional[QueryStats]] = contextvars.ContextVar(
+    "_current_stats",
+    default=None,
+)
+
+
+class QueryStats:
+    """
+    The database queries made while handling a single request.
+
+    Attributes
+    -----------
+    count: int
+        How many queries were run.
+    duration: float
+        The total time spent waiting on queries, in seconds.
+    rows: int
+        The total number of rows returned.
+    slowest: Optional[tuple[str, float]]
+        The SQL of the slowest query and how long it took.
+    statements: dict[str, int]
+        How many times each statement was run, keyed by its SQL with the
+        whitespace collapsed.
+    """
+
+    __slots__ = ("count", "duration", "rows", "slowest", "statements",)
+
+    config_file: ClassVar[str] = "config/website.toml"
+    options: ClassVar[Optional[dict[str, Any]]] = None
+
+    def __init__(self):
+        self.count: int = 0
+        self.duration: float = 0.0
+        self.rows: int = 0
+        self.slowest: Optional[tuple[str, float]] = None
+        self.statements: dict[str, int] = {}
+
+    @classmethod
+    def load_options(cls) -> dict[str, Any]:
+        """
+        Read the instrumentation options from the website config file,
+        falling back to the defaults for anything that isn't set.
+        """
+
+        try:
+            with open(cls.config_file) as a:
+                instrumentation_config = toml.load(a).get("instrumentation", {})
+        except OSError:
+            instrumentation_config = {}
+        return {
+            i: instrumentation_config.get(i, o)
+            for i, o in INSTRUMENTATION_DEFAULTS.items()
+        }
+
+    @classmethod
+    def get_options(cls) -> dict[str, Any]:
+        if cls.options is None:
+            cls.options = cls.load_options()
+        return cls.options
+
+    def add(self, sql: str, duration: float, rows: int) -> None:
+        """
+        Record a query that's been run.
+        """
+
+        self.count += 1
+        self.duration += duration
+        self.rows += rows
+        if self.slowest is None or duration > self.slowest[1]:
+            self.slowest = (sql, duration)
+        key = WHITESPACE_REGEX.sub(" ", sql).strip()
+        self.statements[key] = self.statements.get(key, 0) + 1
+
+    def repeated(self, limit: int) -> dict[str, int]:
+        """
+        Get the statements that were run more than ``limit`` times.
+        """
+
+        return {
+            i: o
+            for i, o in self.statements.items()
+            if o > limit
+        }
+
+    def server_timing(self, total: float) -> str:
+        """
+        Get the stats as a ``Server-Timing`` header value, given the total
+        time taken by the request.
+        """
+
+        metrics = [
+            f'db;dur={self.duration * 1_000:.3f};desc="{self.count} queries, {self.rows} rows"',
+        ]
+        if self.slowest is not None:
+            metrics.append(f"db-slowest;dur={self.slowest[1] * 1_000:.3f}")
+        metrics.append(f"total;dur={total * 1_000:.3f}")
+        return ", ".join(metrics)
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "queries": self.count,
+            "db_ms": round(self.duration * 1_000, 3),
+            "rows": self.rows,
+            "slowest_ms": round(self.slowest[1] * 1_000, 3) if self.slowest else None,
+            "slowest_sql": WHITESPACE_REGEX.sub(" ", self.slowest[0]).strip() if self.slowest else None,
+        }
+
+
+def get_query_stats() -> Optional[QueryStats]:
+    """
+    Get the query stats for the request currently being handled, if there
+    is one.
+    """
+
+    return _current_stats.get()
+
+
+def record_query(sql: str, duration: float, rows: Any) -> None:
+    """
+    Add a query to the stats for the current request, if there is one.
+    ``rows`` is either the rows that were returned or how many there were.
+    """
+
+    stats = _current_stats.get()
+    if stats is None:
+        return
+    if isinstance(rows, list):
+        rows = len(rows)
+    stats.add(sql, duration, rows if isinstance(rows, int) else 0)
+
+
+async def query_stats_middleware(request: Request, handler: Handler) -> Any:
+    """
+    Count the queries each request makes, sending the totals back as a
+    ``Server-Timing`` header and logging them. Statements that are run over
+    and over in one request (usually a query in a loop that should be a
+    join) are logged as a warning.
+    """
+
+    options = QueryStats.get_options()
+    stats = QueryStats()
+    token = _current_stats.set(stats)
+    start = time.perf_counter()
+    response = None
+    try:
+        response = await handler(request)
+        return response
+    except web.HTTPException as e:
+        response = e
+        raise
+    finally:
+        _current_stats.reset(token)
+        total = time.perf_counter() - start
+
+        # Add the header, as long as it's not too late to
+        if (
+                options["server_timing"]
+                and isinstance(response, web.StreamResponse)
+                and not response.prepared):
+            response.headers["Server-Timing"] = stats.server_timing(total)
+
+        # Log the stats
+        status = response.status if isinstance(response, web.StreamResponse) else 500
+        if options["log_requests"]:
+            log.info(
+                "%s %s %s queries=%d db_ms=%.2f rows=%d slowest_ms=%.2f total_ms=%.2f",
+                request.method, request.path, status,
+                stats.count, stats.duration * 1_000, stats.rows,
+                stats.slowest[1] * 1_000 if stats.slowest else 0.0,
+                total * 1_000,
+                extra={
+                    "method": request.method,
+                    "path": request.path,
+                    "status": status,
+                    "total_ms": round(total * 1_000, 3),
+                    **stats.to_json(),
+                },
+            )
+        for sql, count in stats.repeated(options["repeated_query_warning"]).items():
+            log.warning(
+                "Possible N+1 query - %s %s ran the same statement %d times: %s",
+                request.method, request.path, count, sql[:500],
+                extra={
+                    "method": request.method,
+                    "path": request.path,
+                    "repeats": count,
+                    "sql": sql,
+                },
+            )
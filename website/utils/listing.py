@@ -0,0 +1,280 @@
+from __future__ import annotations
+
+import base64
+import binascii
+import json
+from typing import TYPE_CHECKING, Any, Mapping, NamedTuple, Optional
+import uuid
+
+import asyncpg
+
+if TYPE_CHECKING:
+    from discord.ext import vbu
+
+
+__all__ = (
+    "ListFilter",
+    "ListQuery",
+    "ListSpec",
+    "InvalidListQuery",
+)
+
+
+MAX_PAGE_SIZE = 500
+DEFAULT_PAGE_SIZE = 100
+
+
+class InvalidListQuery(ValueError):
+    """
+    Raised when the pagination, filter, or field parameters for a list
+    endpoint aren't valid. The message is safe to show to the user.
+    """
+
+
+class ListFilter(NamedTuple):
+    """
+    A filter that a list endpoint accepts as a query parameter.
+
+    Attributes
+    -----------
+    condition: str
+        The SQL condition, with ``{}`` where the parameter goes.
+    cast: str
+        The type that the (string) parameter is cast to.
+    prefix: bool
+        Whether the value is a prefix to match rather than an exact value.
+    """
+
+    condition: str
+    cast: str = "TEXT"
+    prefix: bool = False
+
+
+class ListQuery(NamedTuple):
+    """
+    The pagination, filter, and field parameters given to a list endpoint.
+    A limit of None means every row.
+    """
+
+    limit: Optional[int]
+    after: Optional[list[Optional[str]]]
+    fields: Optional[list[str]]
+    filters: dict[str, str]
+
+    def cache_key(self) -> tuple:
+        """
+        Get the query as something hashable, to cache its results under.
+        """
+
+        return (
+            self.limit,
+            tuple(self.after) if self.after is not None else None,
+            tuple(self.fields) if self.fields is not None else None,
+            tuple(sorted(self.filters.items())),
+        )
+
+
+def encode_cursor(values: list[Any]) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps([None if i is None else str(i) for i in values]).encode()
+    ).decode()
+
+
+def decode_cursor(cursor: str) -> list[Optional[str]]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        assert isinstance(values, list) and all(i is None or isinstance(i, str) for i in values)
+    except (AssertionError, binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidListQuery("Invalid page cursor.")
+    return values
+
+
+class ListSpec(NamedTuple):
+    """
+    Describes a keyset paginated list endpoint.
+
+    Rows are ordered by the ``order`` columns (the last of which should be
+    unique) and each page starts after the last row of the one before, so
+    pages stay stable as rows are added and removed and deep pages cost the
+    same as the first.
+
+    Attributes
+    -----------
+    columns: dict[str, str]
+        The output name of each column mapped to its SQL expression.
+    source: str
+        The table (and any joins) to select from.
+    order: list[tuple[str, str]]
+        The names of the columns to order by, with their SQL types.
+    filters: dict[str, ListFilter]
+        The filters that can be given as query parameters.
+    nullable: tuple[str, ...]
+        The names of the ``order`` columns that can be NULL. These sort
+        after every other value, as they do in Postgres.
+    """
+
+    columns: dict[str, str]
+    source: str
+    order: list[tuple[str, str]]
+    filters: dict[str, ListFilter]
+    nullable: tuple[str, ...] = ()
+
+    def after_condition(self, after: list[Optional[str]], args: list[Any]) -> str:
+        """
+        Build the SQL condition for the rows that come after the cursor,
+        adding its values to ``args``.
+        """
+
+        # A row comparison can use an index, so use it when there are no NULLs
+        if not self.nullable and None not in after:
+            placeholders = []
+            for value, (_, cast) in zip(after, self.order):
+                args.append(value)
+                placeholders.append(f"${len(args)}::TEXT::{cast}")
+            return "({0}) > ({1})".format(
+                ", ".join(self.columns[i] for i, _ in self.order),
+                ", ".join(placeholders),
+            )
+
+        # Otherwise spell the comparison out a column at a time, since
+        # comparing anything to NULL is NULL rather than true or false
+        equal: list[str] = []
+        branches: list[str] = []
+        for value, (name, cast) in zip(after, self.order):
+            column = self.columns[name]
+            if value is None:
+                equal.append(f"{column} IS NULL")
+                continue
+            args.append(value)
+            placeholder = f"${len(args)}::TEXT::{cast}"
+            greater = f"{column} > {placeholder}"
+            if name in self.nullable:
+                greater = f"({greater} OR {column} IS NULL)"
+            branches.append(" AND ".join(equal + [greater]))
+            equal.append(f"{column} = {placeholder}")
+        if not branches:
+            return "FALSE"
+        return "({0})".format(" OR ".join(f"({i})" for i in branches))
+
+    def parse(self, query: Mapping[str, str]) -> ListQuery:
+        """
+        Read the ``limit``, ``after``, ``fields``, and filter parameters
+        from a request's query string.
+        """
+
+        # Cursor
+        after = None
+        if query.get("after"):
+            after = decode_cursor(query["after"])
+            if len(after) != len(self.order):
+                raise InvalidListQuery("Invalid page cursor.")
+
+        # Page size - everything unless they've asked for pages
+        limit = None
+        if query.get("limit"):
+            try:
+                limit = int(query["limit"])
+                assert 0 < limit <= MAX_PAGE_SIZE
+            except (AssertionError, ValueError):
+                raise InvalidListQuery(f"Limit must be between 1 and {MAX_PAGE_SIZE}.")
+        elif after is not None:
+            limit = DEFAULT_PAGE_SIZE
+
+        # Fields to send back
+        fields = None
+        if query.get("fields"):
+            fields = list(dict.fromkeys(
+                i.strip()
+                for i in query["fields"].split(",")
+                if i.strip()
+            ))
+            unknown = set(fields) - set(self.columns)
+            if unknown:
+                raise InvalidListQuery(f"Unknown fields: {', '.join(sorted(unknown))}.")
+
+        # Filters
+        filters = {}
+        for name, list_filter in self.filters.items():
+            if not query.get(name):
+                continue
+            if list_filter.cast == "UUID":
+                try:
+                    uuid.UUID(query[name])
+                except ValueError:
+                    raise InvalidListQuery(f"Filter {name} is not a valid UUID.")
+            filters[name] = query[name]
+
+        return ListQuery(limit, after, fields, filters)
+
+    async def fetch(
+            self,
+            db: vbu.Database,
+            list_query: ListQuery,
+            *,
+            where: str,
+            args: list[Any]) -> tuple[list[Any], Optional[str]]:
+        """
+        Get a page of rows, returning the rows and the cursor for the next
+        page (or None if this is the last page). Only rows matching the
+        SQL condition ``where`` (using ``args``) are included.
+        """
+
+        # Build the conditions
+        args = list(args)
+        conditions = [where]
+        for name, value in list_query.filters.items():
+            list_filter = self.filters[name]
+            if list_filter.prefix:
+                value = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            args.append(value)
+            conditions.append(list_filter.condition.format(f"${len(args)}::TEXT::{list_filter.cast}"))
+        if list_query.after is not None:
+            conditions.append(self.after_condition(list_query.after, args))
+
+        # Select the requested fields as well as what we need for the cursor
+        selected = list(self.columns) if list_query.fields is None else list_query.fields
+        select = selected + [i for i, _ in self.order if i not in selected]
+        limit = ""
+        if list_query.limit is not None:
+            args.append(list_query.limit + 1)
+            limit = f"LIMIT ${len(args)}"
+        try:
+            rows = await db.call(
+                """
+                SELECT
+                    {0}
+                FROM
+                    {1}
+                WHERE
+                    {2}
+                ORDER BY
+                    {3}
+                {4}
+                """.format(
+                    ",\n                    ".join(f"{self.columns[i]} AS {i}" for i in select),
+                    self.source,
+                    "\n                AND\n                    ".join(conditions),
+                    ", ".join(f"{self.columns[i]} ASC" for i, _ in self.order),
+                    limit,
+                ),
+                *args,
+            )
+        except asyncpg.DataError:
+            raise InvalidListQuery("Invalid page cursor or filter value.")
+
+        # Work out the next page
+        cursor = None
+        if list_query.limit is not None and len(rows) > list_query.limit:
+            rows = rows[:list_query.limit]
+            cursor = encode_cursor([rows[-1][i] for i, _ in self.order])
+
+        # Only copy the rows if we need to drop the ordering columns
+        if len(select) == len(selected):
+            return rows, cursor
+        return [
+            {
+                i: r[i]
+                for i in selected
+            }
+            for r in rows
+        ], cursor
@@ -0,0 +1,308 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import hmac
+import ipaddress
+import time
+from typing import TYPE_CHECKING, Any, ClassVar, Iterable, Optional
+
+from aiohttp import web
+import toml
+
+from .cache import OwnerCache
+from .database import Database
+from .passwords import PasswordHasher
+
+if TYPE_CHECKING:
+    from aiohttp.web import Request
+
+    from .middleware import Handler
+
+
+__all__ = (
+    "Histogram",
+    "Metrics",
+    "metrics_middleware",
+)
+
+
+# The options that can be set in the [metrics] section of the website config,
+# and their defaults. Without a token /metrics can only be read from the
+# machine the website is running on.
+METRICS_DEFAULTS: dict[str, Any] = {
+    "token": "",  # If set, scrapes need an "Authorization: Bearer <token>" header
+    "loop_lag_interval": 0.5,  # Seconds between event loop lag checks
+}
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SESSION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Headers set by a reverse proxy, which means the request didn't really come
+# from the machine even though the connection did
+PROXY_HEADERS = ("X-Forwarded-For", "X-Real-IP", "Forwarded")
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{i}="{_escape(o)}"' for i, o in labels.items()) + "}"
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Histogram:
+    """
+    Counts of observed values in cumulative buckets, as Prometheus expects.
+    """
+
+    __slots__ = ("buckets", "counts", "sum", "count",)
+
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets: tuple[float, ...] = tuple(sorted(buckets))
+        self.counts: list[int] = [0] * len(self.buckets)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: dict[str, Any]) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': _number(bucket)})} {cumulative}")
+        lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {self.count}")
+        lines.append(f"{name}_sum{_labels(labels)} {_number(self.sum)}")
+        lines.append(f"{name}_count{_labels(labels)} {self.count}")
+        return lines
+
+
+class Metrics:
+    """
+    The metrics for this process, rendered in the Prometheus text format
+    by :meth:`render`.
+
+    Requests are recorded per route (by its pattern, such as
+    ``/fill/{id}``, rather than the actual path) by
+    :func:`metrics_middleware`, which also times loading the session and
+    starts a task that measures how late the event loop runs callbacks.
+    The database pool, password hashing queue, and owner caches are read
+    when the metrics are rendered.
+    """
+
+    config_file: ClassVar[str] = "config/website.toml"
+    options: ClassVar[Optional[dict[str, Any]]] = None
+    started: ClassVar[float] = time.time()
+    requests: ClassVar[dict[tuple[str, str, int], int]] = {}
+    request_latency: ClassVar[dict[tuple[str, str], Histogram]] = {}
+    session_load = Histogram(SESSION_BUCKETS)
+    loop_lag = Histogram(LOOP_LAG_BUCKETS)
+    last_loop_lag: ClassVar[float] = 0.0
+    _loop_monitor: ClassVar[Optional[asyncio.Task]] = None
+
+    @classmethod
+    def load_options(cls) -> dict[str, Any]:
+        """
+        Read the metrics options from the website config file, falling back
+        to the defaults for anything that isn't set.
+        """
+
+        try:
+            with open(cls.config_file) as a:
+                metrics_config = toml.load(a).get("metrics", {})
+        except OSError:
+            metrics_config = {}
+        return {
+            i: metrics_config.get(i, o)
+            for i, o in METRICS_DEFAULTS.items()
+        }
+
+    @classmethod
+    def get_options(cls) -> dict[str, Any]:
+        if cls.options is None:
+            cls.options = cls.load_options()
+        return cls.options
+
+    @classmethod
+    def observe_request(cls, method: str, route: str, status: int, duration: float) -> None:
+        key = (method, route, status)
+        cls.requests[key] = cls.requests.get(key, 0) + 1
+        histogram = cls.request_latency.get((method, route))
+        if histogram is None:
+            histogram = cls.request_latency[(method, route)] = Histogram(REQUEST_BUCKETS)
+        histogram.observe(duration)
+
+    @classmethod
+    def start_loop_monitor(cls) -> None:
+        """
+        Start measuring event loop lag, if we aren't already.
+        """
+
+        if cls._loop_monitor is not None and not cls._loop_monitor.done():
+            return
+        cls._loop_monitor = asyncio.create_task(cls._monitor_loop_lag())
+
+    @classmethod
+    async def _monitor_loop_lag(cls) -> None:
+        loop = asyncio.get_running_loop()
+        interval = cls.get_options()["loop_lag_interval"]
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            cls.last_loop_lag = max(loop.time() - start - interval, 0.0)
+            cls.loop_lag.observe(cls.last_loop_lag)
+
+    @classmethod
+    def is_allowed(cls, request: Request) -> bool:
+        """
+        Whether a request may read the metrics - either it has the token
+        or, if there's no token set, it came from this machine and not
+        through a proxy.
+        """
+
+        token = cls.get_options()["token"]
+        if token:
+            given = request.headers.get("Authorization", "")
+            return hmac.compare_digest(given.encode(), f"Bearer {token}".encode())
+        if any(i in request.headers for i in PROXY_HEADERS):
+            return False
+        try:
+            return ipaddress.ip_address(request.remote or "").is_loopback
+        except ValueError:
+            return False
+
+    @classmethod
+    def render(cls, app: Optional[web.Application] = None) -> str:
+        """
+        Get all of the metrics in the Prometheus text format. If the app is
+        given, every route it has gets a latency histogram even if it hasn't
+        been requested yet.
+        """
+
+        lines: list[str] = []
+
+        def metric(name: str, kind: str, description: str, values: Iterable[tuple[dict[str, Any], float]]) -> None:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in values:
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+        # Requests
+        if app is not None:
+            for route in app.router.routes():
+                canonical = route.resource.canonical if route.resource else None
+                if canonical is None or route.method in ("HEAD", "*"):
+                    continue
+                if (route.method, canonical) not in cls.request_latency:
+                    cls.request_latency[(route.method, canonical)] = Histogram(REQUEST_BUCKETS)
+        metric(
+            "rotaroamer_http_requests_total", "counter",
+            "Requests handled, by route and status.",
+            (
+                ({"method": method, "route": route, "status": status}, count)
+                for (method, route, status), count in sorted(cls.requests.items())
+            ),
+        )
+        lines.append("# HELP rotaroamer_http_request_duration_seconds Time taken to handle requests, by route.")
+        lines.append("# TYPE rotaroamer_http_request_duration_seconds histogram")
+        for (method, route), histogram in sorted(cls.request_latency.items()):
+            lines.extend(histogram.render(
+                "rotaroamer_http_request_duration_seconds",
+                {"method": method, "route": route},
+            ))
+
+        # Sessions and the event loop
+        lines.append("# HELP rotaroamer_session_load_seconds Time taken to load and decode the session cookie.")
+        lines.append("# TYPE rotaroamer_session_load_seconds histogram")
+        lines.extend(cls.session_load.render("rotaroamer_session_load_seconds", {}))
+        lines.append("# HELP rotaroamer_event_loop_lag_seconds How late the event loop ran a timed callback.")
+        lines.append("# TYPE rotaroamer_event_loop_lag_seconds histogram")
+        lines.extend(cls.loop_lag.render("rotaroamer_event_loop_lag_seconds", {}))
+        metric(
+            "rotaroamer_event_loop_lag_last_seconds", "gauge",
+            "The most recently measured event loop lag.",
+            [({}, cls.last_loop_lag)],
+        )
+
+        # The database pool
+        pool = Database.pool_stats()
+        for name, kind, description in (
+                ("size", "gauge", "Connections open in the database pool."),
+                ("idle", "gauge", "Idle connections in the database pool."),
+                ("in_use", "gauge", "Connections in use from the database pool."),
+                ("max_size", "gauge", "The most connections the database pool will open."),
+                ("waiting", "gauge", "Requests waiting for a database connection."),
+                ("max_wait", "gauge", "The longest wait for a database connection, in seconds."),
+                ("acquired", "counter", "Database connections acquired from the pool."),
+                ("timeouts", "counter", "Database connection acquires that timed out."),
+                ("slow_acquires", "counter", "Database connection acquires that took longer than the warning time.")):
+            metric_name = f"rotaroamer_db_pool_{name}"
+            if kind == "counter":
+                metric_name += "_total"
+            metric(metric_name, kind, description, [({}, pool[name])])
+
+        # Everything else
+        metric(
+            "rotaroamer_password_hash_pending", "gauge",
+            "Password hashes running or waiting to run.",
+            [({}, PasswordHasher.pending())],
+        )
+        caches = sorted(OwnerCache.caches.items())
+        for name, kind, description in (
+                ("entries", "gauge", "Entries in each owner cache."),
+                ("hits", "counter", "Reads answered from each owner cache."),
+                ("misses", "counter", "Reads that each owner cache sent to the database."),
+                ("evictions", "counter", "Entries dropped to keep each owner cache under its size."),
+                ("invalidations", "counter", "Times an owner's entries were dropped after a change.")):
+            metric_name = f"rotaroamer_cache_{name}"
+            if kind == "counter":
+                metric_name += "_total"
+            metric(
+                metric_name, kind, description,
+                [({"cache": i}, o.stats()[name]) for i, o in caches],
+            )
+        metric(
+            "rotaroamer_process_start_time_seconds", "gauge",
+            "When this process started, as a Unix timestamp.",
+            [({}, cls.started)],
+        )
+        return "\n".join(lines) + "\n"
+
+
+async def metrics_middleware(request: Request, handler: Handler) -> Any:
+    """
+    Record how long each request took and the status it finished with.
+    """
+
+    Metrics.start_loop_monitor()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        if isinstance(response, web.StreamResponse):
+            status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = request.match_info.route
+        canonical = route.resource.canonical if route.resource else "unmatched"
+        Metrics.observe_request(request.method, canonical, status, time.perf_counter() - start)
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import functools
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from aiohttp import web
+from aiohttp.web import Request, StreamResponse
+import aiohttp_session
+
+from .instrumentation import query_stats_middleware
+from .metrics import Metrics, metrics_middleware
+
+
+__all__ = (
+    "RequestContext",
+    "get_context",
+    "RouteTableDef",
+    "MIDDLEWARES",
+)
+
+
+Handler = Callable[[Request], Awaitable[Any]]
+Middleware = Callable[[Request, Handler], Awaitable[Any]]
+
+
+class RequestContext:
+    """
+    Everything we know about who's making a request, resolved once when the
+    request comes in.
+
+    Attributes
+    -----------
+    session: aiohttp_session.Session
+        The request's session.
+    login_id: Optional[str]
+        The ID of the logged in user, if there is one.
+    """
+
+    __slots__ = ("session", "login_id",)
+
+    def __init__(self, session: aiohttp_session.Session):
+        self.session = session
+        self.login_id: Optional[str] = session.get("id")
+
+    @property
+    def logged_in(self) -> bool:
+        return bool(self.login_id)
+
+
+def get_context(request: Request) -> RequestContext:
+    """
+    Get the context for a request, as set by :func:`context_middleware`.
+    """
+
+    try:
+        return request["context"]
+    except KeyError:
+        raise RuntimeError("Request context is missing - is the route using utils.RouteTableDef?")
+
+
+async def context_middleware(request: Request, handler: Handler) -> Any:
+    """
+    Load the session and logged in user for the request.
+    """
+
+    start = time.perf_counter()
+    session = await aiohttp_session.get_session(request)
+    Metrics.session_load.observe(time.perf_counter() - start)
+    request["context"] = RequestContext(session)
+    return await handler(request)
+
+
+# The middlewares that every route goes through, outermost first. These have
+# the same signature as aiohttp's new style middlewares, but since VBU creates
+# the app for us they're applied per route by RouteTableDef.
+MIDDLEWARES: list[Middleware] = [
+    metrics_middleware,
+    query_stats_middleware,
+    context_middleware,
+]
+
+
+def apply_middlewares(handler: Handler) -> Handler:
+    """
+    Wrap a handler in all of the middlewares.
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(request: Request) -> StreamResponse:
+        call = handler
+        for middleware in reversed(MIDDLEWARES):
+            call = functools.partial(middleware, handler=call)  # type: ignore
+        return await call(request)
+    return wrapper
+
+
+class RouteTableDef(web.RouteTableDef):
+    """
+    A route table whose handlers are all run through :data:`MIDDLEWARES`.
+    """
+
+    def route(self, method: str, path: str, **kwargs: Any) -> Callable[[Handler], Handler]:
+        register = super().route(method, path, **kwargs)
+
+        def inner(handler: Handler) -> Handler:
+            register(apply_middlewares(handler))  # type: ignore
+            return handler
+        return inner
@@ -0,0 +1,324 @@
+"""
+Apply the versioned migrations in ``config/migrations`` to the database.
+
+Migrations are named ``NNNN_description.pgsql`` and are applied in order of
+their number, with each applied version recorded in ``schema_migrations``.
+A migration is run inside a single transaction unless its first line is
+``-- transaction: off``, in which case each statement is run on its own;
+this is needed for ``CREATE INDEX CONCURRENTLY``, which lets indexes be
+built on a live database without blocking writes.
+
+Usage:
+    python -m website.utils.migrations [--config FILE] [--list] [--check]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+from typing import Any, NamedTuple
+import uuid
+
+import asyncpg
+import toml
+
+
+__all__ = (
+    "Migration",
+    "get_migrations",
+    "apply_migrations",
+    "check_hot_paths",
+)
+
+
+MIGRATION_DIRECTORY = "config/migrations"
+MIGRATION_FILENAME_REGEX = re.compile(r"^(?P<version>\d+)_(?P<name>\w+)\.pgsql$")
+CONCURRENT_INDEX_REGEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(?P<name>\w+)",
+    re.IGNORECASE,
+)
+
+PLACEHOLDER_ID = uuid.UUID(int=0)
+
+# The queries our handlers run on every dashboard load, and the tables that
+# they should never sequentially scan. Each is explained with placeholder
+# arguments as a generic plan while sequential scans are disabled, so any
+# "Seq Scan" (or index scan with no index condition) left in the plan means
+# there's no usable index for it.
+HOT_PATH_QUERIES: list[tuple[str, str, tuple[Any, ...]]] = [
+    (
+        "login",
+        "SELECT * FROM logins WHERE email = $1",
+        ("",),
+    ),
+    (
+        "versions",
+        "SELECT name, changes FROM owner_changes WHERE owner_id = $1 AND name = $2",
+        (PLACEHOLDER_ID, ""),
+    ),
+    (
+        "roles",
+        "SELECT id, name, parent_id FROM roles WHERE owner_id = $1",
+        (PLACEHOLDER_ID,),
+    ),
+    (
+        "people",
+        "SELECT id, name, email, role_id FROM people WHERE owner_id = $1",
+        (PLACEHOLDER_ID,),
+    ),
+    (
+        "availability",
+        "SELECT id, start_date, end_date FROM availability WHERE owner_id = $1",
+        (PLACEHOLDER_ID,),
+    ),
+    (
+        "user_availability",
+        "SELECT id, person_id, availability FROM filled_availability WHERE availability_id = $1",
+        (PLACEHOLDER_ID,),
+    ),
+    (
+        "rotas",
+        "SELECT id, availability_id FROM rotas WHERE owner_id = $1",
+        (PLACEHOLDER_ID,),
+    ),
+    (
+        "rota_venues",
+        """
+        SELECT venues.id, venue_positions.id
+        FROM venues LEFT JOIN venue_positions ON venue_positions.venue_id = venues.id
+        WHERE venues.owner_id = $1 AND venues.rota_id = $2
+        """,
+        (PLACEHOLDER_ID, PLACEHOLDER_ID),
+    ),
+    (
+        "rota_positions",
+        "SELECT id FROM venue_positions WHERE rota_id = $1",
+        (PLACEHOLDER_ID,),
+    ),
+    (
+        "rota_assignments",
+        "SELECT position_id, date, person_id FROM assignments WHERE rota_id = $1",
+        (PLACEHOLDER_ID,),
+    ),
+    (
+        "person_assignments",
+        "SELECT position_id FROM assignments WHERE availability_id = $1 AND person_id = $2",
+        (PLACEHOLDER_ID, PLACEHOLDER_ID),
+    ),
+]
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    path: str
+    transactional: bool
+    statements: list[str]
+
+
+def split_statements(sql: str) -> list[str]:
+    """
+    Split a file of SQL into its statements. Statements end with a line
+    ending in a semicolon, so long as it's not inside a dollar quoted body.
+    """
+
+    statements: list[str] = []
+    current: list[str] = []
+    in_body = False
+    for line in sql.split("\n"):
+        if line.lstrip().startswith("--"):
+            continue
+        current.append(line)
+        if line.count("$$") % 2:
+            in_body = not in_body
+        if line.rstrip().endswith(";") and not in_body:
+            statement = "\n".join(current).strip()
+            if statement:
+                statements.append(statement)
+            current = []
+    if "\n".join(current).strip():
+        statements.append("\n".join(current).strip())
+    return statements
+
+
+def get_migrations(directory: str = MIGRATION_DIRECTORY) -> list[Migration]:
+    """
+    Read all of the migrations from the given directory, in version order.
+    """
+
+    migrations: list[Migration] = []
+    for filename in sorted(os.listdir(directory)):
+        match = MIGRATION_FILENAME_REGEX.match(filename)
+        if match is None:
+            continue
+        path = os.path.join(directory, filename)
+        with open(path) as a:
+            sql = a.read()
+        migrations.append(Migration(
+            int(match.group("version")),
+            match.group("name"),
+            path,
+            not sql.lstrip().lower().startswith("-- transaction: off"),
+            split_statements(sql),
+        ))
+    versions = [i.version for i in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError("Duplicate migration version numbers.")
+    return sorted(migrations, key=lambda i: i.version)
+
+
+async def apply_migrations(
+        conn: asyncpg.Connection,
+        migrations: list[Migration],
+        *,
+        dry_run: bool = False) -> list[Migration]:
+    """
+    Apply any of the given migrations that haven't been run yet, returning
+    the ones that were applied (or would have been, for a dry run).
+    """
+
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations(
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT TIMEZONE('UTC', NOW())
+        )
+        """
+    )
+    applied = {
+        r["version"]
+        for r in await conn.fetch("SELECT version FROM schema_migrations")
+    }
+
+    done: list[Migration] = []
+    for migration in migrations:
+        if migration.version in applied:
+            continue
+        done.append(migration)
+        if dry_run:
+            continue
+        print(f"Applying migration {migration.version} ({migration.name})", file=sys.stderr)
+
+        # Apply everything at once
+        if migration.transactional:
+            async with conn.transaction():
+                for statement in migration.statements:
+                    await conn.execute(statement)
+                await conn.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                    migration.version, migration.name,
+                )
+            continue
+
+        # A failed concurrent index build leaves an invalid index behind
+        # which IF NOT EXISTS would then skip, so clear those out first
+        index_names = [
+            match.group("name")
+            for statement in migration.statements
+            if (match := CONCURRENT_INDEX_REGEX.search(statement))
+        ]
+        invalid = await conn.fetch(
+            """
+            SELECT
+                pg_class.relname
+            FROM
+                pg_index
+            LEFT JOIN
+                pg_class
+            ON
+                pg_class.oid = pg_index.indexrelid
+            WHERE
+                NOT pg_index.indisvalid
+            AND
+                pg_class.relname = ANY($1::TEXT[])
+            """,
+            index_names,
+        )
+        for r in invalid:
+            await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{r["relname"]}"')
+        for statement in migration.statements:
+            await conn.execute(statement)
+        await conn.execute(
+            "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+            migration.version, migration.name,
+        )
+
+    return done
+
+
+def _find_unindexed_scans(plan: dict[str, Any]) -> list[str]:
+    found = []
+    node_type = plan.get("Node Type")
+    if node_type == "Seq Scan":
+        found.append(plan["Relation Name"])
+    elif node_type in ("Index Scan", "Index Only Scan") and "Index Cond" not in plan:
+        found.append(plan["Relation Name"])  # A full index walk with a filter
+    for i in plan.get("Plans", []):
+        found.extend(_find_unindexed_scans(i))
+    return found
+
+
+async def check_hot_paths(conn: asyncpg.Connection) -> dict[str, list[str]]:
+    """
+    Explain each of the hot path queries with sequential scans disabled,
+    returning the tables that are still scanned without an index condition
+    per query.
+    """
+
+    output: dict[str, list[str]] = {}
+    async with conn.transaction():
+        await conn.execute("SET LOCAL enable_seqscan = off")
+        await conn.execute("SET LOCAL plan_cache_mode = force_generic_plan")
+        for name, sql, args in HOT_PATH_QUERIES:
+            plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", *args)
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            output[name] = _find_unindexed_scans(plan[0]["Plan"])
+    return output
+
+
+async def main(args: argparse.Namespace) -> int:
+    with open(args.config) as a:
+        config = toml.load(a)
+    database_config = {
+        i: o
+        for i, o in config["database"].items()
+        if i in ("host", "port", "database", "user", "password",)
+    }
+    conn = await asyncpg.connect(**database_config)
+    try:
+
+        # Run the sequential scan check
+        if args.check:
+            failed = False
+            for name, tables in (await check_hot_paths(conn)).items():
+                if tables:
+                    failed = True
+                    print(f"SEQ SCAN {name}: {', '.join(tables)}")
+                else:
+                    print(f"ok       {name}")
+            return int(failed)
+
+        # Apply (or list) the migrations
+        migrations = get_migrations(args.directory)
+        pending = await apply_migrations(conn, migrations, dry_run=args.list)
+        if args.list:
+            for i in migrations:
+                print(f"{'pending' if i in pending else 'applied'} {i.version:04d} {i.name}")
+        return 0
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply database migrations.")
+    parser.add_argument("--config", default="config/website.toml")
+    parser.add_argument("--directory", default=MIGRATION_DIRECTORY)
+    parser.add_argument("--list", action="store_true", help="List migrations without applying them.")
+    parser.add_argument("--check", action="store_true", help="Flag hot path queries that sequentially scan.")
+    exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import binascii
+import concurrent.futures
+import hashlib
+import hmac
+import logging
+import os
+from typing import Any, ClassVar, Optional
+
+import toml
+
+
+__all__ = (
+    "PasswordHasher",
+    "PasswordHasherBusy",
+)
+
+
+log = logging.getLogger("rotaroamer.passwords")
+
+
+# The options that can be set in the [passwords] section of the website
+# config, and their defaults. Changing the scrypt cost makes every stored
+# hash with a different cost get rehashed the next time its user logs in.
+PASSWORD_DEFAULTS: dict[str, Any] = {
+    "scrypt_log_n": 15,  # CPU/memory cost, as a power of two
+    "scrypt_r": 8,  # Block size
+    "scrypt_p": 1,  # Parallelism
+    "hash_workers": 2,  # Threads doing hashing at once
+    "hash_queue_size": 32,  # Hashes running or waiting before we turn requests away
+}
+SALT_LENGTH = 16
+KEY_LENGTH = 32
+MD5_CRYPT_ALPHABET = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Raised when there are already too many passwords waiting to be hashed.
+    """
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+def _md5_crypt(password: bytes, salt: bytes) -> str:
+    """
+    The MD5 based crypt, as produced by ``CRYPT(password, GEN_SALT('MD5'))``
+    in Postgres. This is only used to check hashes made before we moved
+    hashing into the application.
+    """
+
+    salt = salt[:8]
+    inner = hashlib.md5(password + salt + password).digest()
+    outer = hashlib.md5(password + b"$1$" + salt)
+    for i in range(len(password), 0, -16):
+        outer.update(inner[:min(16, i)])
+    i = len(password)
+    while i:
+        outer.update(b"\x00" if i & 1 else password[:1])
+        i >>= 1
+    digest = outer.digest()
+    for i in range(1_000):
+        round_hash = hashlib.md5(password if i & 1 else digest)
+        if i % 3:
+            round_hash.update(salt)
+        if i % 7:
+            round_hash.update(password)
+        round_hash.update(digest if i & 1 else password)
+        digest = round_hash.digest()
+
+    # Encode the digest with crypt's own base64 alphabet and byte order
+    groups = [
+        ((digest[a] << 16) | (digest[b] << 8) | digest[c], 4)
+        for a, b, c in ((0, 6, 12), (1, 7, 13), (2, 8, 14), (3, 9, 15), (4, 10, 5))
+    ]
+    groups.append((digest[11], 2))
+    output = ""
+    for value, length in groups:
+        for _ in range(length):
+            output += MD5_CRYPT_ALPHABET[value & 0x3f]
+            value >>= 6
+    return f"$1${salt.decode()}${output}"
+
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords with scrypt, away from the event loop.
+
+    Hashes are stored as ``$scrypt$ln=15,r=8,p=1$<salt>$<key>``. Hashing is
+    run on a small thread pool (scrypt releases the GIL) so that a burst of
+    logins uses at most ``hash_workers`` cores, and once ``hash_queue_size``
+    hashes are running or waiting any more raise
+    :class:`PasswordHasherBusy` rather than queueing up behind them.
+
+    Hashes from Postgres' MD5 ``CRYPT`` are still accepted by
+    :meth:`verify`, which reports that they need rehashing.
+    """
+
+    config_file: ClassVar[str] = "config/website.toml"
+    options: ClassVar[Optional[dict[str, Any]]] = None
+    _executor: ClassVar[Optional[concurrent.futures.ThreadPoolExecutor]] = None
+    _pending: ClassVar[int] = 0
+
+    @classmethod
+    def load_options(cls) -> dict[str, Any]:
+        """
+        Read the password options from the website config file, falling
+        back to the defaults for anything that isn't set.
+        """
+
+        try:
+            with open(cls.config_file) as a:
+                password_config = toml.load(a).get("passwords", {})
+        except OSError:
+            password_config = {}
+        return {
+            i: password_config.get(i, o)
+            for i, o in PASSWORD_DEFAULTS.items()
+        }
+
+    @classmethod
+    def get_options(cls) -> dict[str, Any]:
+        if cls.options is None:
+            cls.options = cls.load_options()
+        return cls.options
+
+    @classmethod
+    def pending(cls) -> int:
+        """
+        Get how many hashes are running or waiting to run.
+        """
+
+        return cls._pending
+
+    @classmethod
+    async def _run(cls, func, *args) -> Any:
+        """
+        Run a hashing function on the hashing thread pool.
+        """
+
+        options = cls.get_options()
+        if cls._pending >= options["hash_queue_size"]:
+            log.warning("Password hashing queue is full (%s pending)", cls._pending)
+            raise PasswordHasherBusy()
+        if cls._executor is None:
+            cls._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=options["hash_workers"],
+                thread_name_prefix="password-hash",
+            )
+        cls._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(cls._executor, func, *args)
+        finally:
+            cls._pending -= 1
+
+    @classmethod
+    def _scrypt(cls, password: str, salt: bytes, log_n: int, r: int, p: int) -> bytes:
+        n = 2 ** log_n
+        return hashlib.scrypt(
+            password.encode(),
+            salt=salt,
+            n=n,
+            r=r,
+            p=p,
+            maxmem=256 * r * (n + p + 2),
+            dklen=KEY_LENGTH,
+        )
+
+    @classmethod
+    def hash_sync(cls, password: str) -> str:
+        """
+        Hash a password with the current scrypt options. This blocks, so
+        use :meth:`hash` from a handler.
+        """
+
+        options = cls.get_options()
+        log_n, r, p = options["scrypt_log_n"], options["scrypt_r"], options["scrypt_p"]
+        salt = os.urandom(SALT_LENGTH)
+        key = cls._scrypt(password, salt, log_n, r, p)
+        return f"$scrypt$ln={log_n},r={r},p={p}${_b64encode(salt)}${_b64encode(key)}"
+
+    @classmethod
+    def verify_sync(cls, password: str, pwhash: str) -> tuple[bool, bool]:
+        """
+        Check a password against a stored hash, returning whether it
+        matches and whether the hash should be replaced with a new one.
+        This blocks, so use :meth:`verify` from a handler.
+        """
+
+        # Hashes made by Postgres' CRYPT
+        if pwhash.startswith("$1$"):
+            salt = pwhash[3:].split("$", 1)[0]
+            expected = _md5_crypt(password.encode(), salt.encode())
+            return hmac.compare_digest(expected, pwhash), True
+
+        # Our own hashes
+        try:
+            _, scheme, params, salt, key = pwhash.split("$")
+            assert scheme == "scrypt"
+            parsed = dict(i.split("=") for i in params.split(","))
+            log_n, r, p = int(parsed["ln"]), int(parsed["r"]), int(parsed["p"])
+            assert log_n > 0 and r > 0 and p > 0
+            salt_bytes, key_bytes = _b64decode(salt), _b64decode(key)
+            actual = cls._scrypt(password, salt_bytes, log_n, r, p)
+        except (AssertionError, KeyError, OverflowError, ValueError, binascii.Error):
+            log.error("Unrecognised password hash format")
+            return False, False
+        if not hmac.compare_digest(actual, key_bytes):
+            return False, False
+        options = cls.get_options()
+        current = (options["scrypt_log_n"], options["scrypt_r"], options["scrypt_p"])
+        return True, (log_n, r, p) != current
+
+    @classmethod
+    async def hash(cls, password: str) -> str:
+        """
+        Hash a password on the hashing thread pool.
+        """
+
+        return await cls._run(cls.hash_sync, password)
+
+    @classmethod
+    async def verify(cls, password: str, pwhash: Optional[str]) -> tuple[bool, bool]:
+        """
+        Check a password against a stored hash on the hashing thread pool,
+        returning whether it matches and whether it needs rehashing. If
+        there's no stored hash, a dummy one is checked anyway so that
+        unknown emails take as long as wrong passwords.
+        """
+
+        if pwhash is None:
+            await cls._run(cls.hash_sync, password)
+            return False, False
+        return await cls._run(cls.verify_sync, password, pwhash)
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Hashable, Iterable, Optional
+import uuid
+
+from .cache import ROLES_CACHE
+
+if TYPE_CHECKING:
+    from discord.ext import vbu
+
+
+__all__ = (
+    "RoleTree",
+    "get_role_tree",
+    "invalidate_role_tree",
+)
+
+
+def _key(value: Any) -> Optional[Hashable]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        return uuid.UUID(value)
+    return value
+
+
+class RoleTree:
+    """
+    The role hierarchy for a single owner, with every role's ancestors
+    worked out up front so that eligibility checks are a dict lookup.
+
+    A person can fill a position if the position has no role, or if the
+    position's role is the person's role or one of its ancestors (so a
+    Senior Bartender, whose parent is Bartender, can fill a Bartender
+    position but not the other way around).
+
+    Parent links that loop back on themselves are cut where the loop is
+    found, and the roles involved are listed in ``cycles``.
+
+    Attributes
+    -----------
+    names: dict[UUID, str]
+        The name of each role.
+    parents: dict[UUID, Optional[UUID]]
+        The parent of each role.
+    children: dict[Optional[UUID], list[UUID]]
+        The children of each role, with the top level roles under None.
+    ancestors: dict[UUID, dict[UUID, int]]
+        Each role's ancestors (including itself) mapped to how many steps
+        up the tree they are.
+    cycles: set[UUID]
+        The roles whose parent links form a loop.
+    """
+
+    def __init__(self, roles: Iterable[tuple[Any, str, Any]]):
+        self.names: dict[Hashable, str] = {}
+        self.parents: dict[Hashable, Optional[Hashable]] = {}
+        for role_id, name, parent_id in roles:
+            self.names[role_id] = name
+            self.parents[role_id] = parent_id
+
+        # Work out the ancestors for each role, cutting any loops
+        self.ancestors: dict[Hashable, dict[Hashable, int]] = {}
+        self.cycles: set[Hashable] = set()
+        for role_id in self.parents:
+            ancestors: dict[Hashable, int] = {}
+            working: Optional[Hashable] = role_id
+            while working is not None and working in self.parents:
+                if working in ancestors:
+                    loop_start = ancestors[working]
+                    self.cycles.update(i for i, o in ancestors.items() if o >= loop_start)
+                    break
+                ancestors[working] = len(ancestors)
+                working = self.parents[working]
+            self.ancestors[role_id] = ancestors
+
+        # And the children of each role
+        self.children: dict[Optional[Hashable], list[Hashable]] = {None: []}
+        for role_id, parent_id in self.parents.items():
+            if parent_id not in self.parents:
+                parent_id = None
+            self.children.setdefault(parent_id, []).append(role_id)
+        for i in self.children.values():
+            i.sort(key=lambda role_id: self.names[role_id].lower())
+
+    @classmethod
+    async def fetch(cls, db: vbu.Database, owner_id: Any, *, lock: bool = False) -> RoleTree:
+        """
+        Load the role tree for an owner in a single query. If ``lock`` is
+        set, the owner's roles are locked until the end of the transaction
+        (always in the same order, so that two edits can't deadlock).
+        """
+
+        rows = await db.call(
+            """
+            SELECT
+                id,
+                name,
+                parent_id
+            FROM
+                roles
+            WHERE
+                owner_id = $1
+            {0}
+            """.format("ORDER BY id FOR UPDATE" if lock else ""),
+            owner_id,
+        )
+        return cls((r["id"], r["name"], r["parent_id"]) for r in rows)
+
+    def __contains__(self, role_id: Any) -> bool:
+        return _key(role_id) in self.parents
+
+    def distance(self, role_id: Any, ancestor_id: Any) -> Optional[int]:
+        """
+        Get how many steps up the tree from a role an ancestor is, or None
+        if it isn't an ancestor.
+        """
+
+        return self.ancestors.get(_key(role_id), {}).get(_key(ancestor_id))
+
+    def can_fill(self, person_role_id: Any, position_role_id: Any) -> bool:
+        """
+        Whether someone with the given role can fill a position with the
+        given role.
+        """
+
+        if _key(position_role_id) is None:
+            return True
+        return self.distance(person_role_id, position_role_id) is not None
+
+    def descendants(self, role_id: Any) -> set[Hashable]:
+        """
+        Get the roles that can fill positions with the given role - that is,
+        the role itself and every role underneath it.
+        """
+
+        role_id = _key(role_id)
+        return {
+            i
+            for i, ancestors in self.ancestors.items()
+            if role_id in ancestors
+        }
+
+    def would_cycle(self, role_id: Any, parent_id: Any) -> bool:
+        """
+        Whether giving a role the given parent would make a loop - that is,
+        whether the new parent is the role itself or one of its descendants.
+        """
+
+        role_id, parent_id = _key(role_id), _key(parent_id)
+        if parent_id is None:
+            return False
+        return role_id in self.ancestors.get(parent_id, {parent_id: 0})
+
+    def to_json(self) -> list[dict[str, Any]]:
+        """
+        Get the whole tree as nested lists of roles, starting with the top
+        level roles.
+        """
+
+        seen: set[Hashable] = set()
+
+        def build(role_id: Hashable, depth: int) -> dict[str, Any]:
+            seen.add(role_id)
+            return {
+                "id": role_id,
+                "name": self.names[role_id],
+                "parent": self.parents[role_id],
+                "depth": depth,
+                "children": [
+                    build(i, depth + 1)
+                    for i in self.children.get(role_id, [])
+                    if i not in seen
+                ],
+            }
+
+        output = [build(i, 0) for i in self.children[None]]
+        for role_id in sorted(self.cycles - seen, key=str):
+            if role_id not in seen:
+                output.append(build(role_id, 0))
+        return output
+
+
+async def get_role_tree(db: vbu.Database, owner_id: Any, *, version: Optional[int] = None) -> RoleTree:
+    """
+    Get the role tree for an owner, from the roles cache if we have it. If
+    the version of their roles is given, only a tree cached at that version
+    is used.
+    """
+
+    return await ROLES_CACHE.get(
+        owner_id,
+        ("tree", version),
+        lambda: RoleTree.fetch(db, owner_id),
+    )
+
+
+def invalidate_role_tree(owner_id: Any) -> None:
+    """
+    Drop the cached role tree (and everything else in the roles cache) for
+    an owner, for after their roles change.
+    """
+
+    ROLES_CACHE.invalidate(owner_id)
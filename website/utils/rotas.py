@@ -0,0 +1,307 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Optional
+
+from .shifts import parse_shift
+
+if TYPE_CHECKING:
+    from discord.ext import vbu
+
+
+__all__ = (
+    "fetch_rota_venues",
+    "save_rota_venues",
+)
+
+
+async def fetch_rota_venues(
+        db: vbu.Database,
+        owner_id: Any,
+        rota_id: Any) -> list[dict[str, Any]]:
+    """
+    Get the venues for a rota, each with a list of their positions, in a
+    single query.
+    """
+
+    rows = await db.call(
+        """
+        SELECT
+            venues.id AS venue_id,
+            venues.name AS venue_name,
+            venues.index AS venue_index,
+            venue_positions.id,
+            venue_positions.role_id,
+            venue_positions.index,
+            venue_positions.start_time,
+            venue_positions.end_time,
+            venue_positions.start_minute,
+            venue_positions.end_minute,
+            venue_positions.notes
+        FROM
+            venues
+        LEFT JOIN
+            venue_positions
+        ON
+            venue_positions.venue_id = venues.id
+        WHERE
+            venues.owner_id = $1
+        AND
+            venues.rota_id = $2
+        ORDER BY
+            venues.index ASC,
+            venues.name ASC,
+            venues.id ASC,
+            venue_positions.index ASC
+        """,
+        owner_id, rota_id,
+    )
+
+    # Nest the positions into their venues
+    venues: list[dict[str, Any]] = []
+    for r in rows:
+        if not venues or venues[-1]["id"] != r["venue_id"]:
+            venues.append({
+                "id": r["venue_id"],
+                "name": r["venue_name"],
+                "index": r["venue_index"],
+                "positions": [],
+            })
+        if r["id"] is None:
+            continue  # Venue with no positions
+        venues[-1]["positions"].append({
+            "id": r["id"],
+            "role": r["role_id"],
+            "index": r["index"],
+            "start": r["start_time"],
+            "end": r["end_time"],
+            "start_minute": r["start_minute"],
+            "end_minute": r["end_minute"],
+            "notes": r["notes"],
+        })
+    return venues
+
+
+async def save_rota_venues(
+        db: vbu.Database,
+        owner_id: Any,
+        rota_id: Any,
+        venues: list[dict[str, Any]]) -> Optional[dict[str, int]]:
+    """
+    Save the given venue/position structure for a rota, changing only the
+    rows that differ from what's stored. Venues and positions that are
+    given with the ID of an existing row keep that ID. Each position's start
+    and end times are parsed and stored alongside the text.
+
+    Everything runs in a single transaction, so a failed save leaves the
+    rota as it was. Returns the number of rows inserted, updated, and
+    deleted, or None if the rota doesn't exist.
+    """
+
+    async with db.transaction() as transaction:
+
+        # Lock the rota so that concurrent saves can't interleave
+        rota_rows = await transaction.call(
+            """
+            SELECT
+                id
+            FROM
+                rotas
+            WHERE
+                owner_id = $1
+            AND
+                id = $2
+            FOR UPDATE
+            """,
+            owner_id, rota_id,
+        )
+        if not rota_rows:
+            return None
+        current = await fetch_rota_venues(transaction, owner_id, rota_id)  # type: ignore
+        current_venues = {
+            str(i["id"]): i
+            for i in current
+        }
+        current_positions = {
+            str(p["id"]): (v["id"], p)
+            for v in current
+            for p in v["positions"]
+        }
+        counts = {
+            "inserted": 0,
+            "updated": 0,
+            "deleted": 0,
+        }
+
+        # Work out which venues are new and which have changed
+        venue_ids: list[Any] = []
+        new_venues: list[tuple[int, str]] = []
+        updated_venues: list[tuple[Any, str, int]] = []
+        for index, venue in enumerate(venues):
+            existing = current_venues.pop(str(venue.get("id")), None)
+            if existing is None:
+                venue_ids.append(None)
+                new_venues.append((index, venue["name"]))
+                continue
+            venue_ids.append(existing["id"])
+            if (existing["name"], existing["index"]) != (venue["name"], index):
+                updated_venues.append((existing["id"], venue["name"], index))
+
+        # Add the new venues all at once and grab their IDs
+        if new_venues:
+            new_venue_rows = await transaction.call(
+                """
+                INSERT INTO
+                    venues
+                    (
+                        owner_id,
+                        rota_id,
+                        name,
+                        index
+                    )
+                SELECT
+                    $1,
+                    $2,
+                    new_venues.name,
+                    new_venues.index
+                FROM
+                    UNNEST($3::TEXT[], $4::INTEGER[]) AS new_venues(name, index)
+                RETURNING
+                    id, index
+                """,
+                owner_id, rota_id,
+                [i[1] for i in new_venues],
+                [i[0] for i in new_venues],
+            )
+            for r in new_venue_rows:
+                venue_ids[r["index"]] = r["id"]
+            counts["inserted"] += len(new_venue_rows)
+        if updated_venues:
+            await transaction.execute_many(
+                """
+                UPDATE
+                    venues
+                SET
+                    name = $2,
+                    index = $3
+                WHERE
+                    id = $1
+                """,
+                *updated_venues,
+            )
+            counts["updated"] += len(updated_venues)
+
+        # Work out which positions are new and which have changed
+        new_positions: list[tuple[Any, ...]] = []
+        updated_positions: list[tuple[Any, ...]] = []
+        for venue_id, venue in zip(venue_ids, venues):
+            for index, position in enumerate(venue["positions"]):
+                start_minute, end_minute = parse_shift(position["start"], position["end"]) or (None, None)
+                values = (
+                    venue_id,
+                    position["role"] or None,
+                    index,
+                    position["start"],
+                    position["end"],
+                    start_minute,
+                    end_minute,
+                    position["notes"],
+                )
+                existing = current_positions.pop(str(position.get("id")), None)
+                if existing is None:
+                    new_positions.append(values)
+                    continue
+                existing_venue_id, existing_position = existing
+                current_values = (
+                    existing_venue_id,
+                    str(existing_position["role"]) if existing_position["role"] else None,
+                    existing_position["index"],
+                    existing_position["start"],
+                    existing_position["end"],
+                    existing_position["start_minute"],
+                    existing_position["end_minute"],
+                    existing_position["notes"],
+                )
+                if current_values != values:
+                    updated_positions.append((existing_position["id"], *values))
+
+        # Remove positions that weren't given, then apply the changes
+        if current_positions:
+            await transaction.call(
+                """
+                DELETE FROM
+                    venue_positions
+                WHERE
+                    id = ANY($1::UUID[])
+                """,
+                [i[1]["id"] for i in current_positions.values()],
+            )
+            counts["deleted"] += len(current_positions)
+        if updated_positions:
+            await transaction.execute_many(
+                """
+                UPDATE
+                    venue_positions
+                SET
+                    venue_id = $2,
+                    role_id = $3,
+                    index = $4,
+                    start_time = $5,
+                    end_time = $6,
+                    start_minute = $7,
+                    end_minute = $8,
+                    notes = $9
+                WHERE
+                    id = $1
+                """,
+                *updated_positions,
+            )
+            counts["updated"] += len(updated_positions)
+        if new_positions:
+            await transaction.execute_many(
+                """
+                INSERT INTO
+                    venue_positions
+                    (
+                        owner_id,
+                        rota_id,
+                        venue_id,
+                        role_id,
+                        index,
+                        start_time,
+                        end_time,
+                        start_minute,
+                        end_minute,
+                        notes
+                    )
+                VALUES
+                    (
+                        $1,
+                        $2,
+                        $3,
+                        $4,
+                        $5,
+                        $6,
+                        $7,
+                        $8,
+                        $9,
+                        $10
+                    )
+                """,
+                *[(owner_id, rota_id, *i) for i in new_positions],
+            )
+            counts["inserted"] += len(new_positions)
+
+        # And remove the venues that weren't given
+        if current_venues:
+            await transaction.call(
+                """
+                DELETE FROM
+                    venues
+                WHERE
+                    id = ANY($1::UUID[])
+                """,
+                [i["id"] for i in current_venues.values()],
+            )
+            counts["deleted"] += len(current_venues)
+
+    return counts
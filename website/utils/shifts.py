@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+from datetime import date, timedelta
+import re
+from typing import Any, Iterable, NamedTuple, Optional
+
+
+__all__ = (
+    "MINUTES_PER_DAY",
+    "parse_time",
+    "parse_shift",
+    "shift_minutes",
+    "BookedShift",
+    "ShiftConflict",
+    "find_conflicts",
+)
+
+
+MINUTES_PER_DAY = 24 * 60
+
+
+TIME_REGEX = re.compile(
+    r"""
+    ^\s*
+    (?P<hour>\d{1,2})
+    (?:\s*[:.h]?\s*(?P<minute>\d{2}))?
+    \s*(?P<meridiem>[ap]\.?m\.?)?
+    \s*$
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+NAMED_TIMES = {
+    "midnight": 0,
+    "noon": 12 * 60,
+    "midday": 12 * 60,
+}
+
+
+def parse_time(value: Optional[str]) -> Optional[int]:
+    """
+    Parse a user-given time string (eg "9", "09:30", "9.30pm", "noon") into
+    the number of minutes since midnight.
+    Returns None if the string can't be understood.
+    """
+
+    if not value:
+        return None
+    value = value.strip().casefold()
+    if value in NAMED_TIMES:
+        return NAMED_TIMES[value]
+    match = TIME_REGEX.match(value)
+    if match is None:
+        return None
+
+    # Get the parts
+    hour = int(match.group("hour"))
+    minute = int(match.group("minute") or 0)
+    meridiem = (match.group("meridiem") or "").replace(".", "")
+    if minute >= 60:
+        return None
+
+    # Sort out 12 hour times
+    if meridiem:
+        if not 1 <= hour <= 12:
+            return None
+        hour %= 12
+        if meridiem == "pm":
+            hour += 12
+    elif hour == 24 and minute == 0:
+        hour = 0
+    elif hour > 23:
+        return None
+    return hour * 60 + minute
+
+
+def parse_shift(start: Optional[str], end: Optional[str]) -> Optional[tuple[int, int]]:
+    """
+    Parse a shift's user-given start and end times into the minute of the
+    day that it starts and ends. Shifts that end at or before they start are
+    treated as running overnight, so end past the end of the day (eg "22:00"
+    to "6am" is ``(1320, 1800)``).
+    Returns None if either of the times can't be parsed.
+    """
+
+    start_minute = parse_time(start)
+    end_minute = parse_time(end)
+    if start_minute is None or end_minute is None:
+        return None
+    if end_minute <= start_minute:
+        end_minute += MINUTES_PER_DAY
+    return start_minute, end_minute
+
+
+def shift_minutes(start: Optional[str], end: Optional[str]) -> Optional[int]:
+    """
+    Get the length of a shift in minutes from its user-given start and end
+    times. Shifts that end at or before they start are treated as running
+    overnight.
+    Returns None if either of the times can't be parsed.
+    """
+
+    shift = parse_shift(start, end)
+    if shift is None:
+        return None
+    return shift[1] - shift[0]
+
+
+class BookedShift(NamedTuple):
+    person_id: Any
+    position_id: Any
+    venue_id: Any
+    day: int  # The index of the day from the start of the availability
+    start_minute: int  # From midnight on the day
+    end_minute: int  # Past MINUTES_PER_DAY for overnight shifts
+
+    @property
+    def start(self) -> int:
+        return self.day * MINUTES_PER_DAY + self.start_minute
+
+    @property
+    def end(self) -> int:
+        return self.day * MINUTES_PER_DAY + self.end_minute
+
+
+class ShiftConflict(NamedTuple):
+    person_id: Any
+    first: BookedShift
+    second: BookedShift  # Starts before the first has ended
+
+    def to_json(self, start_date: date) -> dict[str, Any]:
+        """
+        Get the conflict to send back, with the days of the shifts as dates
+        counted from the given start of the period.
+        """
+
+        return {
+            "person": self.person_id,
+            "positions": [self.first.position_id, self.second.position_id],
+            "venues": [self.first.venue_id, self.second.venue_id],
+            "dates": [
+                start_date + timedelta(days=self.first.day),
+                start_date + timedelta(days=self.second.day),
+            ],
+        }
+
+
+def find_conflicts(shifts: Iterable[BookedShift]) -> list[ShiftConflict]:
+    """
+    Find everyone who's been put into shifts that overlap, including
+    overnight shifts running into the next day's.
+
+    The shifts are sorted by person and start time and then swept through
+    once, keeping the shift that ends last so far for the current person -
+    anything that starts before that shift ends overlaps it. Shifts that
+    only touch (one ending at the minute the next starts) don't conflict.
+    """
+
+    ordered = sorted(shifts, key=lambda i: (str(i.person_id), i.start, i.end))
+    conflicts: list[ShiftConflict] = []
+    latest: Optional[BookedShift] = None
+    for shift in ordered:
+        if latest is None or latest.person_id != shift.person_id:
+            latest = shift
+            continue
+        if shift.start < latest.end:
+            conflicts.append(ShiftConflict(shift.person_id, latest, shift))
+        if shift.end > latest.end:
+            latest = shift
+    return conflicts
@@ -0,0 +1,264 @@
+from __future__ import annotations
+
+from collections import defaultdict
+import heapq
+from typing import TYPE_CHECKING, Any, Hashable, Iterable, NamedTuple, Sequence
+
+if TYPE_CHECKING:
+    from .roles import RoleTree
+
+
+__all__ = (
+    "SolverPerson",
+    "SolverPosition",
+    "Assignment",
+    "MinCostFlow",
+    "solve_rota",
+)
+
+
+# How much it "costs" to put someone into a shift - a lower total cost is a
+# better rota. Anyone who's marked themselves as "P" (preferably not) is only
+# used when there's no-one else, and people with a role further down the tree
+# from the position's role are used after people with the exact role.
+PREFERRED_NOT_COST = 1_000
+ROLE_DISTANCE_COST = 10
+HOUR_WORKED_COST = 1
+
+
+class SolverPerson(NamedTuple):
+    id: Any
+    role_id: Any
+    maximum_minutes: int  # 0 for no maximum
+    worked_minutes: int = 0  # Already worked in the period, in other rotas
+
+
+class SolverPosition(NamedTuple):
+    id: Any
+    venue_id: Any
+    role_id: Any
+    minutes: int
+
+
+class Assignment(NamedTuple):
+    position_id: Any
+    venue_id: Any
+    day: int  # The index of the day from the start of the availability
+    person_id: Any  # None if no-one could fill the position
+
+
+class MinCostFlow:
+    """
+    A min-cost max-flow network solved with the primal-dual method - Dijkstra
+    over reduced costs to update the node potentials, followed by blocking
+    flows (as in Dinic's algorithm) along the zero reduced cost edges.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.graph: list[list[list[int]]] = [[] for _ in range(size)]
+
+    def add_edge(self, source: int, target: int, capacity: int, cost: int) -> list[int]:
+        """
+        Add a directed edge into the network, returning it so that its
+        remaining capacity can be checked after the flow is run.
+        """
+
+        edge = [target, capacity, cost, len(self.graph[target])]
+        reverse = [source, 0, -cost, len(self.graph[source])]
+        self.graph[source].append(edge)
+        self.graph[target].append(reverse)
+        return edge
+
+    def flow(self, source: int, sink: int) -> tuple[int, int]:
+        """
+        Push as much flow as possible from the source to the sink for the
+        lowest cost. Returns the total flow and its cost.
+        """
+
+        graph = self.graph
+        potential = [0] * self.size
+        total_flow = 0
+        total_cost = 0
+        infinity = float("inf")
+
+        while True:
+
+            # Dijkstra over the reduced costs
+            distance: list[float] = [infinity] * self.size
+            distance[source] = 0
+            heap = [(0, source)]
+            while heap:
+                current, node = heapq.heappop(heap)
+                if current > distance[node]:
+                    continue
+                for target, capacity, cost, _ in graph[node]:
+                    if capacity <= 0:
+                        continue
+                    new = current + cost + potential[node] - potential[target]
+                    if new < distance[target]:
+                        distance[target] = new
+                        heapq.heappush(heap, (new, target))
+            sink_distance = distance[sink]
+            if sink_distance == infinity:
+                break
+
+            # Update potentials so that every shortest path edge is zero cost
+            for node in range(self.size):
+                potential[node] += min(distance[node], sink_distance)  # type: ignore
+
+            # Push blocking flows down the zero cost edges
+            while True:
+                level = self._levels(source, potential)
+                if level[sink] < 0:
+                    break
+                iterators = [0] * self.size
+                while (pushed := self._push(source, sink, 1 << 30, level, iterators, potential)):
+                    total_flow += pushed
+                    total_cost += pushed * (potential[sink] - potential[source])
+
+        return total_flow, total_cost
+
+    def _levels(self, source: int, potential: list[int]) -> list[int]:
+        level = [-1] * self.size
+        level[source] = 0
+        queue = [source]
+        for node in queue:
+            for target, capacity, cost, _ in self.graph[node]:
+                if (
+                        capacity > 0
+                        and level[target] < 0
+                        and cost + potential[node] - potential[target] == 0):
+                    level[target] = level[node] + 1
+                    queue.append(target)
+        return level
+
+    def _push(
+            self,
+            node: int,
+            sink: int,
+            limit: int,
+            level: list[int],
+            iterators: list[int],
+            potential: list[int]) -> int:
+        if node == sink:
+            return limit
+        edges = self.graph[node]
+        while iterators[node] < len(edges):
+            edge = edges[iterators[node]]
+            target, capacity, cost, reverse = edge
+            if (
+                    capacity > 0
+                    and level[target] == level[node] + 1
+                    and cost + potential[node] - potential[target] == 0):
+                pushed = self._push(
+                    target, sink, min(limit, capacity),
+                    level, iterators, potential,
+                )
+                if pushed:
+                    edge[1] -= pushed
+                    self.graph[target][reverse][1] += pushed
+                    return pushed
+            iterators[node] += 1
+        return 0
+
+
+def solve_rota(
+        people: Iterable[SolverPerson],
+        positions: Sequence[SolverPosition],
+        roles: RoleTree,
+        availability: dict[Hashable, Sequence[str]],
+        days: int) -> list[Assignment]:
+    """
+    Assign people to every position on every day of a rota.
+
+    A person can fill a position if the position has no role, or if the
+    position's role is the person's role or one of its ancestors. People
+    are never put into more than one position a day, never put into a day
+    they've marked as unavailable (or haven't filled in), and never put
+    past their maximum working minutes for the period (counting what they
+    already work in it).
+
+    Each day is solved as a min-cost flow from people to groups of
+    identical positions, so the number of people and positions only grows
+    the size of the network rather than the number of passes over it.
+    """
+
+    people = list(people)
+    worked_minutes: dict[Hashable, int] = defaultdict(int)
+    for person in people:
+        worked_minutes[person.id] = person.worked_minutes
+
+    # Group the positions by the things that make them interchangeable
+    groups: dict[tuple[Any, int], list[SolverPosition]] = defaultdict(list)
+    for position in positions:
+        groups[(position.role_id, position.minutes)].append(position)
+    group_keys = list(groups.keys())
+
+    # Work out which groups each person could ever fill, and at what cost
+    eligible: dict[Hashable, list[tuple[int, int]]] = {}
+    for person in people:
+        person_ancestors = roles.ancestors.get(person.role_id, {})
+        eligible[person.id] = [
+            (
+                group_index,
+                0 if role_id is None else person_ancestors[role_id] * ROLE_DISTANCE_COST,
+            )
+            for group_index, (role_id, _) in enumerate(group_keys)
+            if role_id is None or role_id in person_ancestors
+        ]
+
+    output: list[Assignment] = []
+    for day in range(days):
+
+        # Set up the network - source, sink, groups, then people
+        source, sink = 0, 1
+        network = MinCostFlow(2 + len(group_keys) + len(people))
+        for group_index, key in enumerate(group_keys):
+            network.add_edge(2 + group_index, sink, len(groups[key]), 0)
+        person_edges: list[tuple[Hashable, int, list[int]]] = []
+        for person_index, person in enumerate(people):
+            person_availability = availability.get(person.id) or ()
+            state = person_availability[day] if day < len(person_availability) else "U"
+            if state not in ("A", "P"):
+                continue
+            node = 2 + len(group_keys) + person_index
+            added = False
+            for group_index, role_cost in eligible[person.id]:
+                minutes = group_keys[group_index][1]
+                worked = worked_minutes[person.id]
+                if person.maximum_minutes and worked + minutes > person.maximum_minutes:
+                    continue
+                cost = (
+                    role_cost
+                    + (PREFERRED_NOT_COST if state == "P" else 0)
+                    + (worked // 60) * HOUR_WORKED_COST
+                )
+                edge = network.add_edge(node, 2 + group_index, 1, cost)
+                person_edges.append((person.id, group_index, edge))
+                added = True
+            if added:
+                network.add_edge(source, node, 1, 0)
+        network.flow(source, sink)
+
+        # Read who got put into which group
+        remaining = {
+            key: list(groups[key])
+            for key in group_keys
+        }
+        filled: dict[Any, Hashable] = {}
+        for person_id, group_index, edge in person_edges:
+            if edge[1] == 0:
+                key = group_keys[group_index]
+                position = remaining[key].pop(0)
+                filled[position.id] = person_id
+                worked_minutes[person_id] += key[1]
+        for position in positions:
+            output.append(Assignment(
+                position.id,
+                position.venue_id,
+                day,
+                filled.get(position.id),
+            ))
+
+    return output